@@ -10,25 +10,50 @@ period of time.
 
 """
 
-import copy
+import functools
 import sys
+import time
+from concurrent.futures import CancelledError
 
+import numpy as np
 from six.moves import zip as szip
 from ..appcom.utils import background
 from ..backend import common as cm
 from ..dbbackend import get_models
+from ..dbbackend import update
+from .executors import get_executor
+from .utils import MemoizedResult
+from .utils import PredictionResult
 from .utils import get_nb_chunks
 from .utils import init_backend
 from .utils import pickle_gen
+from .utils import serialize_gen
 from .utils import switch_backend
 
 
+# asynchronous trainings sent with memoize=True, by model and data ids
+_IN_FLIGHT = dict()
+
+
+def track_in_flight(mod_data_id, res):
+    """Register an asynchronous training sent with memoize=True
+
+    Args:
+        mod_data_id(str): the concatenation of the model and data hashes
+        res(async result): the result of the training"""
+    for k in [k for k, r in _IN_FLIGHT.items() if r.ready()]:
+        _IN_FLIGHT.pop(k)
+    _IN_FLIGHT[mod_data_id] = res
+
+
 class Experiment(object):
     """An Experiment trains, predicts, saves and logs a model
 
     Attributes:
         model(model): the model used in the experiment
         metrics(list): a list of callables
+        executor(executor): the executor of the asynchronous tasks, the
+            default one if None (see :mod:`alp.appcom.executors`)
     """
 
     def __init__(self, model=None, metrics=None, verbose=0):
@@ -36,6 +61,10 @@ class Experiment(object):
         self.trained = False
         self.verbose = verbose
         self.metrics = metrics
+        self.async_res = None
+        self.stopped = False
+        self.prediction_cache = None
+        self.executor = None
         if model is not None:
             backend, backend_name, backend_version = init_backend(model)
             self.backend = backend
@@ -58,6 +87,7 @@ class Experiment(object):
         if isinstance(model_dict, dict) or model_dict is None:
             self.__model_dict = dict()
             self.__model_dict['model_arch'] = model_dict
+            self.__model_dict['arch_hash'] = self._arch_hash(model_dict)
             self.mod_id = None
             self.params_dump = None
             self.data_id = None
@@ -69,10 +99,19 @@ class Experiment(object):
             self.backend_version = backend_version
             self.__model_dict['model_arch'] = self.backend.to_dict_w_opt(
                 self.model, self.metrics)
+            self.__model_dict['arch_hash'] = self._arch_hash(
+                self.__model_dict['model_arch'])
             self.mod_id = None
             self.params_dump = None
             self.data_id = None
 
+    def _arch_hash(self, model_arch):
+        """Hash the architecture once so that the fits of the experiment do
+        not serialize it again"""
+        if model_arch is None or self.backend is None:
+            return None
+        return self.backend.arch_hash(model_arch)
+
     @property
     def params_dump(self):
         return self.__params_dump
@@ -113,6 +152,10 @@ class Experiment(object):
         Returns:
             the id of the model in the db, the id of the data in the db and
             path to the parameters.
+
+        If the keyword argument `memoize` is True and the same model was
+        already trained on the same data without error, the stored results are
+        returned and the model is not trained again.
         """
         res = self._prepare_fit(model, data, data_val, generator=False,
                                 delay=False, *args, **kwargs)
@@ -151,6 +194,11 @@ class Experiment(object):
         Returns:
             the id of the model in the db, the id of the data in the db and a
             path to the parameters.
+
+        If the keyword argument `prefetch` is a positive integer, the workers
+        read up to `prefetch` batches in advance in background threads and
+        the throughput statistics are returned in the `prefetch` key of the
+        results.
         """
         res = self._prepare_fit(model, gen_train, data_val, generator=True,
                                 delay=False, *args, **kwargs)
@@ -203,17 +251,124 @@ class Experiment(object):
     def predict(self, data, *args, **kwargs):
         """Make predictions given data
 
+        If a `PredictionCache` is set in the `prediction_cache` attribute,
+        the predictions of data already predicted by the same model are taken
+        from the cache.
+
         Args:
             data(np.array):
 
         Returns:
             an np.array of predictions"""
-        if self.trained:
-            return self.backend.predict(copy.deepcopy(self.model_dict), data,
+        if not self.trained:
+            raise Exception("You must have a trained model"
+                            "in order to make predictions")
+        if self.prediction_cache is None:
+            return self.backend.predict(self.model_dict, data,
                                         *args, **kwargs)
-        else:
+        key = (self.mod_id, self.data_id, cm.create_input_hash(data))
+        preds = self.prediction_cache.get(key, self.params_dump)
+        if preds is None:
+            preds = self.backend.predict(self.model_dict, data,
+                                         *args, **kwargs)
+            self.prediction_cache.put(key, preds, self.params_dump)
+        return preds
+
+    def predict_async(self, data, *args, **kwargs):
+        """Make predictions with a worker given data
+
+        Only the ids of the model are sent with the data, the worker uses the
+        compiled model from its cache (or loads it from the models
+        collection).
+
+        Args:
+            data(np.array):
+
+        Returns:
+            a `PredictionResult`, whose `wait` method returns an np.array of
+            predictions"""
+        if not self.trained:
             raise Exception("You must have a trained model"
                             "in order to make predictions")
+        f = self._task('predict_ref', delay=True)
+        res = f(self.mod_id, self.data_id, data, *args, **kwargs)
+        return PredictionResult(res)
+
+    def predict_shards(self, streams, *args, **kwargs):
+        """Make predictions on data streams read by the workers
+
+        Each stream (typically a shard of a dataset, see
+        :meth:`alp.appcom.datasets.shard_manifest`) is sent to a different
+        task so that the evaluation scales with the number of workers.
+
+        Args:
+            streams(list): a list of data streams
+
+        Returns:
+            an np.array of the predictions, in the order of the streams"""
+        if not self.trained:
+            raise Exception("You must have a trained model"
+                            "in order to make predictions")
+        f = self._task('predict_stream', delay=True)
+        tasks = [f(self.mod_id, self.data_id, serialize_gen(s),
+                   *args, **kwargs)
+                 for s in streams]
+        return np.concatenate([np.asarray(t.get()) for t in tasks])
+
+    def stop(self):
+        """Stop the asynchronous training of the model
+
+        If the task is still waiting in the queue, it is revoked. If it is
+        already running, the model is flagged as `stopped` in the models
+        collection and the worker stops the training at the end of the current
+        epoch (or chunk) so that the worker is freed for other models."""
+        if self.async_res is None:
+            raise Exception('No asynchronous training to stop')
+        if self.async_res.ready():
+            return
+        self.async_res.revoke()
+        filter_db = {'task_id': self.async_res.id}
+        # the models trained in a single task share its id
+        mod_data_id = getattr(self.async_res, 'mod_data_id', None)
+        if mod_data_id is not None:
+            filter_db['mod_data_id'] = mod_data_id
+        update(filter_db, {'$set': {'stopped': 1}})
+        self.stopped = True
+
+    def progress(self):
+        """Get the last progress published by the worker training the model
+
+        Returns:
+            None if no progress was published yet, a dictionnary with the
+            last `step` and `metrics`, and the list of the (step, metrics)
+            `steps` published since the previous progress otherwise"""
+        if self.async_res is None:
+            return None
+        if self.async_res.state != 'PROGRESS':
+            return None
+        return self.async_res.info
+
+    @background
+    def subscribe(self, callback, interval=1.):
+        """Follow the progress of the asynchronous training of the model
+
+        The progress is read from the state of the task, the models collection
+        is not polled.
+
+        Args:
+            callback(function): a function called with the experiment and the
+                progress (see `progress`) each time a new step is published
+            interval(float): the time between two checks of the state of the
+                task"""
+        if self.async_res is None:
+            raise Exception('No asynchronous training to follow')
+        last_step = 0
+        while not self.async_res.ready():
+            progress = self.progress()
+            if progress is not None and progress['step'] > last_step:
+                last_step = progress['step']
+                callback(self, progress)
+            time.sleep(interval)
 
     def _check_compile(self, model, kwargs_m):
         """Check if we have to recompile and reserialize the model
@@ -341,18 +496,74 @@ class Experiment(object):
                                                                     kwargs,
                                                                     generator)
 
-        f = self.backend.fit
-        if delay:
-            f = self.backend.fit.delay
+        if kwargs.get('memoize'):
+            mod_data_id = self._mod_data_id(data_hash,
+                                            kwargs.get('batch_size'))
+            memoized = self._check_memoized(mod_data_id, delay)
+            if memoized is not None:
+                return memoized
+
+        f = self._task('fit', delay)
         res = f(self.backend_name,
                 self.backend_version,
-                copy.deepcopy(self.model_dict),
+                self.model_dict,
                 data, data_hash, data_val,
                 size_gen=size_gen,
                 generator=generator,
                 *args, **kwargs)
+        if delay and kwargs.get('memoize'):
+            track_in_flight(mod_data_id, res)
         return self._handle_results(res, delay)
 
+    def _mod_data_id(self, data_hash, batch_size=None):
+        """The concatenation of the model and data hashes, as computed by
+        the workers"""
+        hexdi_m, _ = self.backend.make_hashes(self.model_dict, data_hash,
+                                              batch_size)
+        return hexdi_m + data_hash
+
+    def _task(self, name, delay=False):
+        """Get a task of the backend
+
+        Args:
+            name(str): the name of the task
+            delay(bool): if True, the task is sent by the executor of the
+                experiment and returns an asynchronous result
+
+        Returns:
+            a callable running the task"""
+        if not delay:
+            return getattr(self.backend, name)
+        executor = self.executor or get_executor()
+        return functools.partial(executor.submit, self.backend, name)
+
+    def _check_memoized(self, mod_data_id, delay):
+        """Check if the model was already trained (or is being trained) on the
+        same data
+
+        The trainings sent by other clients are detected by the workers,
+        which return pending results the client waits for (see
+        :func:`alp.backend.common.wait_memoized`). The file of the parameters
+        is checked by the workers, the client may not have access to it.
+
+        Args:
+            mod_data_id(str): the concatenation of the model and data hashes
+            delay(bool): if True the results are handled as async results
+
+        Returns:
+            the handled results if the model does not have to be sent, None
+            otherwise"""
+        model_db = cm.get_memoized(mod_data_id, check_file=False)
+        if model_db is not None:
+            res = cm.results_from_db(model_db)
+            if delay:
+                res = MemoizedResult(res, model_db.get('task_id'))
+            return self._handle_results(res, delay)
+        if delay and mod_data_id in _IN_FLIGHT:
+            if not _IN_FLIGHT[mod_data_id].ready():
+                return self._handle_results(_IN_FLIGHT[mod_data_id], delay)
+        return None
+
     def _handle_results(self, res, delay):
         """Modify the Experiment given the results received from the worker
 
@@ -363,8 +574,10 @@ class Experiment(object):
         Returns:
             the results and the thread used to handle the results"""
         if delay:
+            self.async_res = res
             thread = self._get_results(res)
         else:
+            res = cm.wait_memoized(res)
             self.mod_id = res['model_id']
             self.data_id = res['data_id']
             self.params_dump = res['params_dump']
@@ -380,8 +593,13 @@ class Experiment(object):
 
         Args:
             res(async result): result of an asynchronous task"""
+        from celery.exceptions import TaskRevokedError
         self.async_res = res
-        self.full_res = res.wait()  # pragma: no cover
+        try:
+            self.full_res = cm.wait_memoized(res.wait())  # pragma: no cover
+        except (TaskRevokedError, CancelledError):  # pragma: no cover
+            self.stopped = True
+            return
         self.trained = True  # pragma: no cover
         self.mod_id = self.full_res['model_id']  # pragma: no cover
         self.data_id = self.full_res['data_id']  # pragma: no cover
@@ -0,0 +1,208 @@
+"""
+Memory-mapped datasets
+======================
+
+A dataset is a directory holding one `.npy` file per source and a
+`manifest.json` file describing the sources and the splits. The
+`ArrayStream` serves the batches of a split as slices of memory-mapped
+arrays and can be passed to the workers instead of a Fuel stream.
+"""
+
+import json
+import os
+
+import numpy as np
+from six.moves import range as srange
+
+from .utils import norm_iterator
+
+_manifest_name = 'manifest.json'
+
+
+def to_npy_dataset(inputs, outputs, slices, names, dir_name, file_path=''):
+    """Save lists of numpy arrays as a memory-mappable dataset
+
+    Args:
+        inputs(list): a list of inputs(numpy.arrays)
+        outputs(list): a list of outputs(numpy.arrays)
+        slices(list): a list of int representing the end of a slice and the
+            begining of another slice. The last slice is automatically added
+            (maximum length of the inputs).
+        names(list): a list of names for the splits
+        dir_name(str): the name of the directory of the dataset
+        file_path(str): the path where the directory is created
+
+    Returns:
+        the path of the manifest, the names of the inputs and the names of
+        the outputs
+    """
+    full_path = os.path.join(file_path, dir_name.lower())
+    if not os.path.exists(full_path):
+        os.makedirs(full_path)
+
+    inputs_names = []
+    outputs_names = []
+    nb_examples = 0
+    for suf, iterable, names_out in [('input_', inputs, inputs_names),
+                                     ('output_', outputs, outputs_names)]:
+        for k, v in norm_iterator(iterable):
+            np.save(os.path.join(full_path, suf + k + '.npy'), v)
+            names_out.append(suf + k)
+            if suf == 'input_':
+                nb_examples = max(nb_examples, len(v))
+
+    bounds = list(slices) + [nb_examples]
+    splits = {name: [start, stop]
+              for name, start, stop in zip(names, bounds[:-1], bounds[1:])}
+    manifest = {'sources': inputs_names + outputs_names,
+                'splits': splits}
+    manifest_path = os.path.join(full_path, _manifest_name)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest_path, inputs_names, outputs_names
+
+
+def shard_manifest(path, nb_shards):
+    """Split a dataset in shards sharing its `.npy` files
+
+    Each split of the dataset is divided in `nb_shards` contiguous partitions
+    of almost equal sizes, the i-th shard holding the i-th partition of every
+    split. A manifest is written for each shard next to the manifest of the
+    dataset.
+
+    Args:
+        path(str): the path of the manifest of the dataset
+        nb_shards(int): the number of shards
+
+    Returns:
+        the list of the paths of the manifests of the shards"""
+    with open(path) as f:
+        manifest = json.load(f)
+    base, ext = os.path.splitext(path)
+    paths = []
+    for i in srange(nb_shards):
+        splits = dict()
+        for name, (start, stop) in manifest['splits'].items():
+            splits[name] = [start + (stop - start) * i // nb_shards,
+                            start + (stop - start) * (i + 1) // nb_shards]
+        shard = {'sources': manifest['sources'],
+                 'splits': splits,
+                 'shard': [i, nb_shards]}
+        shard_path = '{}_shard_{}_of_{}{}'.format(base, i, nb_shards, ext)
+        with open(shard_path, 'w') as f:
+            json.dump(shard, f, indent=4)
+        paths.append(shard_path)
+    return paths
+
+
+class ArrayDataset(object):
+    """A dataset of `.npy` files described by a manifest
+
+    The arrays are memory-mapped when the dataset is opened, they are not
+    pickled with the dataset.
+
+    Args:
+        path(str): the path of the manifest
+        sources(list, optionnal): the sources to load (all by default)
+    """
+    def __init__(self, path, sources=None):
+        self.path = path
+        with open(path) as f:
+            manifest = json.load(f)
+        self.splits = manifest['splits']
+        if sources is None:
+            sources = manifest['sources']
+        self.sources = tuple(sources)
+        self._arrays = None
+
+    def open(self):
+        """Memory-map the arrays of the sources"""
+        if self._arrays is None:
+            directory = os.path.dirname(self.path)
+            self._arrays = [np.load(os.path.join(directory, s + '.npy'),
+                                    mmap_mode='r')
+                            for s in self.sources]
+        return self._arrays
+
+    def close(self):
+        self._arrays = None
+
+    def get_data(self, request):
+        """Get the examples of a request
+
+        Args:
+            request(slice or np.array): the examples to get
+
+        Returns:
+            a tuple with one array per source"""
+        return tuple(a[request] for a in self.open())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+
+class ArrayScheme(object):
+    """An iteration scheme over the examples of a split
+
+    The sequential batches are slices, so that they are views of the
+    memory-mapped arrays. The shuffled batches are sorted arrays of indices so
+    that only the rows of the batch are read, in the order of the file.
+
+    Args:
+        indices(range): the indices of the examples
+        batch_size(int): the size of the batches
+        shuffle(bool): if True, the examples are shuffled at each epoch
+        seed(int, optionnal): the seed of the shuffling
+    """
+    def __init__(self, indices, batch_size, shuffle=False, seed=None):
+        self.indices = indices
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+
+    def get_request_iterator(self):
+        if len(self.indices) == 0:
+            return
+        if not self.shuffle:
+            start, stop = self.indices[0], self.indices[-1] + 1
+            for i in srange(start, stop, self.batch_size):
+                yield slice(i, min(i + self.batch_size, stop))
+        else:
+            order = self.rng.permutation(len(self.indices))
+            order += self.indices[0]
+            for i in srange(0, len(order), self.batch_size):
+                yield np.sort(order[i:i + self.batch_size])
+
+
+class ArrayStream(object):
+    """A data stream serving the batches of a split of an `ArrayDataset`
+
+    The stream exposes the `sources`, `dataset`, `iteration_scheme` and
+    `get_epoch_iterator` of a Fuel data stream so that it can be used in
+    place of one to train models.
+
+    Args:
+        path(str): the path of the manifest
+        which_set(str): the name of the split
+        batch_size(int): the size of the batches
+        shuffle(bool): if True, the examples are shuffled at each epoch
+        seed(int, optionnal): the seed of the shuffling
+        sources(list, optionnal): the sources to load (all by default)
+    """
+    def __init__(self, path, which_set, batch_size, shuffle=False, seed=None,
+                 sources=None):
+        self.dataset = ArrayDataset(path, sources)
+        self.sources = self.dataset.sources
+        self.which_set = which_set
+        start, stop = self.dataset.splits[which_set]
+        self.iteration_scheme = ArrayScheme(srange(start, stop), batch_size,
+                                            shuffle, seed)
+
+    def get_epoch_iterator(self, **kwargs):
+        for request in self.iteration_scheme.get_request_iterator():
+            yield self.dataset.get_data(request)
+
+    def close(self):
+        self.dataset.close()
@@ -3,7 +3,9 @@ Ensembles module
 ================
 """
 
+import os
 import warnings
+from collections import OrderedDict
 from time import time
 
 import numpy as np
@@ -16,6 +18,12 @@ from progressbar import Percentage
 from progressbar import ProgressBar
 from progressbar import SimpleProgress
 
+from ..backend import common as cm
+from .core import track_in_flight
+from .utils import GroupResult
+from .utils import PackSizer
+from .utils import PredictionCache
+
 
 def get_best(experiments, metric, op, partial=False):
     """Helper function for manipulation of a list of experiments
@@ -35,6 +43,8 @@ def get_best(experiments, metric, op, partial=False):
     list_keys = []
     not_ready = False
     for k, expe in experiments.items():
+        if expe.stopped and not hasattr(expe, 'full_res'):  # pragma: no cover
+            continue
         if not hasattr(expe, 'full_res'):  # pragma: no cover
             if not partial:
                 raise Exception('Results are not ready')
@@ -66,6 +76,142 @@ def get_best(experiments, metric, op, partial=False):
     return best[0], best_key[0]
 
 
+def get_top_k(experiments, metric, op, k=1, partial=False):
+    """Helper function returning the k best experiments
+
+    The experiments stopped early and the ones whose metric is nan are
+    ignored.
+
+    Args:
+        experiments(dict): a dictionnary mapping names to experiments
+        metric(str): the name of a metric used in the experiments
+        op(function): operation selecting the best value of the metric
+        k(int): the number of experiments returned
+        partial(bool): if True, the experiments without result are ignored.
+            Raise an error otherwise.
+
+    Returns:
+        a list of tuples (name, experiment, value of the metric) sorted from
+        the best experiment"""
+    scores = []
+    for key, expe in experiments.items():
+        if getattr(expe, 'full_res', None) is None:
+            if not partial and not expe.stopped:
+                raise Exception('Results are not ready')
+            continue
+        score = op(expe.full_res['metrics'][metric])
+        if np.isnan(score):
+            continue
+        scores.append((key, expe, score))
+
+    if len(scores) == 0:
+        raise Exception('No result is ready yet')
+
+    reverse = bool(op([0., 1.]) == 1.)
+    scores.sort(key=lambda x: x[2], reverse=reverse)
+    return scores[:k]
+
+
+def metric_weights(scores, op):
+    """Weights of the members of an ensemble given their validation metric
+
+    The weights are proportional to the metric if the best value is the
+    maximum (e.g. an accuracy), to its inverse otherwise (e.g. a loss).
+
+    Args:
+        scores(list): the values of the metric
+        op(function): operation selecting the best value of the metric
+
+    Returns:
+        an np.array of weights summing to 1"""
+    scores = np.asarray(scores, dtype='float64')
+    if op([0., 1.]) != 1.:
+        scores = 1. / np.maximum(scores, np.finfo('float64').eps)
+    return scores / scores.sum()
+
+
+def median_stopping(histories, op=np.min, min_steps=1):
+    """Median stopping rule
+
+    An experiment is stopped if its best value of the metric so far is worse
+    than the median of the running averages of the other experiments at the
+    same step.
+
+    Args:
+        histories(dict): a dictionnary mapping experiments names to the list
+            of the intermediate values of a metric
+        op(function): operation selecting the best value of the metric
+        min_steps(int): the minimum number of steps before stopping an
+            experiment
+
+    Returns:
+        the list of the names of the experiments to stop"""
+    to_stop = []
+    for k, hist in histories.items():
+        step = len(hist)
+        if step < min_steps:
+            continue
+        others = [np.mean(h[:step]) for ko, h in histories.items()
+                  if ko != k and len(h) >= step]
+        if len(others) == 0:
+            continue
+        best = op(hist)
+        median = np.median(others)
+        if best != median and op([best, median]) == median:
+            to_stop.append(k)
+    return to_stop
+
+
+def threshold_stopping(threshold, min_steps=1):
+    """Build a stopping rule based on a threshold
+
+    Args:
+        threshold(float): an experiment whose last value of the metric is
+            worse than this threshold is stopped
+        min_steps(int): the minimum number of steps before stopping an
+            experiment
+
+    Returns:
+        a stopping rule to be passed to `HParamsSearch.early_stop`"""
+    def policy(histories, op=np.min):
+        to_stop = []
+        for k, hist in histories.items():
+            if len(hist) < min_steps:
+                continue
+            last = hist[-1]
+            if last != threshold and op([last, threshold]) == threshold:
+                to_stop.append(k)
+        return to_stop
+    return policy
+
+
+def average(predictions):
+    """Average the predictions of the members of an ensemble
+
+    Args:
+        predictions(np.array): the predictions stacked on the first axis
+
+    Returns:
+        an np.array of predictions"""
+    return np.mean(predictions, axis=0)
+
+
+def vote(predictions):
+    """Majority vote of the predictions of the members of an ensemble
+
+    Args:
+        predictions(np.array): the predicted classes stacked on the first axis
+
+    Returns:
+        an np.array of the most predicted classes"""
+    predictions = np.asarray(predictions)
+    classes, inverse = np.unique(predictions, return_inverse=True)
+    inverse = inverse.reshape(predictions.shape)
+    counts = np.apply_along_axis(np.bincount, 0, inverse,
+                                 minlength=len(classes))
+    return classes[counts.argmax(axis=0)]
+
+
 widgets = [Percentage(), ' ',
            SimpleProgress(), ' ',
            Bar(marker='=', left='[', right=']'),
@@ -73,6 +219,31 @@ widgets = [Percentage(), ' ',
            ETA(), ' | ', 'job/', DynamicMessage('s')]
 
 
+def path_groups(experiments):
+    """Group the experiments differing only by their regularization parameter
+
+    Only the sklearn models with a parameter in the `PATH_PARAMS` of the
+    backend can be grouped, every other experiment is alone in its group.
+
+    Args:
+        experiments(dict): a dict of experiments
+
+    Returns:
+        a list of lists of keys of the experiments, in the order of the dict
+    """
+    groups = OrderedDict()
+    for k, expe in experiments.items():
+        group = ('single', k)
+        if expe.backend_name == 'sklearn' and expe.model_dict is not None:
+            arch = expe.model_dict['model_arch']
+            param = expe.backend.PATH_PARAMS.get(arch['config'])
+            if param is not None:
+                group = ('path', cm.serialize_arch(
+                    {p: v for p, v in arch.items() if p != param}))
+        groups.setdefault(group, []).append(k)
+    return list(groups.values())
+
+
 class Ensemble(object):
 
     """Base class to build experiments containers able to execute batch
@@ -132,6 +303,8 @@ class HParamsSearch(Ensemble):
         self.metric = metric
         self.op = op
         self.results = dict()
+        self.predictions = PredictionCache()
+        self.pack_sizer = PackSizer()
 
     def fit(self, data, data_val, *args, **kwargs):
         """Apply the fit method to all the experiments
@@ -177,6 +350,157 @@ class HParamsSearch(Ensemble):
         self._fit_cm(data, data_val, gen=False, async=True, *args, **kwargs)
         return self.results
 
+    def fit_path(self, data, data_val, *args, **kwargs):
+        """Apply the fit method to all the experiments, the sklearn models
+        differing only by their regularization parameter being trained along
+        a path in a single task
+
+        Each model of a path still gets its own document and parameters. The
+        paths are only computed on a single dict of training data, the
+        experiments are otherwise fitted one by one.
+
+        Args:
+            see `alp.core.Experiment.fit`
+
+        Returns:
+            a list of results"""
+        return self._fit_path(data, data_val, False, *args, **kwargs)
+
+    def fit_path_async(self, data, data_val, *args, **kwargs):
+        """Apply the fit_async method to all the experiments, the sklearn
+        models differing only by their regularization parameter being trained
+        along a path in a single task
+
+        Args:
+            see :meth:`alp.appcom.core.Experiment.fit_async`
+
+        Returns:
+            a list of results"""
+        return self._fit_path(data, data_val, True, *args, **kwargs)
+
+    def _fit_path(self, data, data_val, delay, *args, **kwargs):
+        groups = path_groups(self.experiments)
+        # the paths are only computed on a single dict of training data
+        single = (isinstance(data, list) and len(data) == 1 and
+                  isinstance(data[0], dict))
+        if not single:
+            groups = [[k] for keys in groups for k in keys]
+        for keys in groups:
+            if len(keys) == 1:
+                expe = self.experiments[keys[0]]
+                f = expe.fit_async if delay else expe.fit
+                self.results[keys[0]] = f(data, data_val, *args, **kwargs)
+            else:
+                self._fit_group('fit_path', keys, data, data_val, delay,
+                                *args, **kwargs)
+        return self.results
+
+    def fit_pack(self, data, data_val, pack_size=None, *args, **kwargs):
+        """Apply the fit method to all the experiments, several sklearn
+        experiments being trained back to back in each task
+
+        Each model still gets its own document and parameters.
+
+        Args:
+            pack_size(int, optionnal): the number of experiments in a task,
+                by default it is chosen by the `pack_sizer` from the measured
+                training time of the models
+            see `alp.core.Experiment.fit` for the other arguments
+
+        Returns:
+            a list of results"""
+        return self._fit_pack(data, data_val, False, pack_size,
+                              *args, **kwargs)
+
+    def fit_pack_async(self, data, data_val, pack_size=None,
+                       *args, **kwargs):
+        """Apply the fit_async method to all the experiments, several sklearn
+        experiments being trained back to back in each task
+
+        Without `pack_size`, the first task is waited for to measure the
+        training time of the models.
+
+        Args:
+            pack_size(int, optionnal): the number of experiments in a task
+            see :meth:`alp.appcom.core.Experiment.fit_async` for the other
+            arguments
+
+        Returns:
+            a list of results"""
+        return self._fit_pack(data, data_val, True, pack_size,
+                              *args, **kwargs)
+
+    def _fit_pack(self, data, data_val, delay, pack_size, *args, **kwargs):
+        keys = []
+        for k, expe in self.experiments.items():
+            if expe.backend_name == 'sklearn':
+                keys.append(k)
+            else:
+                f = expe.fit_async if delay else expe.fit
+                self.results[k] = f(data, data_val, *args, **kwargs)
+
+        start = 0
+        while start < len(keys):
+            size = pack_size or self.pack_sizer.size()
+            pack = keys[start:start + size]
+            start += size
+            res = self._fit_group('fit_pack', pack, data, data_val, delay,
+                                  *args, **kwargs)
+            if res is None:
+                continue
+            if pack_size is None and not delay:
+                self.pack_sizer.update(res)
+            elif pack_size is None and self.pack_sizer.fit_time is None:
+                self.pack_sizer.update(res.get())
+        return self.results
+
+    def _fit_group(self, task, keys, data, data_val, delay, *args, **kwargs):
+        """Train several experiments in a single task of their backend
+
+        Args:
+            task(str): the name of the task, `fit_path` or `fit_pack`
+            keys(list): the keys of the experiments
+            delay(bool): if True, the task is sent asynchronously
+
+        Returns:
+            the result of the task, None if all the experiments were
+            memoized"""
+        expes = [self.experiments[k] for k in keys]
+        first = expes[0]
+        group_kwargs = dict(kwargs)
+        group_data, group_data_val, data_hash, size_gen = \
+            first._prepare_message(None, data, data_val, group_kwargs)
+        memoize = group_kwargs.get('memoize')
+        group = []
+        for k, expe in zip(keys, expes):
+            mod_data_id = expe._mod_data_id(data_hash)
+            if memoize:
+                memoized = expe._check_memoized(mod_data_id, delay)
+                if memoized is not None:
+                    self.results[k] = memoized
+                    continue
+            group.append((k, expe, mod_data_id))
+        if len(group) == 0:
+            return None
+
+        f = first._task(task, delay)
+        res = f(first.backend_name,
+                first.backend_version,
+                [expe.model_dict for _, expe, _ in group],
+                group_data, data_hash, group_data_val,
+                size_gen=size_gen,
+                generator=False,
+                *args, **group_kwargs)
+        for i, (k, expe, mod_data_id) in enumerate(group):
+            if delay:
+                group_res = GroupResult(res, i, mod_data_id)
+                if memoize:
+                    track_in_flight(mod_data_id, group_res)
+                self.results[k] = expe._handle_results(group_res, True)
+            else:
+                self.results[k] = expe._handle_results(res[i], False)
+        return res
+
     def _fit_cm(self, data, data_val, gen, async, *args, **kwargs):
         with ProgressBar(max_value=len(self.experiments),
                          redirect_stdout=True,
@@ -209,7 +533,10 @@ class HParamsSearch(Ensemble):
 
     def predict(self, data, metric=None, op=None, partial=False,
                 *args, **kwargs):
-        """Apply the predict method to all the experiments
+        """Predict with the best experiment
+
+        The predictions are cached if the `prediction_cache` of the
+        experiment is set (see :meth:`alp.appcom.core.Experiment.predict`).
 
         Args:
             see :meth:`alp.appcom.core.Experiment.predict`
@@ -229,6 +556,223 @@ class HParamsSearch(Ensemble):
         best_exp, best_key = get_best(self.experiments, metric, op, partial)
         return best_key, best_exp.predict(data, *args, **kwargs)
 
+    def predict_all(self, data, keys=None, chunk_rows=4096, *args,
+                    **kwargs):
+        """Predict with all the trained experiments
+
+        The sklearn experiments are scored together in this process: their
+        parameters are loaded from their `params_dump` file and the
+        coefficients of the linear models are stacked so that the data is
+        read once for all of them (see
+        :meth:`alp.backend.sklearn_backend.score_linear_models`). The
+        experiments whose parameters file can not be read here (saved on the
+        volume of the workers only) are predicted by the workers with
+        `predict_async`, the other experiments use their `predict` method.
+
+        Args:
+            data(np.array): the data to predict
+            keys(list, optionnal): the names of the experiments to use. By
+                default, all the trained experiments are used.
+            chunk_rows(int): the number of rows scored at once
+
+        Returns:
+            a dictionnary mapping the names of the experiments to their
+            predictions"""
+        if keys is None:
+            keys = [k for k, expe in self.experiments.items()
+                    if expe.trained]
+        sklearn = [k for k in keys
+                   if self.experiments[k].backend_name == 'sklearn']
+        stacked = [k for k in sklearn
+                   if os.path.isfile(self.experiments[k].params_dump or '')]
+        remote = {k: self.experiments[k].predict_async(data, *args, **kwargs)
+                  for k in sklearn if k not in stacked}
+        preds = dict()
+        if len(stacked) > 0:
+            backend = self.experiments[stacked[0]].backend
+            models = [backend.load_compiled(
+                self.experiments[k].model_dict)['model'] for k in stacked]
+            for k, pred in zip(stacked, backend.score_linear_models(
+                    models, data, chunk_rows)):
+                preds[k] = pred
+        for k, res in remote.items():
+            preds[k] = res.wait()
+        for k in keys:
+            if k not in preds:
+                preds[k] = self.experiments[k].predict(data, *args, **kwargs)
+        return preds
+
+    def evaluate(self, data, y, metrics, keys=None, chunk_rows=4096):
+        """Evaluate the trained experiments on new data
+
+        Args:
+            data(np.array): the data to predict
+            y(np.array): the targets
+            metrics(dict): a dictionnary mapping metrics names to functions
+                of the targets and the predictions
+            keys(list, optionnal): the names of the experiments to evaluate
+            chunk_rows(int): the number of rows scored at once
+
+        Returns:
+            a pandas DataFrame of the metrics indexed by experiment"""
+        preds = self.predict_all(data, keys, chunk_rows)
+        res = {k: {name: f(y, pred) for name, f in metrics.items()}
+               for k, pred in preds.items()}
+        return pd.DataFrame.from_dict(res, orient='index')
+
+    def predict_async(self, data, keys=None, *args, **kwargs):
+        """Apply the predict_async method to the trained experiments
+
+        All the predictions are sent to the workers before returning, so the
+        experiments are scored concurrently.
+
+        Args:
+            data(list, dict, np.array): the data to predict
+            keys(list, optionnal): the names of the experiments to use. By
+                default, all the trained experiments are used.
+
+        Returns:
+            a dictionnary mapping the names of the experiments to
+            `PredictionResult` objects"""
+        if keys is None:
+            keys = [k for k, expe in self.experiments.items()
+                    if expe.trained]
+        return {k: self.experiments[k].predict_async(data, *args, **kwargs)
+                for k in keys}
+
+    def predict_ensemble(self, data, k=3, blend='average', weights=None,
+                         metric=None, op=None, partial=False, *args,
+                         **kwargs):
+        """Blend the predictions of the k best experiments
+
+        The members are scored in parallel by the workers with a single
+        fan-out of `predict_ref` tasks. Their predictions are cached by input
+        hash in the `predictions` attribute (a `PredictionCache`) so that
+        blending the same data again, with other weights, does not require
+        new predictions.
+
+        Args:
+            data(list, dict, np.array): the data to predict
+            k(int): the number of experiments blended
+            blend(str or function): 'average', 'vote', 'weighted' or a
+                function merging the predictions stacked on the first axis
+            weights(dict, optionnal): a dictionnary mapping the names of the
+                experiments to their weights for the 'weighted' blend. By
+                default, the weights are computed from the metric (see
+                `metric_weights`).
+            metric(str): the name of the metric to use
+            op(function): an operator returning the value to select an
+                experiment
+
+        Returns:
+            the names of the experiments blended and the predictions"""
+        if not metric:
+            metric = self.metric
+        if not op:
+            op = self.op
+
+        if metric is None or op is None:
+            raise Exception('You should provide a metric along with an op')
+
+        members = get_top_k(self.experiments, metric, op, k, partial)
+        keys = [key for key, _, _ in members]
+        preds = self._predict_members(members, data, *args, **kwargs)
+
+        if blend == 'average':
+            return keys, average(preds)
+        elif blend == 'vote':
+            return keys, vote(preds)
+        elif blend == 'weighted':
+            if weights is None:
+                w = metric_weights([score for _, _, score in members], op)
+            else:
+                w = np.array([weights[key] for key in keys], dtype='float64')
+                w /= w.sum()
+            return keys, np.tensordot(w, preds, axes=1)
+        return keys, blend(preds)
+
+    def _predict_members(self, members, data, *args, **kwargs):
+        """Get the predictions of the members from the cache or the workers
+
+        Returns:
+            an np.array of the predictions stacked on the first axis"""
+        input_hash = cm.create_input_hash(data)
+        preds = dict()
+        tasks = dict()
+        for key, expe, _ in members:
+            cache_key = (expe.mod_id, expe.data_id, input_hash)
+            preds[key] = self.predictions.get(cache_key, expe.params_dump)
+            if preds[key] is None:
+                tasks[key] = expe.predict_async(data, *args, **kwargs)
+        for key, task in tasks.items():
+            expe = self.experiments[key]
+            preds[key] = task.wait()
+            self.predictions.put((expe.mod_id, expe.data_id, input_hash),
+                                 preds[key], expe.params_dump)
+        return np.array([preds[key] for key, _, _ in members])
+
+    def early_stop(self, policy=median_stopping, metric='val_loss', op=np.min):
+        """Stop the experiments trained asynchronously that are clearly losing
+
+        The intermediate values of the metric are reported by the workers after
+        each epoch (or chunk) and the experiments selected by the policy are
+        stopped, which frees the workers for new configurations.
+
+        Args:
+            policy(function): a stopping rule mapping a dictionnary of
+                histories of the metric to the names of the experiments to
+                stop (see `median_stopping` and `threshold_stopping`)
+            metric(str): the name of the metric monitored
+            op(function): operation selecting the best value of the metric
+
+        Returns:
+            the list of the names of the experiments stopped"""
+        from ..dbbackend import get_partial_metrics
+        histories = dict()
+        running = dict()
+        for k, expe in self.experiments.items():
+            if expe.stopped:
+                continue
+            if hasattr(expe, 'full_res') and expe.full_res is not None:
+                histories[k] = expe.full_res['metrics'].get(metric, [])
+            elif expe.async_res is not None:
+                running[expe.async_res.id] = k
+
+        partial = get_partial_metrics(running.keys())
+        for task_id, k in running.items():
+            histories[k] = partial.get(task_id, dict()).get(metric, [])
+
+        stopped = []
+        for k in policy(histories, op=op):
+            if k in running.values():
+                self.experiments[k].stop()
+                stopped.append(k)
+        return stopped
+
+    def subscribe(self, callback, interval=1.):
+        """Follow the progress of the experiments trained asynchronously
+
+        Args:
+            callback(function): a function called with the name of the
+                experiment and its progress each time a new step is published
+                (see :meth:`alp.appcom.core.Experiment.progress`)
+            interval(float): the time between two checks of the state of the
+                tasks
+
+        Returns:
+            a dictionnary mapping the names of the experiments to the threads
+            following them"""
+        threads = dict()
+        for k, expe in self.experiments.items():
+            if expe.async_res is None or expe.stopped:
+                continue
+
+            def call_with_key(expe, progress, k=k):
+                callback(k, progress)
+
+            threads[k] = expe.subscribe(call_with_key, interval)
+        return threads
+
     def summary(self, metrics, verbose=False):
         """Build a results table using individual results from models
 
@@ -246,6 +790,8 @@ class HParamsSearch(Ensemble):
             res, t = res
             if t is not None:
                 t.join()
+            if not hasattr(expes[k], 'full_res'):  # pragma: no cover
+                continue
             for kr, v in expes[k].full_res['metrics'].items():
                 if isinstance(v, list):
                     if kr in metrics:
@@ -259,3 +805,76 @@ class HParamsSearch(Ensemble):
         if verbose is True:
             print(res_table.describe())
         return res_table
+
+
+class ShardEnsemble(Ensemble):
+    """Train the members of an ensemble on the shards of a dataset
+
+    The i-th experiment is trained on the i-th shard (see
+    :meth:`alp.appcom.datasets.shard_manifest`) and the predictions of the
+    members are merged. The shards are contiguous partitions of the data, not
+    bootstrap samples: the members are trained on disjoint examples, which
+    differs from bagging.
+
+    Args:
+        experiments(dict or list): one experiment per shard. If a dictionnary
+            is passed, it should map experiment names to experiments
+        merge(function): a function merging the predictions of the members
+            stacked on the first axis (see `average` and `vote`)
+    """
+    def __init__(self, experiments, merge=average):
+        super(ShardEnsemble, self).__init__(experiments=experiments)
+        self.merge = merge
+        self.results = dict()
+
+    def fit_gen(self, data, data_val, *args, **kwargs):
+        """Train each experiment on its shard
+
+        Args:
+            data(list): a list of data streams, one per experiment
+            data_val(list): the validation data, see
+                :meth:`alp.appcom.core.Experiment.fit_gen`
+
+        Returns:
+            a dictionnary of results"""
+        return self._fit_shards(data, data_val, False, *args, **kwargs)
+
+    def fit_gen_async(self, data, data_val, *args, **kwargs):
+        """Train asynchronously each experiment on its shard
+
+        Args:
+            data(list): a list of data streams, one per experiment
+            data_val(list): the validation data, see
+                :meth:`alp.appcom.core.Experiment.fit_gen_async`
+
+        Returns:
+            a dictionnary of results"""
+        return self._fit_shards(data, data_val, True, *args, **kwargs)
+
+    def _fit_shards(self, data, data_val, delay, *args, **kwargs):
+        if len(data) != len(self.experiments):
+            raise Exception('You must pass one shard per experiment')
+        for k, shard in zip(self.experiments, data):
+            expe = self.experiments[k]
+            if delay:
+                res = expe.fit_gen_async([shard], data_val, *args, **kwargs)
+            else:
+                res = expe.fit_gen([shard], data_val, *args, **kwargs)
+            self.results[k] = res
+        return self.results
+
+    def predict(self, data, *args, **kwargs):
+        """Merge the predictions of all the experiments
+
+        Args:
+            see :meth:`alp.appcom.core.Experiment.predict`
+
+        Returns:
+            an array of merged predictions"""
+        for k, res in self.results.items():
+            _, thread = res
+            if thread is not None:
+                thread.join()
+        preds = [expe.predict(data, *args, **kwargs)
+                 for expe in self.experiments.values()]
+        return self.merge(np.array(preds))
@@ -0,0 +1,255 @@
+"""
+Executors
+=========
+
+An executor sends the asynchronous tasks of the backends (`fit`, `fit_path`,
+`predict_ref`...). The `CeleryExecutor`, used by default, sends them to the
+Celery workers through the broker. The `ProcessExecutor` runs them in a pool
+of local processes, to use all the cores of a single machine without a
+broker.
+
+The executor of an experiment is its `executor` attribute, or the executor
+set with `set_executor` if it is None.
+"""
+
+import functools
+import importlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ..backend import common as cm
+from .utils import MemmapCache
+
+_executor = None
+
+
+def get_executor():
+    """Get the default executor (a `CeleryExecutor` if none was set)"""
+    global _executor
+    if _executor is None:
+        _executor = CeleryExecutor()
+    return _executor
+
+
+def set_executor(executor):
+    """Set the default executor
+
+    Args:
+        executor(executor): the executor, None to send the tasks to Celery
+    """
+    global _executor
+    _executor = executor
+
+
+class CeleryExecutor(object):
+    """Send the tasks to the Celery workers"""
+
+    def submit(self, backend, task, *args, **kwargs):
+        """Send a task
+
+        Args:
+            backend(module): the backend of the task
+            task(str): the name of the task
+
+        Returns:
+            the asynchronous celery result"""
+        return getattr(backend, task).delay(*args, **kwargs)
+
+
+class SharedArray(object):
+    """A np.array saved in a file, pickled as the path of the file
+
+    Args:
+        path(str): the path of the `.npy` file
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Memory-map the array"""
+        return np.load(self.path, mmap_mode='r')
+
+
+def load_shared(obj):
+    """Replace the `SharedArray` in lists, tuples and dicts by the arrays
+
+    Args:
+        obj(object): the arguments of a task
+
+    Returns:
+        the arguments with memory-mapped arrays"""
+    if isinstance(obj, SharedArray):
+        return obj.load()
+    if isinstance(obj, list):
+        return [load_shared(o) for o in obj]
+    if isinstance(obj, tuple):
+        return tuple(load_shared(o) for o in obj)
+    if isinstance(obj, dict):
+        return {k: load_shared(v) for k, v in obj.items()}
+    return obj
+
+
+def run_task(module_name, task, args, kwargs):
+    """Run a task of a backend in the current process
+
+    Args:
+        module_name(str): the name of the module of the backend
+        task(str): the name of the task
+        args(tuple): the arguments of the task
+        kwargs(dict): the keyword arguments of the task
+
+    Returns:
+        the result of the task"""
+    backend = importlib.import_module(module_name)
+    return getattr(backend, task)(*load_shared(args), **load_shared(kwargs))
+
+
+class LocalResult(object):
+    """The result of a task run by a `ProcessExecutor`, mimicking an
+    asynchronous celery result
+
+    Args:
+        future(Future): the future of the task
+    """
+    info = None
+
+    def __init__(self, future):
+        self.future = future
+        self.id = str(uuid.uuid4())
+
+    @property
+    def state(self):
+        if self.future.cancelled():
+            return 'REVOKED'
+        if self.future.running():
+            return 'STARTED'
+        if not self.future.done():
+            return 'PENDING'
+        if self.future.exception() is not None:
+            return 'FAILURE'
+        return 'SUCCESS'
+
+    def ready(self):
+        return self.future.done()
+
+    def wait(self, timeout=None, *args, **kwargs):
+        return self.future.result(timeout)
+
+    get = wait
+
+    def revoke(self, *args, **kwargs):
+        """Cancel the task if it is not running yet"""
+        self.future.cancel()
+
+
+class ProcessExecutor(object):
+    """Run the tasks in a pool of local processes
+
+    The np.arrays of the arguments larger than `min_bytes` are saved once in
+    a directory (in shared memory when `/dev/shm` exists) and memory-mapped
+    by the processes instead of being pickled with each task. The models
+    trained are stored in the database as with the Celery workers.
+
+    Args:
+        max_workers(int, optionnal): the number of processes (the number of
+            cores by default)
+        min_bytes(int): the minimum size of the shared arrays
+        max_bytes(int): the maximum size of the shared arrays, the least
+            recently used arrays of the finished tasks are deleted beyond
+
+    Attributes:
+        directory(str): the directory of the shared arrays, deleted by
+            `shutdown`
+    """
+    def __init__(self, max_workers=None, min_bytes=2 ** 16,
+                 max_bytes=2 ** 34):
+        self.pool = ProcessPoolExecutor(max_workers=max_workers)
+        self.min_bytes = min_bytes
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.directory = tempfile.mkdtemp(prefix='alp_', dir=shm)
+        self.arrays = MemmapCache(self.directory, max_bytes=max_bytes)
+        self._pending = Counter()
+        self._lock = threading.Lock()
+
+    def share(self, obj, keys):
+        """Replace the large np.arrays in lists, tuples and dicts by
+        `SharedArray`
+
+        The arrays that could not be saved (for instance if the shared
+        memory is full) are left in the arguments.
+
+        Args:
+            obj(object): the arguments of a task
+            keys(list): the list to which the keys of the shared arrays are
+                appended
+
+        Returns:
+            the arguments to pickle"""
+        if isinstance(obj, np.ndarray):
+            if obj.nbytes < self.min_bytes or obj.dtype.hasobject:
+                return obj
+            key = cm.create_input_hash(obj)
+            with self._lock:
+                self._pending[key] += 1
+                pending = list(self._pending)
+            keys.append(key)
+            if self.arrays.get(key) is None:
+                # put returns the array itself when it could not be saved
+                if self.arrays.put(key, obj, keep=pending) is obj:
+                    return obj
+            return SharedArray(self.arrays.path(key))
+        if isinstance(obj, list):
+            return [self.share(o, keys) for o in obj]
+        if isinstance(obj, tuple):
+            return tuple(self.share(o, keys) for o in obj)
+        if isinstance(obj, dict):
+            return {k: self.share(v, keys) for k, v in obj.items()}
+        return obj
+
+    def _release(self, keys, future=None):
+        """Allow the eviction of the arrays of a finished task"""
+        with self._lock:
+            for key in keys:
+                self._pending[key] -= 1
+                if self._pending[key] <= 0:
+                    del self._pending[key]
+
+    def submit(self, backend, task, *args, **kwargs):
+        """Run a task in the pool
+
+        The shared arrays of the task are not evicted before it is done.
+
+        Args:
+            backend(module): the backend of the task
+            task(str): the name of the task
+
+        Returns:
+            a `LocalResult`"""
+        keys = []
+        try:
+            future = self.pool.submit(run_task, backend.__name__, task,
+                                      self.share(args, keys),
+                                      self.share(kwargs, keys))
+        except Exception:
+            self._release(keys)
+            raise
+        future.add_done_callback(functools.partial(self._release, keys))
+        return LocalResult(future)
+
+    def shutdown(self, wait=True):
+        """Stop the processes and delete the shared arrays"""
+        self.pool.shutdown(wait=wait)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
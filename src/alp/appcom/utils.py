@@ -4,10 +4,15 @@ Utility functions for the appcom module
 """
 
 import functools
+import os
 import pickle
 import threading
+import warnings
+from collections import OrderedDict
 from itertools import islice
 
+import numpy as np
+from six.moves import queue
 from six.moves import zip as szip
 
 
@@ -93,6 +98,444 @@ def background(f):
     return bg_f
 
 
+class MemoizedResult(object):
+    """A result already available, mimicking an asynchronous celery result
+
+    Args:
+        results(dict): the results of the training
+        task_id(str, optionnal): the id of the task that trained the model
+    """
+    state = 'SUCCESS'
+
+    def __init__(self, results, task_id=None):
+        self.results = results
+        self.id = task_id
+        self.info = results
+
+    def ready(self):
+        return True
+
+    def wait(self, *args, **kwargs):
+        return self.results
+
+    get = wait
+
+    def revoke(self, *args, **kwargs):
+        pass
+
+
+class GroupResult(object):
+    """The result of one of the models trained together in a single task
+
+    Mimics the asynchronous celery result of a `fit` task, the models of the
+    group sharing the result of the `fit_path` or `fit_pack` task. The
+    progress of the task is only reported while it trains this model.
+
+    Args:
+        async_res(AsyncResult): the result of the task
+        index(int): the index of the model in the group
+        mod_data_id(str, optionnal): the concatenation of the model and data
+            hashes of the model
+    """
+    def __init__(self, async_res, index, mod_data_id=None):
+        self.async_res = async_res
+        self.index = index
+        self.mod_data_id = mod_data_id
+        self.id = async_res.id
+
+    def _progress(self):
+        state, info = self.async_res.state, self.async_res.info
+        if state == 'PROGRESS' and self.mod_data_id is not None:
+            if (info or dict()).get('mod_data_id') != self.mod_data_id:
+                return 'STARTED', None
+        return state, info
+
+    @property
+    def state(self):
+        return self._progress()[0]
+
+    @property
+    def info(self):
+        return self._progress()[1]
+
+    def ready(self):
+        return self.async_res.ready()
+
+    def wait(self, *args, **kwargs):
+        return self.async_res.wait(*args, **kwargs)[self.index]
+
+    get = wait
+
+    def revoke(self, *args, **kwargs):
+        """Do not revoke the task, shared with the other models of the
+        group: the model is only flagged as stopped by
+        :meth:`alp.appcom.core.Experiment.stop`"""
+        pass
+
+
+class PackSizer(object):
+    """Choose the number of models trained in a single task from the measured
+    training time of the models
+
+    Args:
+        target_time(float): the training time of a task to aim at, in seconds
+        max_size(int): the maximum number of models in a task
+        first_size(int): the number of models in a task before any time is
+            measured
+        smoothing(float): the weight of the previous estimate in the moving
+            average of the training time
+
+    Attributes:
+        fit_time(float): the estimated training time of a model (None before
+            any measure)
+    """
+    def __init__(self, target_time=1., max_size=64, first_size=4,
+                 smoothing=0.5):
+        self.target_time = target_time
+        self.max_size = max_size
+        self.first_size = first_size
+        self.smoothing = smoothing
+        self.fit_time = None
+
+    def update(self, results):
+        """Update the estimated training time of a model
+
+        Args:
+            results(list): the results of the models of a task, with their
+                `fit_time`"""
+        times = [r['fit_time'] for r in results if 'fit_time' in r]
+        if len(times) == 0:
+            return
+        fit_time = float(np.mean(times))
+        if self.fit_time is not None:
+            fit_time = (self.smoothing * self.fit_time +
+                        (1 - self.smoothing) * fit_time)
+        self.fit_time = fit_time
+
+    def size(self):
+        """The number of models to train in the next task"""
+        if self.fit_time is None:
+            return self.first_size
+        size = int(self.target_time / max(self.fit_time, 1e-6))
+        return min(max(size, 1), self.max_size)
+
+
+class PredictionResult(object):
+    """The future of a prediction made by a worker
+
+    Wraps the asynchronous celery result of a prediction task and converts
+    the predictions (serialized in json by the workers) to a np.array.
+
+    Args:
+        async_res(AsyncResult): the result of the prediction task
+    """
+    def __init__(self, async_res):
+        self.async_res = async_res
+        self.id = async_res.id
+
+    @property
+    def state(self):
+        return self.async_res.state
+
+    def ready(self):
+        return self.async_res.ready()
+
+    def wait(self, *args, **kwargs):
+        """Wait for the predictions
+
+        Returns:
+            an np.array of predictions"""
+        return np.asarray(self.async_res.get(*args, **kwargs))
+
+    get = wait
+
+    def revoke(self, *args, **kwargs):
+        self.async_res.revoke(*args, **kwargs)
+
+
+class ArrayCache(object):
+    """A cache of np.arrays in memory
+
+    The least recently used arrays are evicted when the total size exceeds
+    `max_bytes`.
+
+    Args:
+        max_bytes(int): the maximum size of the arrays in memory
+
+    Attributes:
+        hits(int): the number of arrays found in the cache
+        misses(int): the number of arrays not found in the cache
+    """
+    def __init__(self, max_bytes=2 ** 28):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get an array
+
+        Args:
+            key(hashable): the key of the array
+
+        Returns:
+            the np.array or None"""
+        value = self._lookup(key)
+        self._count(value is not None)
+        return value
+
+    def put(self, key, value):
+        """Store an array
+
+        Args:
+            key(hashable): the key of the array
+            value(np.array): the array"""
+        self._store(key, np.asarray(value))
+
+    def _lookup(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _store(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key).nbytes
+            if value.nbytes > self.max_bytes:
+                return
+            self._items[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Get the statistics of the cache
+
+        Returns:
+            a dictionnary with the number of hits and misses, the hit rate,
+            the number of arrays and their size in memory"""
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.,
+                'nb_items': len(self._items),
+                'nbytes': self.nbytes}
+
+
+class PredictionCache(ArrayCache):
+    """A cache of predictions keyed by model ids and input hash
+
+    The predictions are kept in memory, the least recently used being
+    evicted when the total size exceeds `max_bytes`. If `on_disk` is True, the
+    predictions are also saved as `.npy` files in a `predictions` directory
+    next to the parameters of the model (see `MemmapCache`) and loaded back on
+    a miss in memory. The predictions returned are read-only.
+
+    Args:
+        max_bytes(int): the maximum size of the predictions in memory
+        on_disk(bool): if True, the predictions are also saved on disk
+        max_disk_bytes(int): the maximum size of the predictions saved in
+            each directory
+    """
+    def __init__(self, max_bytes=2 ** 28, on_disk=False,
+                 max_disk_bytes=2 ** 30):
+        super(PredictionCache, self).__init__(max_bytes)
+        self.on_disk = on_disk
+        self.max_disk_bytes = max_disk_bytes
+        self._disk = dict()
+
+    def disk_cache(self, key, params_dump):
+        """The `MemmapCache` of the predictions of a model and the key of a
+        prediction in it"""
+        directory, name = os.path.split(os.path.splitext(params_dump)[0])
+        directory = os.path.join(directory, 'predictions')
+        with self._lock:
+            if directory not in self._disk:
+                self._disk[directory] = MemmapCache(directory,
+                                                    self.max_disk_bytes)
+            return self._disk[directory], '{}_{}'.format(name, key[-1])
+
+    def get(self, key, params_dump=None):
+        """Get a prediction
+
+        Args:
+            key(tuple): the model id, the data id and the input hash
+            params_dump(str, optionnal): the path of the parameters of the
+                model, used to find the predictions on disk
+
+        Returns:
+            a read-only np.array of predictions or None"""
+        value = self._lookup(key)
+        if value is None and self.on_disk and params_dump is not None:
+            cache, disk_key = self.disk_cache(key, params_dump)
+            value = cache.get(disk_key)
+            if value is not None:
+                value = self._store_copy(key, value)
+        self._count(value is not None)
+        return value
+
+    def put(self, key, value, params_dump=None):
+        """Store a prediction
+
+        Args:
+            key(tuple): the model id, the data id and the input hash
+            value(np.array): the predictions
+            params_dump(str, optionnal): the path of the parameters of the
+                model, used to save the predictions on disk"""
+        value = self._store_copy(key, value)
+        if self.on_disk and params_dump is not None:
+            cache, disk_key = self.disk_cache(key, params_dump)
+            cache.put(disk_key, value)
+
+    def _store_copy(self, key, value):
+        # the cached predictions are not shared with the caller
+        value = np.array(value)
+        value.setflags(write=False)
+        self._store(key, value)
+        return value
+
+
+class MemmapCache(object):
+    """A cache of np.arrays saved in a directory and memory-mapped when read
+
+    The files are written atomically, so that the cache can be shared by
+    several processes on the same volume. The least recently used files are
+    deleted when their total size exceeds `max_bytes`.
+
+    Args:
+        directory(str): the directory of the files
+        max_bytes(int): the maximum size of the files
+
+    Attributes:
+        hits(int): the number of arrays found in the cache
+        misses(int): the number of arrays not found in the cache
+    """
+    def __init__(self, directory, max_bytes=2 ** 32):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """Get an array
+
+        Args:
+            key(str): the key of the array
+
+        Returns:
+            the memory-mapped array or None"""
+        path = self.path(key)
+        try:
+            value = np.load(path, mmap_mode='r')
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value, keep=()):
+        """Store an array
+
+        Args:
+            key(str): the key of the array
+            value(np.array): the array
+            keep(list, optionnal): the keys of arrays not to delete to make
+                room for this one
+
+        Returns:
+            the memory-mapped array, or `value` if it could not be saved or
+            is larger than `max_bytes`"""
+        if np.asarray(value).nbytes > self.max_bytes:
+            return value
+        path = self.path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, value)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            warnings.warn('Could not save the array in ' + self.directory)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return value
+        self.evict(keep=[key] + list(keep))
+        return np.load(path, mmap_mode='r')
+
+    def evict(self, keep=()):
+        """Delete the least recently used files until the size of the cache
+        is below `max_bytes`
+
+        Args:
+            keep(list, optionnal): the keys of the arrays not to delete"""
+        keep = set(self.path(k) for k in keep)
+        files = []
+        kept = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:  # pragma: no cover
+                continue
+            if path in keep:
+                kept += stat.st_size
+            else:
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = kept + sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # pragma: no cover
+                pass
+            total -= size
+
+    def stats(self):
+        """Get the statistics of the cache
+
+        Returns:
+            a dictionnary with the number of hits and misses and the hit
+            rate"""
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.}
+
+
 def imports(packages=None):
     """A decorator to import packages only once when a function is serialized
 
@@ -141,19 +584,33 @@ def window(seq, n=2):
 
 
 def to_fuel_h5(inputs, outputs, slices, names,
-               file_name, file_path=''):
+               file_name, file_path='', chunk_rows=None, compression=None,
+               compression_opts=None, nb_threads=1):
     """Transforms list of numpy arrays to a structured hdf5 file
 
+    The inputs and outputs can also be iterators yielding blocks of rows so
+    that the data never has to fit in memory: the datasets are then extended
+    block by block and the end of the last slice is known once all the blocks
+    are written.
 
     Args:
-        inputs(list): a list of inputs(numpy.arrays)
-        outputs(list): a list of outputs(numpy.arrays)
+        inputs(list): a list of inputs(numpy.arrays or iterators of
+            numpy.arrays)
+        outputs(list): a list of outputs(numpy.arrays or iterators of
+            numpy.arrays)
         slices(list): a list of int representing the end of a slice and the
             begining of another slice. The last slice is automatically added
             if missing (maximum length of the inputs).
         names(list): a list of names for the datasets
         file_name(str): the name of the file to save.
         file_path(str): the path where the file is located
+        chunk_rows(int, optionnal): the number of rows in a chunk of the
+            datasets. If None, the arrays are stored contiguously (unless
+            compressed) and h5py guesses the chunks of the iterators.
+        compression(str, optionnal): the compression filter of h5py
+            ('gzip', 'lzf')
+        compression_opts(optionnal): the options of the compression filter
+        nb_threads(int): the number of datasets written at the same time
 
     Returns:
         The file full path
@@ -170,33 +627,126 @@ def to_fuel_h5(inputs, outputs, slices, names,
     full_path = os.path.join(file_path, file_name.lower() + '.' + suffix)
     f = h5py.File(full_path, mode='w')
 
-    dict_data_set = dict()
     split_dict = dict()
     for name in names:
         split_dict[name] = dict()
 
-    slices.append(max_v_len(inputs))
-
-    def insert_info_h5(iterable, suf):
-        names_out = []
-        for k, v in norm_iterator(iterable):
-            dict_data_set[suf + k] = f.create_dataset(suf + k, v.shape,
-                                                      v.dtype)
-            dict_data_set[suf + k][...] = v
-            for sl, name in zip(window(slices, 2), names):
-                split_dict[name][suf + k] = sl
-            names_out.append(suf + str(k))
-        return names_out
-
-    inputs_names = insert_info_h5(inputs, inp)
-    outputs_names = insert_info_h5(outputs, out)
-
-    f.attrs['split'] = H5PYDataset.create_split_array(split_dict)
-    f.flush()
-    f.close()
+    inputs_names = [inp + k for k, _ in norm_iterator(inputs)]
+    outputs_names = [out + k for k, _ in norm_iterator(outputs)]
+    sources = szip(inputs_names + outputs_names, inputs + outputs)
+
+    lengths = dict()
+
+    def make_job(name, source):
+        def job():
+            lengths[name] = write_h5_dataset(
+                f, name, source, chunk_rows=chunk_rows,
+                compression=compression, compression_opts=compression_opts)
+        return job
+
+    try:
+        run_threads([make_job(n, s) for n, s in sources], nb_threads)
+
+        bounds = list(slices) + [max([0] + [lengths[n]
+                                            for n in inputs_names])]
+        for data_set in inputs_names + outputs_names:
+            for sl, name in zip(window(bounds, 2), names):
+                split_dict[name][data_set] = sl
+
+        f.attrs['split'] = H5PYDataset.create_split_array(split_dict)
+        f.flush()
+    finally:
+        f.close()
     return full_path, inputs_names, outputs_names
 
 
+def write_h5_dataset(h5_file, name, source, chunk_rows=None,
+                     compression=None, compression_opts=None):
+    """Write an array or an iterator of blocks of rows in a hdf5 dataset
+
+    Args:
+        h5_file(h5py.File): the file opened in write mode
+        name(str): the name of the dataset
+        source(numpy.array or iterator): the data or the blocks of data
+        chunk_rows(int, optionnal): the number of rows in a chunk
+        compression(str, optionnal): the compression filter of h5py
+        compression_opts(optionnal): the options of the compression filter
+
+    Returns:
+        the number of rows written"""
+    opts = {'compression': compression,
+            'compression_opts': compression_opts}
+    if isinstance(source, np.ndarray):
+        chunks = None
+        if chunk_rows and len(source) > 0:
+            chunks = (min(chunk_rows, len(source)),) + source.shape[1:]
+        elif compression:
+            chunks = True
+        # a single write, h5py splits it in chunks
+        h5_file.create_dataset(name, data=source, chunks=chunks, **opts)
+        return len(source)
+
+    dset = None
+    nb_rows = 0
+    for block in source:
+        block = np.asarray(block)
+        if dset is None:
+            chunks = True
+            if chunk_rows:
+                chunks = (chunk_rows,) + block.shape[1:]
+            dset = h5_file.create_dataset(name, (0,) + block.shape[1:],
+                                          block.dtype,
+                                          maxshape=(None,) + block.shape[1:],
+                                          chunks=chunks, **opts)
+        dset.resize(nb_rows + len(block), axis=0)
+        dset[nb_rows:nb_rows + len(block)] = block
+        nb_rows += len(block)
+    if dset is None:
+        raise ValueError('No data to write in {}'.format(name))
+    return nb_rows
+
+
+def run_threads(jobs, nb_threads=1):
+    """Run callables in a pool of threads
+
+    Args:
+        jobs(list): a list of callables without arguments
+        nb_threads(int): the number of threads
+
+    Raises:
+        the first exception raised by a job"""
+    jobs = list(jobs)
+    if nb_threads <= 1:
+        for job in jobs:
+            job()
+        return
+
+    pending = queue.Queue()
+    for job in jobs:
+        pending.put(job)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                job = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                job()
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(nb_threads, len(jobs)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
 def max_v_len(iterable_to_check):
     """Returns the max length of a list of iterable"""
     max_v = 0
@@ -216,19 +766,29 @@ def pickle_gen(gen_train, data_val):
 
     Returns:
         normalized datasets"""
-    gen_train = [pickle.dumps(g).decode('raw_unicode_escape')
-                 for g in gen_train]
+    gen_train = [serialize_gen(g) for g in gen_train]
 
     val_gen = check_gen(data_val)
 
     if val_gen:
-        data_val = [pickle.dumps(g).decode('raw_unicode_escape')
-                    for g in data_val]
+        data_val = [serialize_gen(g) for g in data_val]
     return gen_train, data_val
 
 
+def serialize_gen(gen):
+    """Serialize a generator to be sent to a worker
+
+    Args:
+        gen(generator): a data generator
+
+    Returns:
+        the pickled generator as a string"""
+    return pickle.dumps(gen).decode('raw_unicode_escape')
+
+
 def check_gen(iterable):
-    """Check if the last object of the iterable is an iterator
+    """Check if the last object of the iterable is an iterator or a data
+    stream (Fuel or `ArrayStream`)
 
     Args:
         iterable(list): a list containing data.
@@ -239,6 +799,7 @@ def check_gen(iterable):
     is_gen = (hasattr(iterable[-1], 'next') or
               hasattr(iterable[-1], '__next__'))
     is_gen += 'fuel' in repr(iterable[-1])
+    is_gen += hasattr(iterable[-1], 'get_epoch_iterator')
 
     return is_gen
 
@@ -255,7 +816,8 @@ def get_nb_chunks(generator):
         if generator.iteration_scheme is not None:
             batch_size = generator.iteration_scheme.batch_size
             nb_examples = len(generator.iteration_scheme.indices)
-            return nb_examples // batch_size
+            # the last chunk can be smaller than the batch size
+            return (nb_examples + batch_size - 1) // batch_size
         else:
             if hasattr(generator, 'data_stream'):
                 return get_nb_chunks(generator.data_stream)
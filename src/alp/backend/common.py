@@ -3,47 +3,92 @@ Functions used in every backend
 ===============================
 """
 
-import copy
 import hashlib
 import json
 import os
-import pickle
+import threading
+import time
+import types
+import warnings
 from datetime import datetime
 
 import numpy as np
+import six
+from six.moves import queue
+from six.moves import zip as szip
+
+# the time (in seconds) after which a model still being trained is
+# considered lost, e.g. when its worker was killed
+PENDING_TIMEOUT = 24 * 3600
 
 
 def clean_model(model):
     """Clean a dict of a model of uncessary elements
 
+    The model is not modified and is not copied: the new dict shares the
+    unchanged values with it.
+
     Args:
         model(dict): a dictionnary of the model
 
     Returns:
         a new cleaned dict"""
-    model_c = copy.deepcopy(model)
-    if 'ser_metrics' in model_c['model_arch']:
-        model_c['model_arch'].pop('ser_metrics')
-    if 'metrics' in model_c['model_arch']:
-        model_c['model_arch'].pop('metrics')
+    model_c = dict(model)
+    model_c['model_arch'] = clean_arch(model['model_arch'])
     return model_c
 
 
-def create_model_hash(model, batch_size):
-    """Creates a hash based on the dict of a model and the batch size
+def clean_arch(model_arch):
+    """Remove the metrics from the architecture of a model
 
     Args:
-        model(dict): a dictionnary of the model
+        model_arch(dict): the architecture of the model
+
+    Returns:
+        a new dict sharing its values with `model_arch`"""
+    return {k: v for k, v in model_arch.items()
+            if k not in ('ser_metrics', 'metrics')}
+
+
+def serialize_arch(model_arch):
+    """Serialize the architecture of a model in a canonical way
+
+    The keys are sorted so that two equal architectures always give the same
+    string.
+
+    Args:
+        model_arch(dict): the architecture of the model
+
+    Returns:
+        a json string"""
+    return json.dumps(model_arch, sort_keys=True, separators=(',', ':'))
+
+
+def create_arch_hash(model_arch):
+    """Creates a hash based on the architecture of a model
+
+    Args:
+        model_arch(dict): the architecture of the model
+
+    Returns:
+        a md5 hash of the canonical serialization of the architecture"""
+    mh = hashlib.md5()
+    mh.update(serialize_arch(model_arch).encode('utf-8'))
+    return mh.hexdigest()
+
+
+def create_model_hash(arch_hash, batch_size):
+    """Creates a hash based on the hash of the architecture of a model and
+    the batch size
+
+    Args:
+        arch_hash(str): the hash of the architecture, see `create_arch_hash`
         batch_size(int): the batch size
 
     Returns:
         a md5 hash of the model"""
-    # convert dict to json string
-    model_str = json.dumps(model)
-
-    # create the model hash from the stringified json
     mh = hashlib.md5()
-    str_concat_m = str(model_str) + str(batch_size)
+    str_concat_m = str(arch_hash) + str(batch_size)
     mh.update(str_concat_m.encode('utf-8'))
     return mh.hexdigest()
 
@@ -72,21 +117,103 @@ def create_data_hash(data):
     return dh.hexdigest()
 
 
+def describe_gen(obj, _depth=0):
+    """Describe a generator (typically a Fuel pipeline) without reading data
+
+    The transformers, the data stream, the iteration scheme and the dataset
+    are described by their class and public attributes. A dataset stored in a
+    file is identified by the path, the modification time and the size of the
+    file rather than by its content; the arrays held in memory by other
+    objects are hashed from their buffer and the random generators from
+    their state. The objects whose state can not be read (such as python
+    generators) are described by their id, with a warning: their hash is
+    then unique to the object.
+
+    Args:
+        obj(object): the generator or one of its attributes
+
+    Returns:
+        a json serializable description of the object"""
+    if obj is None or isinstance(obj, (bool, float) + six.integer_types):
+        return obj
+    if isinstance(obj, six.string_types):
+        return obj
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        desc = {'shape': list(obj.shape), 'dtype': str(obj.dtype)}
+        if obj.dtype.hasobject:
+            desc['data'] = describe_gen(obj.tolist(), _depth + 1)
+        else:
+            desc['md5'] = hashlib.md5(
+                np.ascontiguousarray(obj).view(np.uint8)).hexdigest()
+        return desc
+    if isinstance(obj, slice):
+        return [obj.start, obj.stop, obj.step]
+    if isinstance(obj, (types.FunctionType, types.BuiltinFunctionType,
+                        types.MethodType)):
+        return getattr(obj, '__module__', None), obj.__name__
+    if _depth > 20:
+        return type(obj).__name__
+    if isinstance(obj, (list, tuple)):
+        return [describe_gen(o, _depth + 1) for o in obj]
+    if isinstance(obj, dict):
+        return {str(k): describe_gen(v, _depth + 1) for k, v in obj.items()}
+
+    desc = {'class': type(obj).__module__ + '.' + type(obj).__name__}
+    if isinstance(obj, np.random.RandomState):
+        desc['state'] = describe_gen(obj.get_state(), _depth + 1)
+        return desc
+    if hasattr(obj, 'bit_generator'):
+        # np.random.Generator
+        desc['state'] = describe_gen(obj.bit_generator.state, _depth + 1)
+        return desc
+    path = getattr(obj, 'path', None)
+    if isinstance(path, six.string_types) and os.path.isfile(path):
+        stat = os.stat(path)
+        desc['file'] = [os.path.abspath(path), stat.st_mtime, stat.st_size]
+        attrs = {k: v for k, v in vars(obj).items()
+                 if not isinstance(v, np.ndarray)}
+    elif hasattr(obj, '__dict__'):
+        attrs = vars(obj)
+    else:
+        warnings.warn('The state of {} can not be described, its hash will '
+                      'not match another object'.format(desc['class']))
+        desc['id'] = id(obj)
+        return desc
+
+    for k, v in attrs.items():
+        if k.startswith('_'):
+            continue
+        desc[k] = describe_gen(v, _depth + 1)
+    return desc
+
+
 def create_gen_hash(gen):
-    """Creates a hash based on the data passed
+    """Creates a hash based on the description of the generators passed
 
-    The unique descriptors are based on the mean of the arrays passed and the
-    sum of all the elements of the first lines of the first axis.
+    See `describe_gen`: the data of the datasets stored in files is not read.
 
     Args:
-        data(list): a dictionnary of the model
+        gen(list): a list of generators
+
+    Returns:
+        a md5 hash of the data"""
+    dh = hashlib.md5()
+    dh.update(serialize_arch(describe_gen(gen)).encode('utf-8'))
+    return dh.hexdigest()
+
+
+def create_input_hash(data):
+    """Creates a hash based on the content of the data to predict
+
+    Args:
+        data(list, dict, np.array): the inputs of a model
 
     Returns:
         a md5 hash of the data"""
-    pickle_gen = pickle.dumps(gen)
     dh = hashlib.md5()
-    str_concat_g = str(pickle_gen)
-    dh.update(str_concat_g.encode('utf-8'))
+    dh.update(serialize_arch(describe_gen(data)).encode('utf-8'))
     return dh.hexdigest()
 
 
@@ -105,8 +232,16 @@ def create_param_dump(_path_h5, hexdi_m, hexdi_d):
 
 def make_all_hash(model_c, batch_size, data_hash, _path_h5):
     """Generate a hash for the model and the name of the file where
-    the parameters are dumped"""
-    hexdi_m = create_model_hash(model_c, batch_size)
+    the parameters are dumped
+
+    Only the architecture is hashed so that the id of a model does not depend
+    on the ids of a previous training of the same experiment. The hash of the
+    architecture is taken from the `arch_hash` key of the model when it was
+    already computed."""
+    arch_hash = model_c.get('arch_hash')
+    if arch_hash is None:
+        arch_hash = create_arch_hash(model_c['model_arch'])
+    hexdi_m = create_model_hash(arch_hash, batch_size)
     params_dump = create_param_dump(_path_h5, hexdi_m, data_hash)
     return hexdi_m, params_dump
 
@@ -137,33 +272,465 @@ def transform_gen(gen_train, mod_name):
     Yield:
         a dictionnary mapping training and testing data to numpy arrays if
         the model is a graph, a tupple (inputs, ouputs) instead."""
-    names_dict = gen_train.sources
-
     inp = 'input_'
     out = 'output_'
 
     li = 'list'
 
+    # route the sources once, the batches are then assembled by indexing
+    inputs_idx = []
+    outputs_idx = []
+    for i, name in enumerate(gen_train.sources):
+        if inp in name:
+            if li in name:
+                inputs_idx.append(i)
+        elif out in name:
+            if li in name:
+                outputs_idx.append(i)
+        elif 'index' in name:  # pragma: no cover
+            pass
+        else:  # pragma: no cover
+            raise Exception("Not input nor output, please check your "
+                            "generator")
+
     open_dataset_gen(gen_train)
 
     while 1:
         for d in gen_train.get_epoch_iterator():
-            data = zip(d, names_dict)
-            inputs_list = []
-            outputs_list = []
-            for arr, name in data:
-                if inp in name:
-                    if li in name:
-                        inputs_list.append(arr)
-                elif out in name:
-                    if li in name:
-                        outputs_list.append(arr)
-                elif 'index' in name:  # pragma: no cover
-                    pass
-                else:  # pragma: no cover
-                    raise("Not input nor output, please check your generator")
-            data_out = (inputs_list, outputs_list)
-            yield data_out
+            yield ([d[i] for i in inputs_idx], [d[i] for i in outputs_idx])
+
+
+def iter_stream_inputs(stream):
+    """Iterate over the inputs of the batches of a data stream
+
+    Args:
+        stream(Fuel data stream or ArrayStream): the stream to read
+
+    Yield:
+        the list of the input arrays of each batch"""
+    inputs_idx = [i for i, name in enumerate(stream.sources)
+                  if 'input_' in name and 'list' in name]
+    open_dataset_gen(stream)
+    for d in stream.get_epoch_iterator():
+        yield [d[i] for i in inputs_idx]
+
+
+class Prefetcher(object):
+    """Iterate over an iterator filled in a background thread
+
+    The items are produced in advance by a thread and stored in a bounded
+    queue so that the reading (and transformation) of the next batches
+    overlaps with the training on the current one.
+
+    Args:
+        iterator(iterator): the iterator to prefetch, e.g. the epoch iterator
+            of a Fuel stream or the generator returned by `transform_gen`
+        depth(int): the maximum number of items prefetched
+
+    Attributes:
+        nb_items(int): the number of items consumed
+        load_time(float): the time spent by the thread producing the items
+        wait_time(float): the time spent waiting for the thread
+    """
+    _end = object()
+
+    def __init__(self, iterator, depth=2):
+        self.iterator = iter(iterator)
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.nb_items = 0
+        self.load_time = 0.
+        self.wait_time = 0.
+        self._start = time.time()
+        self._stop = None
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self):
+        while not self._closed.is_set():
+            start = time.time()
+            try:
+                item = (True, next(self.iterator))
+            except StopIteration:
+                item = (True, self._end)
+            except Exception as e:
+                item = (False, e)
+            self.load_time += time.time() - start
+            while not self._closed.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if item[1] is self._end or not item[0]:
+                return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        while True:
+            try:
+                ok, item = self.queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                # nothing more is produced once closed
+                if self._closed.is_set():
+                    ok, item = True, self._end
+                    break
+        self.wait_time += time.time() - start
+        if not ok:
+            self.close()
+            raise item
+        if item is self._end:
+            # keep the end of the iterator for the next calls
+            self.queue.put((True, self._end))
+            self.close()
+            raise StopIteration
+        self.nb_items += 1
+        return item
+
+    next = __next__
+
+    def close(self):
+        """Stop the background thread"""
+        if self._stop is None:
+            self._stop = time.time()
+        self._closed.set()
+
+    def stats(self):
+        """Get the throughput statistics of the prefetcher
+
+        Returns:
+            a dictionnary with the number of items consumed, the elapsed
+            time, the number of items per second, the loading time and the
+            waiting time"""
+        stop = self._stop if self._stop is not None else time.time()
+        return make_prefetch_stats(self.nb_items, stop - self._start,
+                                   self.load_time, self.wait_time)
+
+
+class PrefetchedStream(object):
+    """Wrap a Fuel stream so that its epoch iterators are prefetched
+
+    The wrapper exposes the `sources`, the `data_stream` and the
+    `get_epoch_iterator` method of a Fuel stream.
+
+    Args:
+        data_stream(Fuel data stream): the wrapped stream
+        depth(int): the maximum number of batches prefetched
+    """
+    def __init__(self, data_stream, depth=2):
+        self.data_stream = data_stream
+        self.depth = depth
+        self.sources = data_stream.sources
+        self.iterators = []
+
+    def get_epoch_iterator(self, **kwargs):
+        for it in self.iterators:
+            it.close()
+        it = Prefetcher(self.data_stream.get_epoch_iterator(**kwargs),
+                        self.depth)
+        self.iterators.append(it)
+        return it
+
+    def close(self):
+        """Stop the prefetching of the epoch iterators"""
+        for it in self.iterators:
+            it.close()
+
+    def stats(self):
+        """Get the throughput statistics summed over the epochs
+
+        Returns:
+            a dictionnary, see `Prefetcher.stats`"""
+        return sum_prefetch_stats([it.stats() for it in self.iterators])
+
+
+def close_prefetchers(objs):
+    """Stop the prefetching threads of the `Prefetcher` and
+    `PrefetchedStream` objects of a list
+
+    Args:
+        objs(list): a list of data objects, the other objects are ignored
+
+    Returns:
+        the list of the prefetchers closed"""
+    prefetchers = [o for o in objs
+                   if isinstance(o, (Prefetcher, PrefetchedStream))]
+    for prefetcher in prefetchers:
+        prefetcher.close()
+    return prefetchers
+
+
+def make_prefetch_stats(nb_items, elapsed, load_time, wait_time):
+    """Build the throughput statistics of a prefetcher"""
+    return {'nb_items': nb_items,
+            'elapsed': elapsed,
+            'items_per_sec': nb_items / elapsed if elapsed > 0 else 0.,
+            'load_time': load_time,
+            'wait_time': wait_time}
+
+
+def sum_prefetch_stats(stats):
+    """Sum the statistics of prefetchers used one after the other
+
+    Args:
+        stats(list): a list of dictionnaries returned by `Prefetcher.stats`
+
+    Returns:
+        a dictionnary with the same keys"""
+    keys = ['nb_items', 'elapsed', 'load_time', 'wait_time']
+    total = {k: sum(st[k] for st in stats) for k in keys}
+    return make_prefetch_stats(**total)
+
+
+class MicroBatcher(object):
+    """Coalesce concurrent predictions of a model in a single forward pass
+
+    The requests received by the threads of a worker within `max_latency`
+    seconds of the first pending one are concatenated (up to
+    `max_batch_size` rows), predicted at once and the predictions are
+    scattered back to the requests.
+
+    Args:
+        predict_f(function): a function mapping data (an array, a list of
+            arrays or a dictionnary of arrays) to an array of predictions
+        max_batch_size(int): the maximum number of rows predicted at once
+        max_latency(float): the maximum time (in seconds) a request waits for
+            other requests
+
+    Attributes:
+        nb_requests(int): the number of requests predicted
+        nb_batches(int): the number of forward passes
+    """
+    def __init__(self, predict_f, max_batch_size=256, max_latency=0.005):
+        self.predict_f = predict_f
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.nb_requests = 0
+        self.nb_batches = 0
+        self._cond = threading.Condition()
+        self._pending = []
+        self._thread = None
+
+    def predict(self, data):
+        """Predict data with the other pending requests
+
+        Args:
+            data(list, dict, np.array): the data of the request
+
+        Returns:
+            an np.array of predictions"""
+        request = _BatchRequest(data)
+        with self._cond:
+            self._pending.append(request)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = self._pending[0].time + self.max_latency
+                while True:
+                    size = sum(r.size for r in self._pending)
+                    remaining = deadline - time.time()
+                    if size >= self.max_batch_size or remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take_batch()
+            self._process(batch)
+
+    def _take_batch(self):
+        """Pop the pending requests with the structure of the first one"""
+        first = self._pending[0]
+        batch = [first]
+        size = first.size
+        for r in self._pending[1:]:
+            if size + r.size > self.max_batch_size:
+                break
+            if r.signature == first.signature:
+                batch.append(r)
+                size += r.size
+        self._pending = [r for r in self._pending
+                         if all(r is not b for b in batch)]
+        return batch
+
+    def _process(self, batch):
+        try:
+            if len(batch) == 1:
+                results = [self.predict_f(batch[0].data)]
+            else:
+                first = batch[0]
+                inputs = [np.concatenate([r.inputs[i] for r in batch])
+                          for i in range(len(first.inputs))]
+                preds = np.asarray(self.predict_f(first.rebuild(inputs)))
+                bounds = np.cumsum([r.size for r in batch])[:-1]
+                results = np.split(preds, bounds)
+            for r, res in szip(batch, results):
+                r.result = res
+        except Exception as e:
+            for r in batch:
+                r.error = e
+        finally:
+            self.nb_requests += len(batch)
+            self.nb_batches += 1
+            for r in batch:
+                r.event.set()
+
+
+class _BatchRequest(object):
+    """A request waiting in a `MicroBatcher`"""
+    def __init__(self, data):
+        self.data = data
+        self.time = time.time()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        if isinstance(data, dict):
+            self.keys = sorted(data)
+            self.inputs = [np.asarray(data[k]) for k in self.keys]
+            self.signature = ('dict', tuple(self.keys))
+        elif isinstance(data, (list, tuple)):
+            self.keys = None
+            self.inputs = [np.asarray(d) for d in data]
+            self.signature = ('list', len(self.inputs))
+        else:
+            self.keys = None
+            self.inputs = [np.asarray(data)]
+            self.signature = ('array', )
+        self.signature += tuple((d.shape[1:], d.dtype.str)
+                                for d in self.inputs)
+        self.size = len(self.inputs[0])
+
+    def rebuild(self, inputs):
+        """Build data with the structure of the request"""
+        if self.signature[0] == 'dict':
+            return dict(szip(self.keys, inputs))
+        elif self.signature[0] == 'list':
+            return inputs
+        return inputs[0]
+
+
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(compiled, predict_f, max_batch_size=256, max_latency=0.005):
+    """Get the micro-batcher of a cached model
+
+    The batcher is stored in the cache entry of the model and its settings
+    are updated with the ones of the last request.
+
+    Args:
+        compiled(dict): the cache entry of the model
+        predict_f(function): the prediction function used by a new batcher
+        max_batch_size(int): the maximum number of rows predicted at once
+        max_latency(float): the maximum time a request waits
+
+    Returns:
+        a `MicroBatcher`"""
+    with _batchers_lock:
+        if 'batcher' not in compiled:
+            compiled['batcher'] = MicroBatcher(predict_f)
+        batcher = compiled['batcher']
+        batcher.max_batch_size = max_batch_size
+        batcher.max_latency = max_latency
+    return batcher
+
+
+class TrainingMonitor(object):
+    """Reports the intermediate metrics of a model trained on a worker
+
+    The metrics are appended to the document of the model after each epoch (or
+    chunk) and the training is stopped as soon as the model is flagged as
+    stopped in the models collection. If a task is given, the progress is also
+    published in the state of the task (`PROGRESS`), at most once every
+    `min_interval` seconds, the last progress throttled being published by
+    `flush` at the end of the training. Each publication only carries the
+    steps reported since the previous one, the full history of the metrics
+    is read from the db (see `get_history`).
+
+    Args:
+        inserted_id(int): the id of the model in the models collection
+        task(celery.Task, optionnal): the task training the model
+        min_interval(float): the minimum time between two publications of
+            the progress
+        mod_data_id(str, optionnal): the concatenation of the model and data
+            hashes, published with the progress when a task trains several
+            models
+    """
+    def __init__(self, inserted_id, task=None, min_interval=1.,
+                 mod_data_id=None):
+        self.inserted_id = inserted_id
+        self.task = task
+        self.min_interval = min_interval
+        self.mod_data_id = mod_data_id
+        self.stopped = False
+        self.step = 0
+        self._unpublished = []
+        self._last_publish = None
+        self._pending = None
+
+    def report(self, metrics):
+        """Report the last value of the metrics
+
+        Args:
+            metrics(dict): a dictionnary mapping metrics names to values
+
+        Returns:
+            True if the training should be stopped"""
+        from alp import dbbackend as db
+        metrics = {k: float(v) for k, v in metrics.items() if np.isscalar(v)}
+        self.step += 1
+        self.publish(metrics)
+        self.stopped = db.report_metrics(self.inserted_id, self.step,
+                                         metrics)
+        return self.stopped
+
+    def publish(self, metrics):
+        """Publish the progress in the state of the task (throttled)
+
+        Args:
+            metrics(dict): a dictionnary mapping metrics names to values"""
+        if self.task is None or self.task.request.id is None:
+            return
+        self._unpublished.append((self.step, metrics))
+        now = time.time()
+        if self._last_publish is not None:
+            if now - self._last_publish < self.min_interval:
+                self._pending = (self.step, metrics)
+                return
+        self._last_publish = now
+        self._pending = None
+        self._update_state(self.step, metrics)
+
+    def flush(self):
+        """Publish the last progress if it was throttled"""
+        if self._pending is not None:
+            self._last_publish = time.time()
+            step, metrics = self._pending
+            self._pending = None
+            self._update_state(step, metrics)
+
+    def _update_state(self, step, metrics):
+        meta = {'step': step,
+                'metrics': metrics,
+                'steps': self._unpublished}
+        self._unpublished = []
+        if self.mod_data_id is not None:
+            meta['mod_data_id'] = self.mod_data_id
+        self.task.update_state(state='PROGRESS', meta=meta)
 
 
 def train_pipe(train_f, save_f, model, data, data_val, generator, size_gen,
@@ -171,21 +738,36 @@ def train_pipe(train_f, save_f, model, data, data_val, generator, size_gen,
                *args, **kwargs):
     """Common function to train models for all backends
 
+    The document of the model only keeps a summary of each metric (the minimum
+    for the losses, the last value otherwise), the values epoch by epoch are
+    stored with `insert_metrics`.
+
     Args:
         train_f(function): the train function to use
         save_f(function): the function used to save parameters"""
-    results, model = train_f(model['model_arch'], data,
-                             data_val, size_gen,
-                             generator=generator,
-                             *args, **kwargs)
+    monitor = kwargs.get('monitor')
+    try:
+        results, model = train_f(model['model_arch'], data,
+                                 data_val, size_gen,
+                                 generator=generator,
+                                 *args, **kwargs)
+    finally:
+        if monitor is not None:
+            # the last step is published even if it was throttled
+            monitor.flush()
     res_dict = {
         'iter_stopped': results['metrics']['iter'],
         'trained': 1,
         'date_finished_training': datetime.now()}
-    for metric in results['metrics']:
-        res_dict[metric] = results['metrics'][metric]
+    if monitor is not None and monitor.stopped:
+        res_dict['stopped'] = 1
+    for metric, values in results['metrics'].items():
+        if not isinstance(values, list) or len(values) == 0:
+            continue
         if metric in ['loss', 'val_loss']:
-            res_dict[metric] = np.min(results['metrics'][metric])
+            res_dict[metric] = np.min(values)
+        else:
+            res_dict[metric] = values[-1]
 
     save_f(model, params_dump)
     results['model_id'] = hexdi_m
@@ -194,5 +776,195 @@ def train_pipe(train_f, save_f, model, data, data_val, generator, size_gen,
     return results, res_dict
 
 
+def get_memoized(mod_data_id, check_file=True, pending=False):
+    """Look for a model already trained on the same data
+
+    Models trained with an error or stopped before the end are ignored, as
+    well as the models whose training was lost (see `pending_alive`).
+
+    Args:
+        mod_data_id(str): the concatenation of the model and data hashes
+        check_file(bool): if True, the file where the parameters are dumped
+            must exist. The clients do not share the file system of the
+            workers and leave this check to them.
+        pending(bool): if True, the document of a model being trained by
+            another task is also returned
+
+    Returns:
+        the document of the model in the db or None"""
+    from alp import dbbackend as db
+    model_db = db.get_models().find_one({'mod_data_id': mod_data_id})
+    if model_db is None:
+        return None
+    if model_db.get('error') == 1 or model_db.get('stopped') == 1:
+        return None
+    if model_db.get('trained') != 1:
+        return model_db if pending and pending_alive(model_db) else None
+    if check_file and not os.path.exists(model_db['params_dump']):
+        return None
+    return model_db
+
+
+def pending_alive(model_db, timeout=None):
+    """Check if a model is still being trained by another task
+
+    The training is lost if it started more than `timeout` seconds ago or if
+    its task is over.
+
+    Args:
+        model_db(dict): the document of a model not trained yet
+        timeout(float, optionnal): the maximum duration of a training,
+            `PENDING_TIMEOUT` by default
+
+    Returns:
+        True if the model is being trained, False otherwise"""
+    if timeout is None:
+        timeout = PENDING_TIMEOUT
+    started = model_db.get('datetime')
+    if started is not None:
+        if (datetime.now() - started).total_seconds() > timeout:
+            return False
+    if model_db.get('task_id') is None:
+        return True
+    try:
+        from celery import states
+        from alp.celapp import app
+        state = app.AsyncResult(model_db['task_id']).state
+    except (ImportError, NotImplementedError):
+        # no celery or no result backend: the state of the task is unknown
+        return True
+    return state not in states.READY_STATES
+
+
+def claim_models(docs, overwrite=False, memoize=False):
+    """Insert the documents of models before their training
+
+    With `memoize`, the models already trained on the same data, or being
+    trained by another task, are not inserted again: their results are
+    returned instead (see `results_from_db`). The documents of the models
+    that failed, were stopped or lost their parameters are replaced.
+
+    Args:
+        docs(list): the documents of the models, with the mod_data_id key
+        overwrite(bool): if True, the documents already in the db are
+            replaced
+        memoize(bool): if True, the models already trained are not trained
+            again
+
+    Returns:
+        a list of (id, results) tuples, one per model: the id of the
+        document of a model to train and None, or None and the results of a
+        memoized model"""
+    from alp import dbbackend as db
+    models = db.get_models()
+    claimed = []
+    for doc in docs:
+        upsert = overwrite
+        if memoize and not overwrite:
+            model_db = get_memoized(doc['mod_data_id'], pending=True)
+            if model_db is not None:
+                claimed.append((None, results_from_db(model_db)))
+                continue
+            filter_db = {'mod_data_id': doc['mod_data_id']}
+            upsert = models.find_one(filter_db) is not None
+        if upsert:
+            # reset the flags of a previous training
+            doc.setdefault('error', 0)
+            doc.setdefault('stopped', 0)
+        try:
+            claimed.append((db.insert(doc, models, upsert=upsert), None))
+        except db.DuplicateKeyError:
+            # another task inserted the model since it was looked for
+            model_db = None
+            if memoize:
+                model_db = get_memoized(doc['mod_data_id'], pending=True)
+            if model_db is None:
+                raise
+            claimed.append((None, results_from_db(model_db)))
+    return claimed
+
+
+def results_from_db(model_db):
+    """Build the results of a training from the document of a trained model
+
+    If the model is still being trained by another task, the results only
+    have the ids of the model and the `pending` flag, see `wait_memoized`.
+    The documents written before the metrics collection keep the metrics
+    epoch by epoch under their `metrics` key.
+
+    Args:
+        model_db(dict): the document of the model in the db
+
+    Returns:
+        results similar to the ones returned by the fit tasks"""
+    from alp import dbbackend as db
+    results = {'model_id': model_db['mod_id'],
+               'data_id': model_db['data_id'],
+               'params_dump': model_db['params_dump'],
+               'memoized': True}
+    if model_db.get('trained') != 1:
+        results['metrics'] = dict()
+        results['pending'] = True
+        return results
+    metrics = db.get_history(model_db['_id'])
+    if len(metrics) == 0 and 'metrics' in model_db:
+        metrics = dict(model_db['metrics'])
+    metrics['iter'] = model_db.get('iter_stopped', metrics.get('iter'))
+    results['metrics'] = metrics
+    return results
+
+
+def wait_memoized(results, timeout=600, interval=1.):
+    """Wait for the end of the training of a memoized model by another task
+
+    The results that are not `pending` are returned unchanged. This is called
+    by the clients, so that the workers are not blocked by the trainings of
+    the other workers. An exception is raised if the training of the other
+    task fails or is lost: the model can then be sent again to be retrained.
+
+    Args:
+        results(dict): the results returned by a fit task
+        timeout(float): the maximum time to wait for the other task
+        interval(float): the time between two checks of the other task
+
+    Returns:
+        the results of the trained model"""
+    if not results.get('pending'):
+        return results
+    mod_data_id = results['model_id'] + results['data_id']
+    start = time.time()
+    while time.time() - start < timeout:
+        model_db = get_memoized(mod_data_id, check_file=False, pending=True)
+        if model_db is None:
+            raise Exception('The training of the memoized model {} '
+                            'failed'.format(mod_data_id))
+        if model_db.get('trained') == 1:
+            return results_from_db(model_db)
+        time.sleep(interval)
+    raise Exception('Timeout while waiting for the training of the memoized'
+                    ' model {}'.format(mod_data_id))
+
+
+def get_model_ref(mod_id, data_id):
+    """Get the model dict of a trained model from the models collection
+
+    Args:
+        mod_id(str): the id of the model
+        data_id(str): the id of the data the model was trained on
+
+    Returns:
+        a dictionnary with the ids, the architecture and the path of the
+        parameters of the model"""
+    from alp import dbbackend as db
+    model_db = db.get_models().find_one({'mod_id': mod_id,
+                                         'data_id': data_id})
+    if model_db is None:
+        raise Exception('Unknown model: {} | {}'.format(mod_id, data_id))
+    return {'mod_id': mod_id,
+            'data_id': data_id,
+            'model_arch': model_db['model_arch'],
+            'params_dump': model_db['params_dump']}
+
+
 def on_worker():
     return os.getenv("ON_WORKER") == "TRUE"
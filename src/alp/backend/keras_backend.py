@@ -12,7 +12,11 @@ in memory compiled function, this function is used instead.
 ----------------------------------------------------------------------------
 """
 
+import contextlib
+import copy
 import inspect
+import os
+import threading
 import types
 
 import dill
@@ -33,6 +37,7 @@ except ImportError:  # pragma: no cover
 
 
 COMPILED_MODELS = dict()
+_compiled_lock = threading.Lock()
 TO_SERIALIZE = ['custom_objects']
 
 
@@ -171,7 +176,7 @@ def model_from_dict_w_opt(model_dict, custom_objects=None):
 
     Returns:
         A Keras.Model which is compiled if the information about the optimizer
-        is available.
+        is available. The model_dict is not modified.
 
     """
     from keras import optimizers
@@ -187,11 +192,13 @@ def model_from_dict_w_opt(model_dict, custom_objects=None):
         if inspect.isfunction(custom_objects[k]):
             custom_objects[k] = custom_objects[k]()
 
-    model = layer_from_config(model_dict['config'],
+    # layer_from_config pops keys out of the configs of some layers (Lambda,
+    # Merge), the copy is only made when a model is built
+    model = layer_from_config(copy.deepcopy(model_dict['config']),
                               custom_objects=custom_objects)
 
     if 'optimizer' in model_dict:
-        metrics = model_dict.get("metrics", [])
+        metrics = list(model_dict.get("metrics", []))
         ser_metrics = model_dict.get("ser_metrics", [])
         for k in custom_objects:
             if inspect.isfunction(custom_objects[k]):
@@ -200,7 +207,7 @@ def model_from_dict_w_opt(model_dict, custom_objects=None):
                     metrics.append(custom_objects[k])
         model_name = model_dict['config'].get('class_name')
         # if it has an optimizer, the model is assumed to be compiled
-        loss = model_dict.get('loss')
+        loss = dict(model_dict.get('loss'))
 
         # if a custom loss function is passed replace it in loss
         for l in loss:
@@ -271,6 +278,25 @@ def build_predict_func(mod):
     return K.function(tensors, mod.outputs, updates=mod.state_updates)
 
 
+def make_monitor_callback(monitor):
+    """Build a Keras callback reporting the metrics to a training monitor
+
+    Args:
+        monitor(TrainingMonitor): the monitor of the training
+
+    Returns:
+        a keras.callbacks.Callback stopping the training when the monitor
+        asks for it"""
+    from keras.callbacks import Callback
+
+    class MonitorCallback(Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            if monitor.report(logs or dict()):
+                self.model.stop_training = True
+
+    return MonitorCallback()
+
+
 def train(model, data, data_val, size_gen, generator=False, *args, **kwargs):
     """Fit a model given hyperparameters and a serialized model
 
@@ -298,6 +324,12 @@ def train(model, data, data_val, size_gen, generator=False, *args, **kwargs):
     if 'custom_objects' in kwargs:
         custom_objects = kwargs.pop('custom_objects')
 
+    prefetch = kwargs.pop('prefetch', 0)
+    monitor = kwargs.pop('monitor', None)
+    if monitor is not None:
+        kwargs['callbacks'] = list(kwargs.get('callbacks', [])) + \
+            [make_monitor_callback(monitor)]
+
     # load model
     model = model_from_dict_w_opt(model, custom_objects=custom_objects)
 
@@ -310,61 +342,105 @@ def train(model, data, data_val, size_gen, generator=False, *args, **kwargs):
     if generator:
         data = [pickle.loads(d.encode('raw_unicode_escape')) for d in data]
         data = [cm.transform_gen(d, mod_name) for d in data]
+        if prefetch:
+            data = [cm.Prefetcher(d, prefetch) for d in data]
         kwargs.pop('batch_size')
 
-    if all(v is None for v in data_val):
-        val_gen = 0
-    else:
-        val_gen = check_gen(data_val)
-
-    if val_gen > 0:
-        if generator:
-            data_val = [pickle.loads(dv.encode('raw_unicode_escape'))
-                        for dv in data_val]
-            data_val = [cm.transform_gen(dv, mod_name) for dv in data_val]
-            for i, check in enumerate(size_gen):
-                if check is 1:
-                    data_val[i] = next(data_val[i])
-            fit_gen_val = True
+    try:
+        if all(v is None for v in data_val):
+            val_gen = 0
         else:
-            raise Exception("You should also pass a generator for the training"
-                            " data.")
-
-    # fit the model according to the input/output type
+            val_gen = check_gen(data_val)
 
-    if mod_name is "Sequential" or mod_name is "Model":
-        for d, dv in szip(data, data_val):
-            validation = check_validation(dv)
-            if not fit_gen_val:
-                if dv is not None:
-                    dv = (dv['X'], dv['y'])
+        if val_gen > 0:
             if generator:
-                h = model.fit_generator(generator=d,
-                                        validation_data=dv,
-                                        *args,
-                                        **kwargs)
+                data_val = [pickle.loads(dv.encode('raw_unicode_escape'))
+                            for dv in data_val]
+                data_val = [cm.transform_gen(dv, mod_name)
+                            for dv in data_val]
+                for i, check in enumerate(size_gen):
+                    if check is 1:
+                        data_val[i] = next(data_val[i])
+                    elif prefetch:
+                        data_val[i] = cm.Prefetcher(data_val[i], prefetch)
+                fit_gen_val = True
             else:
-                X, y = d['X'], d['y']
-                h = model.fit(x=X,
-                              y=y,
-                              validation_data=dv,
-                              *args,
-                              **kwargs)
-            for metric in metrics_names:
-                results['metrics'][metric] += h.history[metric]
-                if validation:
-                    results['metrics'][
-                        suf + metric] += h.history[suf + metric]
+                raise Exception("You should also pass a generator for the "
+                                "training data.")
+
+        # fit the model according to the input/output type
+
+        if mod_name is "Sequential" or mod_name is "Model":
+            for d, dv in szip(data, data_val):
+                validation = check_validation(dv)
+                if not fit_gen_val:
+                    if dv is not None:
+                        dv = (dv['X'], dv['y'])
+                if generator:
+                    h = model.fit_generator(generator=d,
+                                            validation_data=dv,
+                                            *args,
+                                            **kwargs)
                 else:
-                    results['metrics'][suf + metric] += [np.nan] * \
-                        len(h.history[metric])
-        results['metrics']['iter'] = h.epoch[-1] * len(data)
-    else:
-        raise NotImplementedError("This type of model"
-                                  "is not supported: {}".format(mod_name))
+                    X, y = d['X'], d['y']
+                    h = model.fit(x=X,
+                                  y=y,
+                                  validation_data=dv,
+                                  *args,
+                                  **kwargs)
+                for metric in metrics_names:
+                    results['metrics'][metric] += h.history[metric]
+                    if validation:
+                        results['metrics'][
+                            suf + metric] += h.history[suf + metric]
+                    else:
+                        results['metrics'][suf + metric] += [np.nan] * \
+                            len(h.history[metric])
+                if monitor is not None and monitor.stopped:
+                    break
+            results['metrics']['iter'] = h.epoch[-1] * len(data)
+            if generator and prefetch:
+                prefetchers = cm.close_prefetchers(data + data_val)
+                results['prefetch'] = [p.stats() for p in prefetchers]
+        else:
+            raise NotImplementedError("This type of model"
+                                      "is not supported: {}".format(mod_name))
+    finally:
+        # stop the threads of the prefetchers, even if the training failed
+        cm.close_prefetchers(data + data_val)
     return results, model
 
 
+def arch_hash(model_arch):
+    """Compute the hash of the architecture of a model
+
+    The metrics are not part of the architecture hashed.
+
+    Args:
+        model_arch(dict): the architecture returned by `to_dict_w_opt`
+
+    Returns:
+        the md5 hash of the architecture"""
+    return cm.create_arch_hash(cm.clean_arch(model_arch))
+
+
+def make_hashes(model, data_hash, batch_size=None):
+    """Compute the id of a model and the path where its parameters are dumped
+
+    Args:
+        model(dict): the model dict sent to `fit`
+        data_hash(str): the hash of the data
+        batch_size(int, optionnal): the batch size (32 if None)
+
+    Returns:
+        the hash of the model and the path of the parameters"""
+    if batch_size is None:
+        batch_size = 32
+    if model.get('arch_hash') is None:
+        model = dict(model, arch_hash=arch_hash(model['model_arch']))
+    return cm.make_all_hash(model, batch_size, data_hash, _path_h5)
+
+
 @app.task(bind=True, default_retry_delay=60 * 10, max_retries=3,
           rate_limit='20/s', queue='keras')
 def fit(self, backend_name, backend_version, model, data, data_hash, data_val,
@@ -400,12 +476,13 @@ def fit(self, backend_name, backend_version, model, data, data_hash, data_val,
     else:
         overwrite = kwargs.pop("overwrite")
 
+    memoize = kwargs.pop('memoize', False)
+
     batch_size = kwargs['batch_size']
 
     model_c = cm.clean_model(model)
 
-    hexdi_m, params_dump = cm.make_all_hash(model_c, batch_size, data_hash,
-                                            _path_h5)
+    hexdi_m, params_dump = make_hashes(model, data_hash, batch_size)
 
     # update the full json
     full_json_model = {'backend_name': backend_name,
@@ -420,7 +497,13 @@ def fit(self, backend_name, backend_version, model, data, data_hash, data_val,
                        'mod_data_id': hexdi_m + data_hash,
                        'task_id': self.request.id}
 
-    mod_id = db.insert(full_json_model, db.get_models(), upsert=overwrite)
+    mod_id, memoized = cm.claim_models([full_json_model], overwrite,
+                                       memoize)[0]
+    if memoized is not None:
+        return memoized
+    progress_interval = kwargs.pop('progress_interval', 1.)
+    kwargs['monitor'] = cm.TrainingMonitor(mod_id, task=self,
+                                           min_interval=progress_interval)
 
     if generator is True:
         full_json_data = {'mod_data_id': hexdi_m + data_hash,
@@ -435,6 +518,7 @@ def fit(self, backend_name, backend_version, model, data, data_hash, data_val,
                                           *args, **kwargs)
 
         db.update({'_id': mod_id}, {'$set': res_dict})
+        db.insert_metrics(mod_id, results['metrics'])
 
     except Exception:
         db.update({'_id': mod_id}, {'$set': {'error': 1}})
@@ -442,54 +526,98 @@ def fit(self, backend_name, backend_version, model, data, data_hash, data_val,
     return results
 
 
-@app.task(queue='keras')
-def predict(model, data, *args, **kwargs):
-    """Make predictions given a model and data
+def load_compiled(model, custom_objects=None):
+    """Get a compiled model and its prediction function
+
+    The compiled models are cached in `COMPILED_MODELS` by model and data ids,
+    and compiled again only if the parameters file is modified. With
+    tensorflow, the graph and the session of the model are kept so that it
+    can be used by other threads (see `predict_compiled`).
 
     Args:
-        model(dict): a serialized keras models
+        model(dict): a serialized keras models with its ids and the path of
+            its parameters (only the ids if the model is already cached)
+        custom_objects(dict, optionnal): the serialized custom objects
+
+    Returns:
+        a dictionnary with the compiled `model`, the prediction function
+        `pred`, the `learning_phase` flag and the `model_name`"""
+    import keras.backend as K
+
+    key = (model['mod_id'], model.get('data_id'))
+    with _compiled_lock:
+        compiled = COMPILED_MODELS.get(key)
+        if compiled is None:
+            compiled = {'model_arch': copy.deepcopy(model['model_arch']),
+                        'params_dump': model['params_dump'],
+                        'mtime': None}
+        params_dump = model.get('params_dump') or compiled['params_dump']
+        mtime = os.path.getmtime(params_dump)
+        outdated = (compiled['params_dump'] != params_dump or
+                    compiled['mtime'] != mtime)
+        if outdated:
+            # get the model arch without the optimizer
+            model_dict = {k: v for k, v in compiled['model_arch'].items()
+                          if k != 'optimizer'}
+
+            # load model
+            model_k = model_from_dict_w_opt(model_dict,
+                                            custom_objects=custom_objects)
+            # load the weights
+            model_k.load_weights(params_dump)
+
+            # build the prediction function
+            compiled = {
+                'pred': build_predict_func(model_k),
+                'model': model_k,
+                'learning_phase': model_k.uses_learning_phase,
+                'model_name': model_dict['config'].get('class_name'),
+                'model_arch': compiled['model_arch'],
+                'params_dump': params_dump,
+                'mtime': mtime,
+                'graph': None,
+                'session': None}
+            if K.backend() == 'tensorflow':  # pragma: no cover
+                import tensorflow as tf
+                compiled['graph'] = tf.get_default_graph()
+                compiled['session'] = K.get_session()
+            COMPILED_MODELS[key] = compiled
+    return compiled
+
+
+@contextlib.contextmanager
+def model_scope(compiled):
+    """Enter the graph and the session of a compiled model (tensorflow only)
+
+    Args:
+        compiled(dict): a compiled model returned by `load_compiled`"""
+    if compiled.get('graph') is None:
+        yield
+        return
+    with compiled['graph'].as_default():  # pragma: no cover
+        with compiled['session'].as_default():
+            yield
+
+
+def predict_compiled(compiled, data, batch_size=32):
+    """Make predictions with a compiled model
+
+    Args:
+        compiled(dict): a compiled model returned by `load_compiled`
         data(list, dict, np.array): data to be passed as a dictionary mapping
             inputs names to np.arrays or a list of arrays or an arrays
+        batch_size(int): the size of the batches
 
     Returns:
         an np.array of predictions
     """
-
     from keras.engine.training import make_batches
-    if kwargs.get("batch_size") is None:  # pragma: no cover
-        kwargs['batch_size'] = 32
-
-    batch_size = kwargs['batch_size']
 
-    custom_objects = kwargs.get('custom_objects')
-
-    model_name = model['model_arch']['config'].get('class_name')
-    # check if the predict function is already compiled
-    if model['mod_id'] in COMPILED_MODELS:
-        pred_function = COMPILED_MODELS[model['mod_id']]['pred']
-        model_k = COMPILED_MODELS[model['mod_id']]['model']
-        learning_phase = COMPILED_MODELS[model['mod_id']]['learning_phase']
-        output_shape = COMPILED_MODELS[model['mod_id']]['model'].output_shape
-    else:
-        # get the model arch
-        model_dict = model['model_arch']
-
-        model_dict.pop('optimizer')
-
-        # load model
-        model_k = model_from_dict_w_opt(model_dict,
-                                        custom_objects=custom_objects)
-        # load the weights
-        model_k.load_weights(model['params_dump'])
-
-        # build the prediction function
-        pred_function = build_predict_func(model_k)
-        COMPILED_MODELS[model['mod_id']] = dict()
-        COMPILED_MODELS[model['mod_id']]['pred'] = pred_function
-        COMPILED_MODELS[model['mod_id']]['model'] = model_k
-        learning_phase = model_k.uses_learning_phase
-        COMPILED_MODELS[model['mod_id']]['learning_phase'] = learning_phase
-        output_shape = model_k.output_shape
+    model_name = compiled['model_name']
+    model_k = compiled['model']
+    pred_function = compiled['pred']
+    learning_phase = compiled['learning_phase']
+    output_shape = model_k.output_shape
 
     # predict according to the input/output type
     if model_name == 'Sequential':
@@ -509,13 +637,112 @@ def predict(model, data, *args, **kwargs):
     batches = make_batches(len_data, batch_size)
     index_array = np.arange(len_data)
     results_array = np.empty((len_data, ) + output_shape[1:])
-    for batch_start, batch_end in batches:
-        batch_ids = index_array[batch_start:batch_end]
-        data_b = [d[batch_ids] for d in data]
-        if learning_phase:
-            data_b.append(0.)
-        batch_prediction = pred_function(data_b)
-        if isinstance(batch_prediction, list):  # pragma: no cover
-            batch_prediction = batch_prediction[0]
-        results_array[batch_ids] = batch_prediction
+    with model_scope(compiled):
+        for batch_start, batch_end in batches:
+            batch_ids = index_array[batch_start:batch_end]
+            data_b = [d[batch_ids] for d in data]
+            if learning_phase:
+                data_b.append(0.)
+            batch_prediction = pred_function(data_b)
+            if isinstance(batch_prediction, list):  # pragma: no cover
+                batch_prediction = batch_prediction[0]
+            results_array[batch_ids] = batch_prediction
     return results_array
+
+
+def load_ref(mod_id, data_id, custom_objects=None):
+    """Get a compiled model given its ids
+
+    Args:
+        mod_id(str): the id of the model
+        data_id(str): the id of the data the model was trained on
+        custom_objects(dict, optionnal): the serialized custom objects
+
+    Returns:
+        a compiled model, see `load_compiled`"""
+    if (mod_id, data_id) in COMPILED_MODELS:
+        model = {'mod_id': mod_id, 'data_id': data_id}
+    else:
+        model = cm.get_model_ref(mod_id, data_id)
+    return load_compiled(model, custom_objects)
+
+
+@app.task(queue='keras')
+def predict(model, data, *args, **kwargs):
+    """Make predictions given a model and data
+
+    Args:
+        model(dict): a serialized keras models
+        data(list, dict, np.array): data to be passed as a dictionary mapping
+            inputs names to np.arrays or a list of arrays or an arrays
+
+    Returns:
+        an np.array of predictions
+    """
+    compiled = load_compiled(model, kwargs.get('custom_objects'))
+    return predict_compiled(compiled, data, kwargs.get('batch_size') or 32)
+
+
+@app.task(queue='keras')
+def predict_ref(mod_id, data_id, data, *args, **kwargs):
+    """Make predictions given the ids of a trained model and data
+
+    Only the ids of the model are sent: the compiled model is taken from the
+    cache of the worker or, on a miss, its architecture is read from the
+    models collection.
+
+    If the keyword argument `max_latency` is set, the concurrent requests of
+    the worker for the same model are coalesced (see
+    :meth:`alp.backend.common.MicroBatcher`), up to `max_batch_size` rows.
+
+    Args:
+        mod_id(str): the id of the model
+        data_id(str): the id of the data the model was trained on
+        data(list, dict, np.array): data to be passed as a dictionary mapping
+            inputs names to np.arrays or a list of arrays or an arrays
+
+    Returns:
+        the list of the predictions (the results of the tasks are serialized
+        in json)
+    """
+    compiled = load_ref(mod_id, data_id, kwargs.get('custom_objects'))
+    batch_size = kwargs.get('batch_size') or 32
+    if kwargs.get('max_latency') is None:
+        return predict_compiled(compiled, data, batch_size).tolist()
+
+    max_batch_size = kwargs.get('max_batch_size') or 256
+
+    # run by the thread of the batcher, in the graph of the model
+    def predict_f(data):
+        return predict_compiled(compiled, data,
+                                max(batch_size, max_batch_size))
+
+    batcher = cm.get_batcher(compiled, predict_f, max_batch_size,
+                             kwargs['max_latency'])
+    return batcher.predict(data).tolist()
+
+
+@app.task(queue='keras')
+def predict_stream(mod_id, data_id, stream, *args, **kwargs):
+    """Make predictions on all the batches of a data stream
+
+    The stream is read by the worker so that the shards of a dataset can be
+    evaluated in parallel by several workers.
+
+    Args:
+        mod_id(str): the id of the model
+        data_id(str): the id of the data the model was trained on
+        stream(str): a pickled data stream (see
+            :meth:`alp.appcom.utils.serialize_gen`)
+
+    Returns:
+        the list of the predictions
+    """
+    compiled = load_ref(mod_id, data_id, kwargs.get('custom_objects'))
+    stream = pickle.loads(stream.encode('raw_unicode_escape'))
+    batch_size = kwargs.get('batch_size') or 32
+    preds = [predict_compiled(compiled, inputs, batch_size)
+             for inputs in cm.iter_stream_inputs(stream)]
+    if len(preds) == 0:
+        return []
+    return np.concatenate(preds).tolist()
@@ -4,12 +4,18 @@ Adaptor for the sklearn backend
 """
 
 import copy
+import os
 import pickle
 import re
+import threading
+import time
+import warnings
 import h5py
 import numpy as np
 
 from six import next as snext
+from six import string_types
+from six.moves import range as srange
 from six.moves import zip as szip
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis
@@ -26,7 +32,10 @@ from sklearn.linear_model import Ridge
 
 
 from ..appcom import _path_h5
+from ..appcom.utils import ArrayCache
+from ..appcom.utils import MemmapCache
 from ..appcom.utils import check_gen
+from ..backend import common as cm
 from ..celapp import app
 
 SUPPORTED = [LogisticRegression, LinearRegression, Ridge, Lasso,
@@ -47,7 +56,20 @@ keyval = dict()
 for m in SUPPORTED:
     keyval[getname(m)] = m()
 
+# the regularization parameter of the models trained along a path
+PATH_PARAMS = {getname(Ridge): 'alpha',
+               getname(Lasso): 'alpha',
+               getname(LassoLars): 'alpha',
+               getname(LogisticRegression): 'C'}
+
 COMPILED_MODELS = dict()
+_compiled_lock = threading.Lock()
+STATS_CACHE = ArrayCache(max_bytes=2 ** 28)
+STATS_FILES = MemmapCache(os.path.join(_path_h5, 'stats'), max_bytes=2 ** 30)
+KERNEL_CACHE = MemmapCache(os.path.join(_path_h5, 'kernels'),
+                           max_bytes=2 ** 33)
+# the type of the cached kernels, np.float32 halves their size
+KERNEL_DTYPE = np.float64
 TO_SERIALIZE = ['custom_objects']
 
 # general utilities
@@ -224,7 +246,7 @@ def model_from_dict_w_opt(model_dict, custom_objects=None):
 
     Returns:
         A new sklearn.BaseEstimator (in SUPPORTED) instance. The attributes
-        are not loaded.
+        are not loaded and the model_dict is not modified.
 
     """
     if custom_objects is None:
@@ -238,16 +260,15 @@ def model_from_dict_w_opt(model_dict, custom_objects=None):
         raise NotImplementedError("sklearn model not supported.")
 
     # load the metrics
-    if 'metrics' in model_dict:
-        metrics = model_dict.pop('metrics')
-    else:
-        metrics = None
+    metrics = model_dict.get('metrics')
 
     # create a new instance of the appropriate model type
     model = copy.deepcopy(keyval[model_dict['config']])
 
     # load the parameters
     for k, v in model_dict.items():
+        if k == 'metrics':
+            continue
         if isinstance(v, list):  # pragma: no cover
             setattr(model, k, np.array(v))
         else:
@@ -256,6 +277,234 @@ def model_from_dict_w_opt(model_dict, custom_objects=None):
     return model, metrics
 
 
+def report_last(monitor, results):
+    """Report the last value of each metric to a training monitor
+
+    Args:
+        monitor(TrainingMonitor): the monitor of the training (could be None)
+        results(dict): the results being built by `train`
+
+    Returns:
+        True if the training should be stopped"""
+    if monitor is None:
+        return False
+    last = {k: v[-1] for k, v in results['metrics'].items() if len(v) > 0}
+    return monitor.report(last)
+
+
+def linear_stats(X, y):
+    """Compute the sufficient statistics of a linear least squares problem
+
+    With Z the centered concatenation of the inputs and the outputs, the
+    statistics are packed in one symmetric matrix holding Z^T Z, its last row
+    and column holding the means of the columns and the number of samples.
+
+    Args:
+        X(np.array): the inputs
+        y(np.array): the outputs
+
+    Returns:
+        the packed statistics"""
+    Z = np.column_stack([np.asarray(X, dtype=np.float64),
+                         np.asarray(y, dtype=np.float64)])
+    means = Z.mean(axis=0)
+    Z -= means
+    stats = np.empty((Z.shape[1] + 1, Z.shape[1] + 1))
+    stats[:-1, :-1] = Z.T.dot(Z)
+    stats[-1, :-1] = stats[:-1, -1] = means
+    stats[-1, -1] = len(Z)
+    return stats
+
+
+def unpack_stats(stats, nb_features, fit_intercept=True):
+    """Get the products and the means of the inputs and outputs from packed
+    statistics, see `linear_stats`
+
+    Args:
+        stats(np.array): the packed statistics
+        nb_features(int): the number of columns of the inputs
+        fit_intercept(bool): if False, the products of the raw data are
+            returned and the means are zeros
+
+    Returns:
+        X^T X, X^T y (one column per output), the means of X and of y"""
+    products = stats[:-1, :-1]
+    means = stats[-1, :-1]
+    if not fit_intercept:
+        products = products + stats[-1, -1] * np.outer(means, means)
+        means = np.zeros_like(means)
+    return (products[:nb_features, :nb_features],
+            products[:nb_features, nb_features:],
+            means[:nb_features], means[nb_features:])
+
+
+def normalizes_inputs(model):
+    """Check if a linear model scales its inputs before fitting them
+
+    Args:
+        model(sklearn.BaseEstimator): the model
+
+    Returns:
+        True if the model is fitted on the normalized inputs"""
+    normalize = getattr(model, 'normalize', False)
+    if isinstance(normalize, string_types):
+        # the deprecated default of the lars models normalizes the inputs
+        return isinstance(model, Lars)
+    return bool(normalize)
+
+
+def supports_stats(model, X=None):
+    """Check if a model can be fitted from the statistics of its data, see
+    `fit_from_stats`
+
+    Args:
+        model(sklearn.BaseEstimator): the model to fit
+        X(optionnal): the inputs, the sparse matrices are not supported
+
+    Returns:
+        True if `fit_from_stats` gives the same fit as the model"""
+    if hasattr(X, 'toarray') or normalizes_inputs(model):
+        # the statistics are computed on the raw dense inputs
+        return False
+    if isinstance(model, Lars):
+        return (not hasattr(model.precompute, '__array__') and
+                model.precompute in ['auto', True])
+    if isinstance(model, Ridge):
+        return (np.isscalar(model.alpha) and model.solver != 'lbfgs' and
+                not getattr(model, 'positive', False))
+    if isinstance(model, LinearRegression):
+        return not getattr(model, 'positive', False)
+    return False
+
+
+def fit_from_stats(model, stats, X, y):
+    """Fit a linear model from the sufficient statistics of its data
+
+    The linear and ridge regressions are solved from X^T X and X^T y only,
+    the lars models (and lasso lars) are given X^T X as their precomputed
+    Gram matrix.
+
+    Args:
+        model(sklearn.BaseEstimator): a model checked by `supports_stats`
+        stats(np.array): the statistics of the data, see `linear_stats`
+        X(np.array): the inputs
+        y(np.array): the outputs
+
+    Returns:
+        the fitted model"""
+    XtX, Xty, X_mean, y_mean = unpack_stats(stats, np.shape(X)[1],
+                                            model.fit_intercept)
+    if np.ndim(y) == 1:
+        Xty, y_mean = Xty[:, 0], y_mean[0]
+
+    if isinstance(model, Lars):
+        precompute = model.precompute
+        model.precompute = XtX
+        try:
+            model.fit(X, y)
+        finally:
+            model.precompute = precompute
+        return model
+
+    if isinstance(model, Ridge):
+        coef = np.linalg.solve(XtX + model.alpha * np.eye(len(XtX)), Xty)
+        if coef.ndim == 2 and coef.shape[1] == 1:
+            # like sklearn, a single output column gives flat coefficients
+            coef = coef.ravel()
+        model.n_iter_ = None
+        model.solver_ = 'cholesky'
+    else:
+        coef, _, rank, singular = np.linalg.lstsq(XtX, Xty, rcond=None)
+        model.rank_ = rank
+        model.singular_ = np.sqrt(singular)
+    model.coef_ = coef.T
+    model.intercept_ = 0.
+    if model.fit_intercept:
+        model.intercept_ = y_mean - X_mean.dot(coef)
+    model.n_features_in_ = len(XtX)
+    return model
+
+
+def get_linear_stats(X, y):
+    """Get the sufficient statistics of some data, see `linear_stats`
+
+    The statistics are keyed by the hash of the content of the data. They are
+    cached in memory in `STATS_CACHE` and saved in `STATS_FILES`, in the
+    directory of the parameters, so that they are computed once per data
+    for all the workers.
+
+    Args:
+        X(np.array): the inputs
+        y(np.array): the outputs
+
+    Returns:
+        the packed statistics"""
+    key = cm.create_input_hash([np.asarray(X), np.asarray(y)])
+    stats = STATS_CACHE.get(key)
+    if stats is not None:
+        return stats
+    stats = STATS_FILES.get(key)
+    if stats is None:
+        stats = linear_stats(X, y)
+        STATS_FILES.put(key, stats)
+    stats = np.array(stats)
+    STATS_CACHE.put(key, stats)
+    return stats
+
+
+def supports_kernel_cache(model):
+    """Check if the kernel matrices of a model can be cached, see
+    `get_kernel`
+
+    The models with `kernel_params` are fitted by sklearn, which decides how
+    they are used."""
+    return (isinstance(model, KernelRidge) and
+            isinstance(model.kernel, string_types) and
+            model.kernel != 'precomputed' and
+            not model.kernel_params)
+
+
+def kernel_params(model):
+    """Get the kernel and its parameters of a kernel model"""
+    return {'kernel': model.kernel,
+            'gamma': model.gamma,
+            'degree': model.degree,
+            'coef0': model.coef0}
+
+
+def get_kernel(params, X, Y=None):
+    """Get a kernel matrix from `KERNEL_CACHE`, computing it on a miss
+
+    The kernels are keyed by the hash of the content of the training inputs,
+    the kernel and its parameters (and the other inputs for the cross
+    kernels) so that the models only differing by their regularization share
+    them.
+
+    Args:
+        params(dict): the kernel and its parameters, see `kernel_params`
+        X(np.array): the training inputs
+        Y(np.array, optionnal): other inputs (validation data for instance),
+            the kernel of the training inputs is returned by default
+
+    Returns:
+        the (memory-mapped) kernel between `Y` and `X`"""
+    X = np.asarray(X)
+    if Y is not None:
+        Y = np.asarray(Y)
+    key = cm.create_input_hash({'fit_inputs': X,
+                                'params': params,
+                                'inputs': Y})
+    K = KERNEL_CACHE.get(key)
+    if K is None:
+        from sklearn.metrics.pairwise import pairwise_kernels
+        kwargs = {k: v for k, v in params.items() if k != 'kernel'}
+        K = pairwise_kernels(X if Y is None else Y, X,
+                             metric=params['kernel'], filter_params=True,
+                             **kwargs)
+        K = KERNEL_CACHE.put(key, K.astype(KERNEL_DTYPE, copy=False))
+    return K
+
+
 def train(model, data, data_val, size_gen, generator=False, *args, **kwargs):
     """Fit a model given parameters and a serialized model
 
@@ -265,6 +514,12 @@ def train(model, data, data_val, size_gen, generator=False, *args, **kwargs):
             dictionnaries mapping the inputs names to np.arrays
             XOR -a list of fuel generators
         data_val(list): same structure than `data` but for validation.
+        fitted(sklearn.BaseEstimator, optionnal): a model already fitted on
+            `data`, which is only evaluated (dict data only)
+        data_id(str, optionnal): the hash of the data, the linear models
+            are then fitted from the cached statistics of the data and the
+            kernel models from the cached kernels (dict data only, see
+            `fit_from_stats` and `get_kernel`)
 
         it is possible to feed generators for data and plain data for data_val.
         it is not possible the other way around.
@@ -288,9 +543,16 @@ def train(model, data, data_val, size_gen, generator=False, *args, **kwargs):
     if 'custom_objects' in kwargs:  # pragma: no cover
         custom_objects = kwargs.pop('custom_objects')
 
+    monitor = kwargs.pop('monitor', None)
+    prefetch = kwargs.pop('prefetch', 0)
+    fitted = kwargs.pop('fitted', None)
+    data_id = kwargs.pop('data_id', None)
+
     # Load model and get metrics
     model, metrics = model_from_dict_w_opt(model,
                                            custom_objects=custom_objects)
+    if fitted is not None:
+        model = fitted
 
     # instantiates metrics
     # there is at least one mandatory metric for sklearn models
@@ -305,191 +567,404 @@ def train(model, data, data_val, size_gen, generator=False, *args, **kwargs):
     # pickle data if generator
     if generator:
         data = [pickle.loads(d.encode('raw_unicode_escape')) for d in data]
+        if prefetch:
+            data = [cm.PrefetchedStream(d, prefetch) for d in data]
 
-    # check if data_val is in generator
-    if all(v is None for v in data_val):
-        val_gen = 0
-    else:
-        val_gen = check_gen(data_val)
-    # if so pickle data_val
-    if val_gen > 0:
-        if generator:
-            data_val = [pickle.loads(dv.encode('raw_unicode_escape'))
-                        for dv in data_val]
-            fit_gen_val = True
-        else:
-            raise Exception("You should also pass a generator for the training"
-                            " data.")
-
-    # Fit the model
-    # and validates it
-    if len(size_gen) == 0:
-        size_gen = [0] * len(data)
-    # loop over the data/generators
-    for d, dv, s_gen in szip(data, data_val, size_gen):
-        # check if we have a data_val object.
-        # if not, no evaluation of the metrics on data_val.
-        if dv is None:
-            validation = False
+    try:
+        # check if data_val is in generator
+        if all(v is None for v in data_val):
+            val_gen = 0
         else:
-            validation = True
-
-        # not treating the case "not generator and fit_gen_val"
-        #    since it is catched above
-        # case A : dict for data and data_val
-        if not generator and not fit_gen_val:
-            X, y = d['X'], d['y']
-            model.fit(X, y, *args, **kwargs)
-            predondata.append(model.predict(X))
-            for metric in metrics_names:
-                if metric is not 'score':
-                    computed_metric = getattr(
-                        sklearn.metrics, metric)(y, predondata[-1])
-                    results['metrics'][metric].append(
-                        computed_metric)
-                else:
-                    computed_metric = model.score(X, y)
-                    results['metrics']['score'].append(
-                        computed_metric)
-                    # TODO : optimization
-
-            if validation:
-                X_val, y_val = dv['X'], dv['y']
-                predonval.append(model.predict(X_val))
+            val_gen = check_gen(data_val)
+        # if so pickle data_val
+        if val_gen > 0:
+            if generator:
+                data_val = [pickle.loads(dv.encode('raw_unicode_escape'))
+                            for dv in data_val]
+                if prefetch:
+                    data_val = [cm.PrefetchedStream(dv, prefetch)
+                                for dv in data_val]
+                fit_gen_val = True
+            else:
+                raise Exception("You should also pass a generator for the "
+                                "training data.")
+
+        # Fit the model
+        # and validates it
+        if len(size_gen) == 0:
+            size_gen = [0] * len(data)
+        # loop over the data/generators
+        for i, (d, dv, s_gen) in enumerate(szip(data, data_val, size_gen)):
+            # check if we have a data_val object.
+            # if not, no evaluation of the metrics on data_val.
+            if dv is None:
+                validation = False
+            else:
+                validation = True
+
+            # not treating the case "not generator and fit_gen_val"
+            #    since it is catched above
+            # case A : dict for data and data_val
+            if not generator and not fit_gen_val:
+                X, y = d['X'], d['y']
+                cached = (fitted is None and data_id is not None and
+                          not (args or kwargs))
+                use_stats = cached and supports_stats(model, X)
+                use_kernel = cached and supports_kernel_cache(model)
+                if use_stats:
+                    stats = get_linear_stats(X, y)
+                    fit_from_stats(model, stats, X, y)
+                elif use_kernel:
+                    # fit and evaluate on the cached kernels
+                    X_fit, kernel = X, kernel_params(model)
+                    X = get_kernel(kernel, X_fit)
+                    model.kernel = 'precomputed'
+                    model.fit(X, y)
+                elif fitted is None:
+                    model.fit(X, y, *args, **kwargs)
+                predondata.append(model.predict(X))
                 for metric in metrics_names:
                     if metric is not 'score':
                         computed_metric = getattr(
-                            sklearn.metrics, metric)(y_val, predonval[-1])
+                            sklearn.metrics, metric)(y, predondata[-1])
+                        results['metrics'][metric].append(
+                            computed_metric)
                     else:
-                        computed_metric = model.score(X_val, y_val)
+                        computed_metric = model.score(X, y)
+                        results['metrics']['score'].append(
+                            computed_metric)
                         # TODO : optimization
-                    results['metrics']['val_' + metric].append(
-                        computed_metric)
 
-            else:
-                for metric in metrics_names:
-                    results['metrics']['val_' + metric].append(np.nan)
-
-        # case B : generator for data and no generator for data_val
-        # could be dict or None
-        elif generator and not fit_gen_val:
-            if validation:
-                X_val, y_val = dv['X'], dv['y']
-            for batch_data in d.get_epoch_iterator():
-                X, y = batch_data
-                model.fit(X, y, *args, **kwargs)
-                predondata.append(model.predict(X))
                 if validation:
+                    X_val, y_val = dv['X'], dv['y']
+                    if use_kernel:
+                        X_val = get_kernel(kernel, X_fit, X_val)
                     predonval.append(model.predict(X_val))
+                    for metric in metrics_names:
+                        if metric is not 'score':
+                            computed_metric = getattr(
+                                sklearn.metrics, metric)(y_val, predonval[-1])
+                        else:
+                            computed_metric = model.score(X_val, y_val)
+                            # TODO : optimization
+                        results['metrics']['val_' + metric].append(
+                            computed_metric)
 
-                for metric in metrics_names:
-                    if metric is not 'score':
-                        results['metrics'][metric].append(
-                            getattr(sklearn.metrics, metric)(y,
-                                                             predondata[-1]))
+                else:
+                    for metric in metrics_names:
+                        results['metrics']['val_' + metric].append(np.nan)
 
-                        if validation:
-                            results['metrics']['val_' +
-                                               metric].append(
-                                getattr(sklearn.metrics,
-                                        metric)(y_val, predonval[-1]))
-                        else:
-                            results['metrics'][
-                                'val_' + metric].append(np.nan)
-                    else:
-                        results['metrics']['score'].append(
-                            model.score(X, y))
-                        if validation:
-                            results['metrics']['val_score'].append(
-                                model.score(X_val, y_val))
-                        else:
-                            results['metrics']['val_score'].append(np.nan)
+                if use_kernel:
+                    model.kernel = kernel['kernel']
+                    model.X_fit_ = np.asarray(X_fit)
+                    model.n_features_in_ = model.X_fit_.shape[1]
+                report_last(monitor, results)
 
-        # case C : generator for data and for data_val
-        else:
-            # case C1: N chunks in gen, 1 chunk in val, many to one
-            if s_gen == 1:
-                X_val, y_val = snext(dv.get_epoch_iterator())
+            # case B : generator for data and no generator for data_val
+            # could be dict or None
+            elif generator and not fit_gen_val:
+                if validation:
+                    X_val, y_val = dv['X'], dv['y']
                 for batch_data in d.get_epoch_iterator():
                     X, y = batch_data
                     model.fit(X, y, *args, **kwargs)
                     predondata.append(model.predict(X))
-                    predonval.append(model.predict(X_val))
+                    if validation:
+                        predonval.append(model.predict(X_val))
+
                     for metric in metrics_names:
                         if metric is not 'score':
                             results['metrics'][metric].append(
-                                getattr(sklearn.metrics,
-                                        metric)(y, predondata[-1]))
-                            results['metrics']['val_' +
-                                               metric].append(
-                                getattr(sklearn.metrics,
-                                        metric)(y_val, predonval[-1]))
+                                getattr(sklearn.metrics, metric)(
+                                    y, predondata[-1]))
+
+                            if validation:
+                                results['metrics']['val_' +
+                                                   metric].append(
+                                    getattr(sklearn.metrics,
+                                            metric)(y_val, predonval[-1]))
+                            else:
+                                results['metrics'][
+                                    'val_' + metric].append(np.nan)
                         else:
                             results['metrics']['score'].append(
                                 model.score(X, y))
-                            results['metrics']['val_score'].append(
-                                model.score(X_val, y_val))
-
-            # case C2 : 1 chunk in gen, N chunks in val, one to many
-            elif s_gen == 2:
-                X, y = snext(d.get_epoch_iterator())
-                model.fit(X, y, *args, **kwargs)
-                predondata.append(model.predict(X))
-                for metric in metrics_names:
-                    if metric is not 'score':
-                        results['metrics'][metric].append(
-                            getattr(sklearn.metrics,
-                                    metric)(y, predondata[-1]))
-                    else:
-                        results['metrics']['score'].append(model.score(X, y))
-
-                for batch_val in dv.get_epoch_iterator():
-                    X_val, y_val = batch_val
-                    predonval.append(model.predict(X_val))
-                    for metric in metrics_names:
-                        if metric is not 'score':
-                            results['metrics']['val_' +
-                                               metric].append(
-                                getattr(sklearn.metrics,
-                                        metric)(y_val, predonval[-1]))
-                        else:
-                            results['metrics']['val_score'].append(
-                                model.score(X_val, y_val))
-
-            # case C3 : same numbers of chunks, many to many
-            elif s_gen == 3:
-                for batch_data, batch_val in szip(d.get_epoch_iterator(),
-                                                  dv.get_epoch_iterator()):
-                    X, y = batch_data
-                    X_val, y_val = batch_val
+                            if validation:
+                                results['metrics']['val_score'].append(
+                                    model.score(X_val, y_val))
+                            else:
+                                results['metrics']['val_score'].append(np.nan)
+                    if report_last(monitor, results):
+                        break
+
+            # case C : generator for data and for data_val
+            else:
+                # case C1: N chunks in gen, 1 chunk in val, many to one
+                if s_gen == 1:
+                    X_val, y_val = snext(dv.get_epoch_iterator())
+                    for batch_data in d.get_epoch_iterator():
+                        X, y = batch_data
+                        model.fit(X, y, *args, **kwargs)
+                        predondata.append(model.predict(X))
+                        predonval.append(model.predict(X_val))
+                        for metric in metrics_names:
+                            if metric is not 'score':
+                                results['metrics'][metric].append(
+                                    getattr(sklearn.metrics,
+                                            metric)(y, predondata[-1]))
+                                results['metrics']['val_' +
+                                                   metric].append(
+                                    getattr(sklearn.metrics,
+                                            metric)(y_val, predonval[-1]))
+                            else:
+                                results['metrics']['score'].append(
+                                    model.score(X, y))
+                                results['metrics']['val_score'].append(
+                                    model.score(X_val, y_val))
+                        if report_last(monitor, results):
+                            break
+
+                # case C2 : 1 chunk in gen, N chunks in val, one to many
+                elif s_gen == 2:
+                    X, y = snext(d.get_epoch_iterator())
                     model.fit(X, y, *args, **kwargs)
                     predondata.append(model.predict(X))
-                    predonval.append(model.predict(X_val))
                     for metric in metrics_names:
                         if metric is not 'score':
                             results['metrics'][metric].append(
                                 getattr(sklearn.metrics,
                                         metric)(y, predondata[-1]))
-                            results['metrics']['val_' +
-                                               metric].append(
-                                getattr(sklearn.metrics,
-                                        metric)(y_val, predonval[-1]))
                         else:
                             results['metrics']['score'].append(
                                 model.score(X, y))
-                            results['metrics']['val_score'].append(
-                                model.score(X_val, y_val))
 
-            else:  # pragma: no cover
-                raise Exception(
-                    'Incoherent generator size for train and validation')
+                    for batch_val in dv.get_epoch_iterator():
+                        X_val, y_val = batch_val
+                        predonval.append(model.predict(X_val))
+                        for metric in metrics_names:
+                            if metric is not 'score':
+                                results['metrics']['val_' +
+                                                   metric].append(
+                                    getattr(sklearn.metrics,
+                                            metric)(y_val, predonval[-1]))
+                            else:
+                                results['metrics']['val_score'].append(
+                                    model.score(X_val, y_val))
+                    report_last(monitor, results)
+
+                # case C3 : same numbers of chunks, many to many
+                elif s_gen == 3:
+                    for batch_data, batch_val in szip(d.get_epoch_iterator(),
+                                                      dv.get_epoch_iterator()):
+                        X, y = batch_data
+                        X_val, y_val = batch_val
+                        model.fit(X, y, *args, **kwargs)
+                        predondata.append(model.predict(X))
+                        predonval.append(model.predict(X_val))
+                        for metric in metrics_names:
+                            if metric is not 'score':
+                                results['metrics'][metric].append(
+                                    getattr(sklearn.metrics,
+                                            metric)(y, predondata[-1]))
+                                results['metrics']['val_' +
+                                                   metric].append(
+                                    getattr(sklearn.metrics,
+                                            metric)(y_val, predonval[-1]))
+                            else:
+                                results['metrics']['score'].append(
+                                    model.score(X, y))
+                                results['metrics']['val_score'].append(
+                                    model.score(X_val, y_val))
+                        if report_last(monitor, results):
+                            break
+
+                else:  # pragma: no cover
+                    raise Exception(
+                        'Incoherent generator size for train and validation')
+
+            if monitor is not None and monitor.stopped:
+                break
+    finally:
+        # stop the threads of the prefetchers, even if the training failed
+        cm.close_prefetchers(data + data_val)
 
     # for compatibility with keras backend
     results['metrics']['iter'] = np.nan
 
+    if generator and prefetch:
+        streams = cm.close_prefetchers(data + data_val)
+        results['prefetch'] = [stream.stats() for stream in streams]
+
     return results, model
 
 
+def _ridge_path(models, X, y):
+    """Solve all the alphas of ridge models with one SVD of the inputs
+
+    The models should not normalize their inputs, see `normalizes_inputs`"""
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    fit_intercept = models[0].fit_intercept
+    X_mean = np.zeros(X.shape[1])
+    y_mean = np.zeros(y.shape[1:])
+    if fit_intercept:
+        X_mean = X.mean(axis=0)
+        y_mean = y.mean(axis=0)
+    U, s, Vt = np.linalg.svd(X - X_mean, full_matrices=False)
+    UTy = U.T.dot(y - y_mean)
+
+    fitted = []
+    for model in models:
+        shrink = s / (s ** 2 + model.alpha)
+        coef = Vt.T.dot((shrink * UTy.T).T)
+        estimator = copy.deepcopy(model)
+        estimator.coef_ = coef.T
+        estimator.intercept_ = 0.
+        if fit_intercept:
+            estimator.intercept_ = y_mean - X_mean.dot(coef)
+        estimator.n_iter_ = None
+        estimator.n_features_in_ = X.shape[1]
+        fitted.append(estimator)
+    return fitted
+
+
+def _lars_path(models, X, y):
+    """Read the lasso lars models on the path of the least regularized one
+
+    The models should not normalize their inputs: the path is then in the
+    scale of the inputs, see `normalizes_inputs`"""
+    least = int(np.argmin([model.alpha for model in models]))
+    reference = copy.deepcopy(models[least]).fit(X, y)
+    X_mean = np.asarray(X, dtype=np.float64).mean(axis=0)
+    y_mean = np.asarray(y, dtype=np.float64).mean(axis=0)
+    alphas = reference.alphas_[::-1]
+    coef_path = reference.coef_path_[:, ::-1]
+
+    fitted = []
+    for i, model in enumerate(models):
+        if i == least:
+            fitted.append(reference)
+            continue
+        coef = np.array([np.interp(model.alpha, alphas, c)
+                         for c in coef_path])
+        keep = reference.alphas_ > model.alpha
+        estimator = copy.deepcopy(reference)
+        estimator.alpha = model.alpha
+        estimator.alphas_ = np.append(reference.alphas_[keep], model.alpha)
+        estimator.coef_path_ = np.column_stack([
+            reference.coef_path_[:, keep], coef])
+        estimator.active_ = [j for j in reference.active_ if coef[j] != 0]
+        estimator.n_iter_ = len(estimator.alphas_) - 1
+        estimator.coef_ = coef
+        if reference.fit_intercept:
+            estimator.intercept_ = y_mean - X_mean.dot(coef)
+        fitted.append(estimator)
+    return fitted
+
+
+def _warm_path(models, X, y, param):
+    """Fit the models from the most to the least regularized one, each fit
+    starting from the solution of the previous one"""
+    order = sorted(srange(len(models)),
+                   key=lambda i: getattr(models[i], param),
+                   reverse=param == 'alpha')
+    estimator = copy.deepcopy(models[order[0]])
+    estimator.warm_start = True
+
+    fitted = [None] * len(models)
+    for i in order:
+        setattr(estimator, param, getattr(models[i], param))
+        estimator.fit(X, y)
+        fitted[i] = copy.deepcopy(estimator)
+        fitted[i].warm_start = models[i].warm_start
+    return fitted
+
+
+def fit_regularization_path(models, X, y, *args, **kwargs):
+    """Fit models differing only by their regularization parameter
+
+    The ridge models share one SVD of the centered inputs, the lasso lars
+    models are read on the path of the least regularized one and the lasso and
+    logistic regressions are warm started from the most regularized one. Any
+    other model, the ridge and lasso lars models normalizing their inputs, or
+    any fit with extra arguments, is fitted independently.
+
+    Args:
+        models(list): sklearn models of the same class
+        X(np.array): the inputs
+        y(np.array): the outputs
+
+    Returns:
+        the list of the fitted models, in the order of `models`"""
+    param = PATH_PARAMS.get(getname(models[0], call=False))
+    if param is None or args or kwargs or hasattr(X, 'toarray'):
+        return [copy.deepcopy(m).fit(X, y, *args, **kwargs) for m in models]
+    if isinstance(models[0], (Ridge, LassoLars)) and \
+            normalizes_inputs(models[0]):
+        # the shared solutions are computed on the raw inputs
+        return [copy.deepcopy(m).fit(X, y) for m in models]
+    if isinstance(models[0], Ridge) and not getattr(models[0], 'positive',
+                                                    False):
+        return _ridge_path(models, X, y)
+    if isinstance(models[0], LassoLars):
+        if (np.ndim(y) == 1 and models[0].fit_path and
+                getattr(models[0], 'jitter', None) is None):
+            return _lars_path(models, X, y)
+        return [copy.deepcopy(m).fit(X, y) for m in models]
+    return _warm_path(models, X, y, param)
+
+
+def arch_hash(model_arch):
+    """Compute the hash of the architecture of a model
+
+    Args:
+        model_arch(dict): the architecture returned by `to_dict_w_opt`
+
+    Returns:
+        the md5 hash of the architecture"""
+    return cm.create_arch_hash(model_arch)
+
+
+def make_hashes(model, data_hash, batch_size=None):
+    """Compute the id of a model and the path where its parameters are dumped
+
+    Args:
+        model(dict): the model dict sent to `fit`
+        data_hash(str): the hash of the data
+        batch_size(int, optionnal): not used, for compatibility with the keras
+            backend
+
+    Returns:
+        the hash of the model and the path of the parameters"""
+    return cm.make_all_hash(model, 0, data_hash, _path_h5)
+
+
+def model_document(backend_name, backend_version, model, hexdi_m, data_hash,
+                   params_dump, task_id):
+    """Build the document of a model inserted in the db before its training
+
+    Args:
+        model(dict): the model dict sent to `fit`
+        hexdi_m(str): the hash of the model
+        data_hash(str): the hash of the data
+        params_dump(str): the path of the parameters
+        task_id(str): the id of the training task
+
+    Returns:
+        the document of the model"""
+    from datetime import datetime
+    return {'backend_name': backend_name,
+            'backend_version': backend_version,
+            'model_arch': model['model_arch'],
+            'datetime': datetime.now(),
+            'mod_id': hexdi_m,
+            'data_id': data_hash,
+            'params_dump': params_dump,
+            'trained': 0,
+            'mod_data_id': hexdi_m + data_hash,
+            'task_id': task_id}
+
+
 @app.task(bind=True, default_retry_delay=60 * 10, max_retries=3,
           rate_limit='20/s', queue='sklearn')
 def fit(self, backend_name, backend_version, model, data, data_hash,
@@ -513,28 +988,28 @@ def fit(self, backend_name, backend_version, model, data, data_hash,
 
     from alp import dbbackend as db
     import alp.backend.common as cm
-    from datetime import datetime
 
     if kwargs.get("overwrite") is None:  # pragma: no cover
         overwrite = False
     else:
         overwrite = kwargs.pop("overwrite")
 
-    hexdi_m, params_dump = cm.make_all_hash(model, 0, data_hash, _path_h5)
+    memoize = kwargs.pop('memoize', False)
+
+    hexdi_m, params_dump = make_hashes(model, data_hash)
 
     # update the full json
-    full_json = {'backend_name': backend_name,
-                 'backend_version': backend_version,
-                 'model_arch': model['model_arch'],
-                 'datetime': datetime.now(),
-                 'mod_id': hexdi_m,
-                 'data_id': data_hash,
-                 'params_dump': params_dump,
-                 'trained': 0,
-                 'mod_data_id': hexdi_m + data_hash,
-                 'task_id': self.request.id}
-
-    mod_id = db.insert(full_json, db.get_models(), upsert=overwrite)
+    full_json = model_document(backend_name, backend_version, model, hexdi_m,
+                               data_hash, params_dump, self.request.id)
+
+    mod_id, memoized = cm.claim_models([full_json], overwrite, memoize)[0]
+    if memoized is not None:
+        return memoized
+    progress_interval = kwargs.pop('progress_interval', 1.)
+    kwargs['monitor'] = cm.TrainingMonitor(mod_id, task=self,
+                                           min_interval=progress_interval)
+    if not generator:
+        kwargs['data_id'] = data_hash
 
     if generator is True:  # pragma: no cover
         full_json_data = {'mod_data_id': hexdi_m + data_hash,
@@ -552,6 +1027,7 @@ def fit(self, backend_name, backend_version, model, data, data_hash,
                                           *args, **kwargs)
 
         db.update({'_id': mod_id}, {'$set': res_dict})
+        db.insert_metrics(mod_id, results['metrics'])
 
     except Exception:
         db.update({'_id': mod_id}, {'$set': {'error': 1}})
@@ -559,10 +1035,405 @@ def fit(self, backend_name, backend_version, model, data, data_hash,
     return results
 
 
+@app.task(bind=True, default_retry_delay=60 * 10, max_retries=3,
+          rate_limit='20/s', queue='sklearn')
+def fit_path(self, backend_name, backend_version, models, data, data_hash,
+             data_val, size_gen, generator=False, *args, **kwargs):
+    """Train in one task models differing only by their regularization
+    parameter, see `fit_regularization_path`.
+
+    Each model is registered with its own document and parameters file, as if
+    it was trained by `fit`. Unless `overwrite` is True, the models already
+    trained on the same data are not trained again (see `claim_models`).
+
+    Args:
+        models(list): the model dicts, as sent to `fit`
+        data(list): a list with one dict mapping inputs and outputs to lists
+            or np.arrays, generators are not supported
+        data_val(list): same structure than `data` but for validation
+
+    Returns:
+        the list of the results of the models, as returned by `fit`"""
+    from alp import dbbackend as db
+
+    config = models[0]['model_arch']['config']
+    param = PATH_PARAMS.get(config)
+    if param is None:
+        raise NotImplementedError('No regularization path for ' + config)
+    if generator or len(data) != 1:
+        raise NotImplementedError('The regularization path is only computed'
+                                  ' on a single dict of training data.')
+    others = set(cm.serialize_arch({k: v for k, v in
+                                    m['model_arch'].items() if k != param})
+                 for m in models)
+    if len(others) != 1:
+        raise ValueError('The models must only differ by ' + param)
+
+    overwrite = kwargs.pop('overwrite', False)
+    memoize = kwargs.pop('memoize', False)
+    kwargs.pop('custom_objects', None)
+    kwargs.pop('prefetch', None)
+    progress_interval = kwargs.pop('progress_interval', 1.)
+
+    docs = []
+    for model in models:
+        hexdi_m, params_dump = make_hashes(model, data_hash)
+        docs.append(model_document(backend_name, backend_version, model,
+                                   hexdi_m, data_hash, params_dump,
+                                   self.request.id))
+    claimed = cm.claim_models(docs, overwrite, memoize)
+    to_train = [i for i, (mod_id, _) in enumerate(claimed)
+                if mod_id is not None]
+
+    try:
+        estimators = [model_from_dict_w_opt(models[i]['model_arch'])[0]
+                      for i in to_train]
+        if len(estimators) > 0:
+            estimators = fit_regularization_path(
+                estimators, data[0]['X'], data[0]['y'], *args, **kwargs)
+    except Exception:
+        for i in to_train:
+            db.update({'_id': claimed[i][0]}, {'$set': {'error': 1}})
+        raise
+
+    results = [memoized for _, memoized in claimed]
+    for i, estimator in szip(to_train, estimators):
+        mod_id = claimed[i][0]
+        monitor = cm.TrainingMonitor(mod_id, task=self,
+                                     min_interval=progress_interval,
+                                     mod_data_id=docs[i]['mod_data_id'])
+        try:
+            res, res_dict = cm.train_pipe(train, save_params, models[i],
+                                          data, data_val,
+                                          generator, size_gen,
+                                          docs[i]['params_dump'], data_hash,
+                                          docs[i]['mod_id'],
+                                          fitted=estimator,
+                                          monitor=monitor)
+
+            db.update({'_id': mod_id}, {'$set': res_dict})
+            db.insert_metrics(mod_id, res['metrics'])
+
+        except Exception:
+            db.update({'_id': mod_id}, {'$set': {'error': 1}})
+            raise
+        results[i] = res
+    return results
+
+
+@app.task(bind=True, default_retry_delay=60 * 10, max_retries=3,
+          rate_limit='20/s', queue='sklearn')
+def fit_pack(self, backend_name, backend_version, models, data, data_hash,
+             data_val, size_gen, generator=False, *args, **kwargs):
+    """Train several models on the same data back to back in one task
+
+    The documents of the models are inserted before the trainings, so that
+    their progress can be followed and they can be stopped as the models
+    trained by `fit`. Unless `overwrite` is True, the models already trained
+    on the same data are not trained again (see `claim_models`). The results
+    and the metrics are written in bulk once the models are trained (see
+    `insert_trained`). If a model fails, it is stored with an error flag, as
+    the models of the pack not trained yet, and the exception is raised.
+
+    Args:
+        models(list): the model dicts, as sent to `fit`
+        data(list): a list of dict mapping inputs and outputs to lists or
+            dictionnaries mapping the inputs names to np.arrays
+        data_val(list): same structure than `data` but for validation
+
+    Returns:
+        the list of the results of the models, as returned by `fit`, with
+        the training time of each model in `fit_time`"""
+    from alp import dbbackend as db
+
+    overwrite = kwargs.pop('overwrite', False)
+    memoize = kwargs.pop('memoize', False)
+    progress_interval = kwargs.pop('progress_interval', 1.)
+    if not generator:
+        kwargs['data_id'] = data_hash
+
+    docs = []
+    for model in models:
+        hexdi_m, params_dump = make_hashes(model, data_hash)
+        docs.append(model_document(backend_name, backend_version, model,
+                                   hexdi_m, data_hash, params_dump,
+                                   self.request.id))
+    claimed = cm.claim_models(docs, overwrite, memoize)
+
+    trained = []
+    metrics = []
+    results = []
+    try:
+        for model, doc, (mod_id, memoized) in szip(models, docs, claimed):
+            if memoized is not None:
+                results.append(memoized)
+                continue
+            trained.append({'mod_data_id': doc['mod_data_id'], 'error': 1})
+            metrics.append(dict())
+            if generator is True:  # pragma: no cover
+                full_json_data = {'mod_data_id': doc['mod_data_id'],
+                                  'data_id': data_hash,
+                                  'data': data}
+                db.insert(full_json_data, db.get_generators(),
+                          upsert=overwrite)
+
+            monitor = cm.TrainingMonitor(mod_id, task=self,
+                                         min_interval=progress_interval,
+                                         mod_data_id=doc['mod_data_id'])
+            start = time.time()
+            res, res_dict = cm.train_pipe(train, save_params, model,
+                                          data, data_val,
+                                          generator, size_gen,
+                                          doc['params_dump'], data_hash,
+                                          doc['mod_id'], monitor=monitor,
+                                          *args, **kwargs)
+            res['fit_time'] = time.time() - start
+            trained[-1].pop('error')
+            trained[-1].update(res_dict)
+            metrics[-1] = res['metrics']
+            results.append(res)
+    except Exception:
+        # the models not trained yet are flagged too, so that they are not
+        # waited for as pending
+        started = set(t['mod_data_id'] for t in trained)
+        for doc, (mod_id, _) in szip(docs, claimed):
+            if mod_id is not None and doc['mod_data_id'] not in started:
+                trained.append({'mod_data_id': doc['mod_data_id'],
+                                'error': 1})
+                metrics.append(dict())
+        db.insert_trained(trained, metrics, upsert=True)
+        raise
+    if len(trained) > 0:
+        db.insert_trained(trained, metrics, upsert=True)
+    return results
+
+
+def linear_block(model):
+    """Get the coefficients and the link function of a linear model
+
+    Args:
+        model(sklearn.BaseEstimator): a fitted model (in SUPPORTED)
+
+    Returns:
+        the coefficients (a contiguous np.array of shape (n_features,
+        n_outputs)), the intercepts, and the function mapping the decision
+        values to the predictions. None if the model is not linear
+        (KernelRidge, QuadraticDiscriminantAnalysis)"""
+    if isinstance(model, (KernelRidge, QuadraticDiscriminantAnalysis)):
+        return None
+    W = np.asarray(model.coef_).T
+    if W.ndim == 1:
+        W = W[:, None]
+    b = np.zeros(W.shape[1]) + np.asarray(model.intercept_)
+
+    if isinstance(model, (LogisticRegression, LinearDiscriminantAnalysis)):
+        classes = np.asarray(model.classes_)
+        if W.shape[1] == 1:
+            def link(Z):
+                return classes[(Z[:, 0] > 0).astype(int)]
+        else:
+            def link(Z):
+                return classes[np.argmax(Z, axis=1)]
+    elif np.asarray(model.coef_).ndim == 1:
+        def link(Z):
+            return Z[:, 0]
+    else:
+        def link(Z):
+            return Z
+    return np.ascontiguousarray(W), b, link
+
+
+def qda_scorer(model):
+    """Build the scoring function of a quadratic discriminant analysis
+
+    The projections of all the classes are stacked in a single matrix so that
+    the batch is projected with one product.
+
+    Returns:
+        a function mapping a 2D np.array to the predicted classes"""
+    projs = [np.asarray(R) * (np.asarray(S) ** (-0.5))
+             for R, S in szip(model.rotations_, model.scalings_)]
+    P = np.ascontiguousarray(np.hstack(projs))
+    offsets = np.hstack([np.dot(m, pr)
+                         for m, pr in szip(model.means_, projs)])
+    starts = np.cumsum([0] + [pr.shape[1] for pr in projs[:-1]])
+    u = np.asarray([np.sum(np.log(S)) for S in model.scalings_])
+    bias = -0.5 * u + np.log(model.priors_)
+    classes = np.asarray(model.classes_)
+
+    def score(X):
+        Z = X.dot(P) - offsets
+        norm2 = np.add.reduceat(Z * Z, starts, axis=1)
+        return classes[np.argmax(-0.5 * norm2 + bias, axis=1)]
+    return score
+
+
+def make_scorer(model, check_input=True):
+    """Build a numpy scoring function from the attributes of a fitted model
+
+    The coefficients are extracted once in contiguous arrays and a batch is
+    scored with a single matrix product followed by the link function.
+
+    Args:
+        model(sklearn.BaseEstimator): a fitted model (in SUPPORTED)
+        check_input(bool): if False, the inputs are not validated
+
+    Returns:
+        a function mapping a 2D np.array to the predictions or None if the
+        model is not linear (KernelRidge)"""
+    if isinstance(model, KernelRidge):
+        return None
+    elif isinstance(model, QuadraticDiscriminantAnalysis):
+        score = qda_scorer(model)
+        nb_features = np.asarray(model.means_).shape[1]
+    else:
+        W, b, link = linear_block(model)
+        nb_features = W.shape[0]
+
+        def score(X):
+            return link(X.dot(W) + b)
+
+    if not check_input:
+        return score
+
+    def checked_score(X):
+        X = np.asarray(X)
+        if X.dtype.kind not in 'fc':
+            X = X.astype('float64')
+        if X.ndim != 2 or X.shape[1] != nb_features:
+            raise ValueError('Expected a 2D array with {} features, got an '
+                             'array of shape {}'.format(nb_features, X.shape))
+        return score(X)
+    return checked_score
+
+
+def score_linear_models(models, X, chunk_rows=4096):
+    """Score several models on the same data with one product per chunk
+
+    The coefficients of the linear models are stacked in a single matrix so
+    that the data is read once for all the models. The other models are
+    scored with their `predict` method.
+
+    Args:
+        models(list): a list of fitted models (in SUPPORTED)
+        X(np.array): the data
+        chunk_rows(int): the number of rows scored at once
+
+    Returns:
+        the list of the predictions of the models"""
+    X = np.asarray(X)
+    blocks = [linear_block(m) for m in models]
+    linear = [i for i, block in enumerate(blocks) if block is not None]
+    preds = [None] * len(models)
+    for i, block in enumerate(blocks):
+        if block is None:
+            preds[i] = models[i].predict(X)
+
+    if len(linear) == 0:
+        return preds
+
+    W = np.ascontiguousarray(np.hstack([blocks[i][0] for i in linear]))
+    b = np.hstack([blocks[i][1] for i in linear])
+    bounds = np.cumsum([0] + [blocks[i][0].shape[1] for i in linear])
+    chunks = dict((i, []) for i in linear)
+    for start in range(0, len(X), chunk_rows):
+        Z = X[start:start + chunk_rows].dot(W) + b
+        for n, i in enumerate(linear):
+            link = blocks[i][2]
+            chunks[i].append(link(Z[:, bounds[n]:bounds[n + 1]]))
+    for i in linear:
+        preds[i] = np.concatenate(chunks[i])
+    return preds
+
+
+def get_predict_f(compiled, fast=False, check_input=True):
+    """Get the prediction function of a cached model
+
+    Args:
+        compiled(dict): the cache entry of the model, see `load_compiled`
+        fast(bool): if True, the numpy scoring function of the model is used
+            (see `make_scorer`). It is built once per cache entry.
+        check_input(bool): if False, the inputs of the numpy scoring function
+            are not validated
+
+    Returns:
+        a function mapping the inputs to the predictions"""
+    if not fast:
+        return compiled['model'].predict
+    scorers = compiled['scorers']
+    if check_input not in scorers:
+        scorer = make_scorer(compiled['model'], check_input)
+        if scorer is None:
+            scorer = compiled['model'].predict
+        scorers[check_input] = scorer
+    return scorers[check_input]
+
+
+def load_compiled(model, custom_objects=None):
+    """Get a model instance with its attributes loaded
+
+    The instances are cached in `COMPILED_MODELS` by model and data ids. The
+    attributes are loaded once, and again only if the parameters file is
+    modified: a new instance then replaces the cached one, so that the
+    predictions running with the previous one (in a `MicroBatcher` for
+    instance) are not altered.
+
+    Args:
+        model(dict): a serialized sklearn model with its ids and the path of
+            its parameters (only the ids if the model is already cached)
+        custom_objects(dict, optionnal): the serialized custom objects
+
+    Returns:
+        a dictionnary with the `model` instance and the `params_dump` path"""
+    key = (model['mod_id'], model.get('data_id'))
+    with _compiled_lock:
+        compiled = COMPILED_MODELS.get(key)
+        if compiled is None:
+            compiled = {'model_arch': copy.deepcopy(model['model_arch']),
+                        'params_dump': model['params_dump'],
+                        'mtime': None}
+        params_dump = model.get('params_dump') or compiled['params_dump']
+        mtime = os.path.getmtime(params_dump)
+        outdated = (compiled['params_dump'] != params_dump or
+                    compiled['mtime'] != mtime)
+        if outdated:
+            model_instance, _ = model_from_dict_w_opt(
+                compiled['model_arch'],
+                custom_objects=custom_objects)
+            load_params(model_instance, params_dump)
+            compiled = {'model': model_instance,
+                        'model_arch': compiled['model_arch'],
+                        'params_dump': params_dump,
+                        'mtime': mtime,
+                        'scorers': dict()}
+            COMPILED_MODELS[key] = compiled
+    return compiled
+
+
+def load_ref(mod_id, data_id, custom_objects=None):
+    """Get a model instance given its ids
+
+    Args:
+        mod_id(str): the id of the model
+        data_id(str): the id of the data the model was trained on
+        custom_objects(dict, optionnal): the serialized custom objects
+
+    Returns:
+        a model instance with its attributes loaded, see `load_compiled`"""
+    if (mod_id, data_id) in COMPILED_MODELS:
+        model = {'mod_id': mod_id, 'data_id': data_id}
+    else:
+        model = cm.get_model_ref(mod_id, data_id)
+    return load_compiled(model, custom_objects)
+
+
 @app.task(queue='sklearn')
 def predict(model, data, *args, **kwargs):
     """Make predictions given a model and data
 
+    With the keyword argument `fast`, the model is scored with numpy (see
+    `make_scorer`) and `check_input=False` skips the validation of the data.
+
     Args:
         model (dict) : a serialied sklearn model.
         data(list, dict, np.array): data to be passed as a dictionary mapping
@@ -571,32 +1442,67 @@ def predict(model, data, *args, **kwargs):
     Returns:
         an np.array of predictions
     """
-    custom_objects = kwargs.get('custom_objects')
+    fast = kwargs.get('fast', False)
+    compiled = load_compiled(model, kwargs.get('custom_objects'))
+    return get_predict_f(compiled, fast,
+                         kwargs.get('check_input', True))(data)
 
-    # check if the predict function is already compiled
-    m_id = model['mod_id']
-    if m_id in COMPILED_MODELS:  # pragma: no cover
-        model_instance = COMPILED_MODELS[m_id]['model']
-        # load the attributes
-        model_instance = load_params(model_instance, model['params_dump'])
 
-    else:
-        # get the model type
-        model_dict = model['model_arch']
+@app.task(queue='sklearn')
+def predict_ref(mod_id, data_id, data, *args, **kwargs):
+    """Make predictions given the ids of a trained model and data
 
-        # load model
-        model_instance, _ = model_from_dict_w_opt(
-            model_dict,
-            custom_objects=custom_objects)
+    Only the ids of the model are sent: the model is taken from the cache of
+    the worker or, on a miss, its architecture is read from the models
+    collection.
 
-        # load the attributes
-        model_instance = load_params(model_instance, model['params_dump'])
+    If the keyword argument `max_latency` is set, the concurrent requests of
+    the worker for the same model are coalesced (see
+    :meth:`alp.backend.common.MicroBatcher`), up to `max_batch_size` rows.
+    The keyword arguments `fast` and `check_input` are the ones of `predict`.
 
-        # write in the compiled list
-        COMPILED_MODELS[m_id] = dict()
-        COMPILED_MODELS[m_id]['model'] = model_instance
+    Args:
+        mod_id(str): the id of the model
+        data_id(str): the id of the data the model was trained on
+        data(list, dict, np.array): data to be passed as a dictionary mapping
+            inputs names to np.arrays or a list of arrays or an arrays
+
+    Returns:
+        the list of the predictions (the results of the tasks are serialized
+        in json)
+    """
+    fast = kwargs.get('fast', False)
+    compiled = load_ref(mod_id, data_id, kwargs.get('custom_objects'))
+    predict_f = get_predict_f(compiled, fast, kwargs.get('check_input', True))
+    if kwargs.get('max_latency') is None:
+        return np.asarray(predict_f(data)).tolist()
+
+    batcher = cm.get_batcher(compiled, predict_f,
+                             kwargs.get('max_batch_size') or 256,
+                             kwargs['max_latency'])
+    return batcher.predict(data).tolist()
 
-    # to be discussed
-    # data = data[0]['X']
 
-    return model_instance.predict(data)
+@app.task(queue='sklearn')
+def predict_stream(mod_id, data_id, stream, *args, **kwargs):
+    """Make predictions on all the batches of a data stream
+
+    The stream is read by the worker so that the shards of a dataset can be
+    evaluated in parallel by several workers.
+
+    Args:
+        mod_id(str): the id of the model
+        data_id(str): the id of the data the model was trained on
+        stream(str): a pickled data stream (see
+            :meth:`alp.appcom.utils.serialize_gen`)
+
+    Returns:
+        the list of the predictions
+    """
+    compiled = load_ref(mod_id, data_id, kwargs.get('custom_objects'))
+    stream = pickle.loads(stream.encode('raw_unicode_escape'))
+    preds = [compiled['model'].predict(inputs[0])
+             for inputs in cm.iter_stream_inputs(stream)]
+    if len(preds) == 0:
+        return []
+    return np.concatenate(preds).tolist()
@@ -1,3 +1,21 @@
+"""
+Model database
+==============
+
+The database engine is chosen with the `db_engine` key of the `alpdb.json`
+configuration file (or the `ALP_DB_ENGINE` environment variable):
+
+* `mongodb` (default): the models are stored in a MongoDB service.
+* `sqlite`: the models are stored in a local SQLite file, for single machine
+  deployments.
+
+Each engine implements the same functions: `get_models`, `get_generators`,
+`get_metrics`, `insert`, `update`, `report_metrics`, `insert_metrics`,
+`insert_trained`, `get_history`, `get_partial_metrics`, `find_best`,
+`find_trained` and `create_db`, and raises its `DuplicateKeyError` when a
+model is inserted twice without `upsert`.
+"""
+
 from __future__ import absolute_import
 from __future__ import print_function
 
@@ -20,6 +38,8 @@ _host_port = 27017
 _db_name = 'modelization'
 _models_collection = 'models'
 _generators_collection = 'generators'
+_metrics_collection = 'metrics'
+_sqlite_path = os.path.join(_alp_dir, 'alp.sqlite')
 
 if os.getenv("TEST_MODE") == "ON":  # pragma: no cover
     _host_adress = '127.0.0.1'
@@ -30,12 +50,17 @@ _config_path = os.path.expanduser(os.path.join(_alp_dir, 'alpdb.json'))
 if os.path.exists(_config_path):  # pragma: no cover
     _config = json.load(open(_config_path))
     _db_engine = _config.get('db_engine', 'mongodb')
-    assert _db_engine in {'mongodb'}
+    assert _db_engine in {'mongodb', 'sqlite'}
     _host_adress = _config.get('host_adress', 'mongo_m')
     _host_port = _config.get('host_port', 27017)
     _db_name = _config.get('db_name', 'modelization')
     _models_collection = _config.get('_models_collection', 'models')
     _generators_collection = _config.get('_generators_collection', 'models')
+    _metrics_collection = _config.get('metrics_collection', 'metrics')
+    _sqlite_path = _config.get('sqlite_path', _sqlite_path)
+
+if os.getenv("ALP_DB_ENGINE") is not None:  # pragma: no cover
+    _db_engine = os.getenv("ALP_DB_ENGINE")
 
 # save config file
 _config = {'db_engine': _db_engine,
@@ -43,13 +68,32 @@ _config = {'db_engine': _db_engine,
            'host_port': _host_port,
            'db_name': _db_name,
            'models_collection': _models_collection,
-           'generators_collection': _generators_collection}
+           'generators_collection': _generators_collection,
+           'metrics_collection': _metrics_collection,
+           'sqlite_path': _sqlite_path}
 
 with open(_config_path, 'w') as f:
     f.write(json.dumps(_config, indent=4))
 
+
+# shared by the engines
+def _metrics_steps(inserted_id, metrics):
+    """Build the documents of the metrics of a model, one per epoch"""
+    metrics = {k: v for k, v in metrics.items() if isinstance(v, list)}
+    nb_steps = max([len(v) for v in metrics.values()] + [0])
+    metrics_db = []
+    for step in range(nb_steps):
+        step_db = {k: v[step] for k, v in metrics.items() if step < len(v)}
+        step_db['model'] = inserted_id
+        step_db['step'] = step + 1
+        metrics_db.append(step_db)
+    return metrics_db
+
+
 # import backend
 if _db_engine == 'mongodb':
     from ..dbbackend.mongo_backend import *  # NOQA
+elif _db_engine == 'sqlite':
+    from ..dbbackend.sqlite_backend import *  # NOQA
 else:
     raise Exception('Unknown backend: ' + str(_db_engine))
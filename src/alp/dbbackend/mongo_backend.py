@@ -3,13 +3,18 @@ Model database setup
 ====================
 """
 
+from pymongo import ASCENDING
 from pymongo import DESCENDING
 from pymongo import MongoClient
 from pymongo import ReturnDocument
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError  # NOQA
 from ..dbbackend import _db_name
 from ..dbbackend import _generators_collection
 from ..dbbackend import _host_adress
 from ..dbbackend import _host_port
+from ..dbbackend import _metrics_collection
+from ..dbbackend import _metrics_steps
 from ..dbbackend import _models_collection
 
 
@@ -33,6 +38,16 @@ def get_generators():
     return modelization[_generators_collection]
 
 
+def get_metrics():
+    """Utility function to retrieve the collection of metrics
+
+    Returns:
+        the collection of metrics, one document per model and epoch"""
+    client = MongoClient(_host_adress, _host_port)
+    modelization = client[_db_name]
+    return modelization[_metrics_collection]
+
+
 def insert(full_json, collection, upsert=False):
     """Insert an observation in the db
 
@@ -69,12 +84,182 @@ def update(inserted_id, json_changes):
     return updated
 
 
+def report_metrics(inserted_id, step, metrics):
+    """Store the intermediate metrics of a model being trained
+
+    Args:
+        inserted_id(int): the id of the observation
+        step(int): the epoch (or chunk) of the metrics
+        metrics(dict): a dictionnary mapping metrics names to their last value
+
+    Returns:
+        True if the model was flagged as stopped, False otherwise"""
+    metrics_db = dict(metrics)
+    metrics_db['model'] = inserted_id
+    metrics_db['step'] = step
+    get_metrics().replace_one({'model': inserted_id, 'step': step},
+                              metrics_db, upsert=True)
+    model_db = get_models().find_one({'_id': inserted_id},
+                                     projection={'stopped': True})
+    return model_db is not None and model_db.get('stopped', 0) == 1
+
+
+def insert_metrics(inserted_id, metrics):
+    """Store the metrics of a trained model, one document per epoch (or chunk)
+
+    The metrics reported during the training are replaced.
+
+    Args:
+        inserted_id(int): the id of the observation
+        metrics(dict): a dictionnary mapping metrics names to lists of values
+    """
+    metrics_db = _metrics_steps(inserted_id, metrics)
+    collection = get_metrics()
+    collection.delete_many({'model': inserted_id})
+    if len(metrics_db) > 0:
+        collection.insert_many(metrics_db)
+
+
+def insert_trained(docs, metrics, upsert=False):
+    """Store several trained models and their metrics in bulk
+
+    Args:
+        docs(list): the documents of the models, with the mod_data_id key
+        metrics(list): for each model, a dictionnary mapping metrics names to
+            lists of values
+        upsert(bool): if True, the documents of the models already in the db
+            are updated
+
+    Returns:
+        the ids of the models in the db"""
+    models = get_models()
+    if upsert is True:
+        models.bulk_write([UpdateOne({'mod_data_id': d['mod_data_id']},
+                                     {'$set': d}, upsert=True)
+                           for d in docs])
+        models_db = models.find({'mod_data_id': {'$in': [d['mod_data_id']
+                                                         for d in docs]}},
+                                projection={'mod_data_id': True})
+        ids = {m['mod_data_id']: m['_id'] for m in models_db}
+        inserted_ids = [ids[d['mod_data_id']] for d in docs]
+    else:
+        inserted_ids = models.insert_many(docs).inserted_ids
+    metrics_db = []
+    for inserted_id, m in zip(inserted_ids, metrics):
+        metrics_db += _metrics_steps(inserted_id, m)
+    collection = get_metrics()
+    collection.delete_many({'model': {'$in': list(inserted_ids)}})
+    if len(metrics_db) > 0:
+        collection.insert_many(metrics_db)
+    return inserted_ids
+
+
+def _histories(inserted_ids):
+    """Rebuild the histories of the metrics of some models
+
+    Args:
+        inserted_ids(list): the ids of the observations
+
+    Returns:
+        a dictionnary mapping the ids to dictionnaries mapping metrics names
+        to lists of values"""
+    histories = {i: dict() for i in inserted_ids}
+    metrics_db = get_metrics().find({'model': {'$in': list(inserted_ids)}})
+    for step_db in metrics_db.sort('step', ASCENDING):
+        history = histories[step_db['model']]
+        for k, v in step_db.items():
+            if k not in ('_id', 'model', 'step'):
+                history.setdefault(k, []).append(v)
+    return histories
+
+
+def get_history(inserted_id):
+    """Get the metrics of a model, epoch by epoch
+
+    Args:
+        inserted_id(int): the id of the observation
+
+    Returns:
+        a dictionnary mapping metrics names to lists of values"""
+    return _histories([inserted_id])[inserted_id]
+
+
+def get_partial_metrics(task_ids):
+    """Get the intermediate metrics of the models trained by some tasks
+
+    Args:
+        task_ids(list): the ids of the tasks
+
+    Returns:
+        a dictionnary mapping the tasks ids to their intermediate metrics"""
+    models_db = get_models().find({'task_id': {'$in': list(task_ids)}},
+                                  projection={'task_id': True})
+    tasks = {m['_id']: m['task_id'] for m in models_db}
+    histories = _histories(list(tasks))
+    return {tasks[i]: h for i, h in histories.items()}
+
+
+def find_best(data_id, metric='val_loss', k=1, ascending=True):
+    """Find the best models trained on some data
+
+    The query is served by the indexes created by `create_db` for the `loss`
+    and `val_loss` metrics.
+
+    Args:
+        data_id(str): the id of the data
+        metric(str): the name of the metric stored in the models documents
+        k(int): the number of models to return
+        ascending(bool): if True the lowest values are the best
+
+    Returns:
+        a list of the documents of the k best models"""
+    direction = ASCENDING if ascending else DESCENDING
+    filter_db = {'data_id': data_id,
+                 'trained': 1,
+                 metric: {'$gt': float('-inf')}}
+    models_db = get_models().find(filter_db).sort(metric, direction)
+    return list(models_db.limit(k))
+
+
+def find_trained(backend_name=None, since=None):
+    """Find the trained models, the most recent first
+
+    Args:
+        backend_name(str, optionnal): the name of the backend of the models
+        since(datetime, optionnal): the models must be created after this date
+
+    Returns:
+        a list of the documents of the models"""
+    filter_db = {'trained': 1}
+    if backend_name is not None:
+        filter_db['backend_name'] = backend_name
+    if since is not None:
+        filter_db['datetime'] = {'$gte': since}
+    return list(get_models().find(filter_db).sort('datetime', DESCENDING))
+
+
 def create_db(drop=True):
-    """Delete (and optionnaly drop) the modelization database and collection"""
+    """Delete (and optionnaly drop) the modelization database and collection
+
+    The indexes used to query the models and their metrics are created."""
     client = MongoClient(_host_adress, _host_port)
     modelization = client[_db_name]
     if drop:
         modelization.drop_collection(_models_collection)
-    models = modelization['models']
+        modelization.drop_collection(_metrics_collection)
+    models = modelization[_models_collection]
+    models.create_index([('task_id', ASCENDING)])
+    for metric in ['loss', 'val_loss']:
+        models.create_index([('data_id', ASCENDING),
+                             ('trained', ASCENDING),
+                             (metric, ASCENDING)])
+    models.create_index([('backend_name', ASCENDING),
+                         ('trained', ASCENDING),
+                         ('datetime', DESCENDING)])
+    models.create_index([('trained', ASCENDING),
+                         ('datetime', DESCENDING)])
+    metrics = modelization[_metrics_collection]
+    metrics.create_index([('model', ASCENDING), ('step', ASCENDING)],
+                         unique=True)
     return models.create_index([('mod_data_id', DESCENDING)],
                                unique=True)
@@ -0,0 +1,554 @@
+"""
+Local model database
+====================
+
+An embedded alternative to the MongoDB backend for single machine
+deployments. The documents are stored as JSON in SQLite tables (in WAL mode)
+and the fields used by the queries are copied in indexed columns.
+
+Only the subset of the MongoDB query language used by ALP is supported:
+equality, `$in`, `$ne`, `$gt`, `$gte`, `$lt`, `$lte` and `$exists` in the
+filters, `$set` and `$unset` in the updates.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from ..dbbackend import _metrics_steps
+from ..dbbackend import _sqlite_path
+
+# the tables do not depend on the names of the MongoDB collections
+_models_collection = 'models'
+_generators_collection = 'generators'
+_metrics_collection = 'metrics'
+
+# fields copied in indexed columns, for each collection
+_COLUMNS = {_models_collection: ['mod_data_id', 'mod_id', 'data_id',
+                                 'task_id', 'backend_name', 'trained',
+                                 'loss', 'val_loss', 'datetime'],
+            _generators_collection: ['mod_data_id', 'data_id'],
+            _metrics_collection: ['model', 'step']}
+
+_UNIQUE = {_models_collection: ['mod_data_id'],
+           _generators_collection: [],
+           _metrics_collection: ['model', 'step']}
+
+_INDEXES = {_models_collection: [['task_id'],
+                                 ['mod_id', 'data_id'],
+                                 ['data_id', 'trained', 'loss'],
+                                 ['data_id', 'trained', 'val_loss'],
+                                 ['backend_name', 'trained', 'datetime'],
+                                 ['trained', 'datetime']],
+            _generators_collection: [['mod_data_id']],
+            _metrics_collection: []}
+
+_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# raised when a unique column is duplicated, as pymongo's DuplicateKeyError
+DuplicateKeyError = sqlite3.IntegrityError
+
+_local = threading.local()
+
+
+def _default(obj):
+    """Serialize the objects json does not know"""
+    if isinstance(obj, datetime):
+        return {'$date': obj.strftime(_DATE_FORMAT)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+
+def _object_hook(obj):
+    if len(obj) == 1 and '$date' in obj:
+        return datetime.strptime(obj['$date'], _DATE_FORMAT)
+    return obj
+
+
+def _to_column(value):
+    """Convert a value to the type stored in the indexed columns"""
+    if isinstance(value, datetime):
+        return value.strftime(_DATE_FORMAT)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=_default, sort_keys=True)
+    return value
+
+
+def _connect():
+    """Get the connection of the current thread to the database
+
+    The connections are not shared with the processes forked after their
+    creation (by a local executor for instance)."""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = dict()
+    key = (_sqlite_path, os.getpid())
+    if key not in connections:
+        conn = sqlite3.connect(_sqlite_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for name in _COLUMNS:
+            _create_table(conn, name)
+        connections[key] = conn
+    return connections[key]
+
+
+def _create_table(conn, name):
+    """Create a table and its indexes if they do not exist"""
+    columns = ', '.join(['"{}"'.format(c) for c in _COLUMNS[name]])
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS "{}" ('
+                     '_id INTEGER PRIMARY KEY AUTOINCREMENT, {}, '
+                     'doc TEXT)'.format(name, columns))
+        indexes = [(index, '') for index in _INDEXES[name]]
+        if len(_UNIQUE[name]) > 0:
+            indexes.append((_UNIQUE[name], 'UNIQUE '))
+        for index, unique in indexes:
+            conn.execute('CREATE {}INDEX IF NOT EXISTS "{}" ON "{}" '
+                         '({})'.format(unique, '_'.join([name] + index), name,
+                                       ', '.join(['"{}"'.format(c)
+                                                  for c in index])))
+
+
+def _get_field(doc, key):
+    """Get a (possibly dotted) field of a document"""
+    for k in key.split('.'):
+        if not isinstance(doc, dict) or k not in doc:
+            return None, False
+        doc = doc[k]
+    return doc, True
+
+
+def _match(doc, filter_db):
+    """Check if a document matches a filter"""
+    for key, cond in filter_db.items():
+        value, exists = _get_field(doc, key)
+        if isinstance(cond, dict) and any(k[:1] == '$' for k in cond):
+            for op, arg in cond.items():
+                if op == '$exists':
+                    ok = exists == bool(arg)
+                elif op == '$in':
+                    ok = exists and value in arg
+                elif op == '$ne':
+                    ok = value != arg
+                elif not exists or value is None:
+                    ok = False
+                elif op == '$gt':
+                    ok = value > arg
+                elif op == '$gte':
+                    ok = value >= arg
+                elif op == '$lt':
+                    ok = value < arg
+                elif op == '$lte':
+                    ok = value <= arg
+                else:
+                    raise NotImplementedError('Unsupported operator: ' + op)
+                if not ok:
+                    return False
+        elif not exists or value != cond:
+            return False
+    return True
+
+
+_SQL_OPS = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+
+def _where(name, filter_db):
+    """Translate the part of a filter on indexed columns to SQL
+
+    Returns:
+        the SQL condition, its parameters and True if the whole filter was
+        translated"""
+    clauses = []
+    params = []
+    complete = True
+    for key, cond in filter_db.items():
+        if key != '_id' and key not in _COLUMNS[name]:
+            complete = False
+            continue
+        if isinstance(cond, dict) and any(k[:1] == '$' for k in cond):
+            for op, arg in cond.items():
+                if op in _SQL_OPS:
+                    clauses.append('"{}" {} ?'.format(key, _SQL_OPS[op]))
+                    params.append(_to_column(arg))
+                elif op == '$in':
+                    arg = list(arg)
+                    clauses.append('"{}" IN ({})'.format(
+                        key, ', '.join(['?'] * len(arg))))
+                    params.extend([_to_column(a) for a in arg])
+                else:
+                    complete = False
+        else:
+            clauses.append('"{}" = ?'.format(key))
+            params.append(_to_column(cond))
+    if len(clauses) == 0:
+        return '', params, complete
+    return ' WHERE ' + ' AND '.join(clauses), params, complete
+
+
+class Collection(object):
+    """A collection of documents stored in a SQLite table
+
+    Implements the part of the pymongo collection interface used by ALP.
+
+    Args:
+        name(str): the name of the table
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def _load(self, row):
+        doc = json.loads(row[1], object_hook=_object_hook)
+        doc['_id'] = row[0]
+        return doc
+
+    def find(self, filter_db=None, projection=None, sort=None, limit=0):
+        """Find the documents matching a filter
+
+        Args:
+            filter_db(dict): the filter
+            projection(dict): not used, the full documents are returned
+            sort(list): a list of (key, direction) tuples
+            limit(int): the maximum number of documents (0 for no limit)
+
+        Returns:
+            a list of documents"""
+        if filter_db is None:
+            filter_db = dict()
+        where, params, complete = _where(self.name, filter_db)
+        query = 'SELECT _id, doc FROM "{}"'.format(self.name) + where
+        sort = sort or []
+        sql_sort = all(k == '_id' or k in _COLUMNS[self.name]
+                       for k, _ in sort)
+        if sql_sort and len(sort) > 0:
+            query += ' ORDER BY ' + ', '.join(
+                ['"{}" {}'.format(k, 'ASC' if d > 0 else 'DESC')
+                 for k, d in sort])
+        if sql_sort and complete and limit > 0:
+            query += ' LIMIT {:d}'.format(limit)
+        rows = _connect().execute(query, params).fetchall()
+        docs = [self._load(r) for r in rows]
+        docs = [d for d in docs if _match(d, filter_db)]
+        if not sql_sort:
+            for k, d in reversed(sort):
+                docs.sort(key=lambda doc: _get_field(doc, k)[0],
+                          reverse=d < 0)
+        if limit > 0:
+            docs = docs[:limit]
+        return docs
+
+    def find_one(self, filter_db=None, projection=None):
+        """Find the first document matching a filter
+
+        Returns:
+            a document or None"""
+        docs = self.find(filter_db, limit=1)
+        if len(docs) == 0:
+            return None
+        return docs[0]
+
+    def _write(self, conn, doc, doc_id=None):
+        doc = dict(doc)
+        doc.pop('_id', None)
+        columns = _COLUMNS[self.name]
+        values = [_to_column(_get_field(doc, c)[0]) for c in columns]
+        values.append(json.dumps(doc, default=_default))
+        if doc_id is None:
+            query = 'INSERT INTO "{}" ({}, doc) VALUES ({})'.format(
+                self.name, ', '.join(['"{}"'.format(c) for c in columns]),
+                ', '.join(['?'] * (len(columns) + 1)))
+            return conn.execute(query, values).lastrowid
+        query = 'UPDATE "{}" SET {}, doc = ? WHERE _id = ?'.format(
+            self.name, ', '.join(['"{}" = ?'.format(c) for c in columns]))
+        conn.execute(query, values + [doc_id])
+        return doc_id
+
+    def insert_one(self, doc):
+        """Insert a document
+
+        Returns:
+            the id of the inserted document"""
+        conn = _connect()
+        with conn:
+            inserted_id = self._write(conn, doc)
+        doc['_id'] = inserted_id
+        return inserted_id
+
+    def insert_many(self, docs):
+        """Insert several documents in one transaction
+
+        Returns:
+            the ids of the inserted documents"""
+        conn = _connect()
+        with conn:
+            inserted_ids = [self._write(conn, doc) for doc in docs]
+        for doc, inserted_id in zip(docs, inserted_ids):
+            doc['_id'] = inserted_id
+        return inserted_ids
+
+    def update_one(self, filter_db, json_changes, upsert=False):
+        """Update the first document matching a filter
+
+        Returns:
+            the id of the updated document or None"""
+        doc = self.find_one(filter_db)
+        if doc is None and not upsert:
+            return None
+        if doc is None:
+            doc = {k: v for k, v in filter_db.items()
+                   if not isinstance(v, dict)}
+        doc_id = doc.pop('_id', None)
+        for op, changes in json_changes.items():
+            for key, value in changes.items():
+                keys = key.split('.')
+                sub = doc
+                for k in keys[:-1]:
+                    sub = sub.setdefault(k, dict())
+                if op == '$set':
+                    sub[keys[-1]] = value
+                elif op == '$unset':
+                    sub.pop(keys[-1], None)
+                else:
+                    raise NotImplementedError('Unsupported update: ' + op)
+        conn = _connect()
+        with conn:
+            return self._write(conn, doc, doc_id)
+
+    def delete_many(self, filter_db):
+        """Delete the documents matching a filter"""
+        ids = [(d['_id'],) for d in self.find(filter_db)]
+        conn = _connect()
+        with conn:
+            conn.executemany('DELETE FROM "{}" WHERE _id = ?'.format(
+                self.name), ids)
+        return len(ids)
+
+
+def get_models():
+    """Utility function to retrieve the collection of models
+
+    Returns:
+        the collection of models"""
+    return Collection(_models_collection)
+
+
+def get_generators():
+    """Utility function to retrieve the collection of generators
+
+    Returns:
+        the collection of generators"""
+    return Collection(_generators_collection)
+
+
+def get_metrics():
+    """Utility function to retrieve the collection of metrics
+
+    Returns:
+        the collection of metrics, one document per model and epoch"""
+    return Collection(_metrics_collection)
+
+
+def insert(full_json, collection, upsert=False):
+    """Insert an observation in the db
+
+    Args:
+        full_json(dict): a dictionnary mapping variable names to
+            carateristics of object. This dictionnary must have the
+            mod_data_id key.
+
+    Returns:
+        the id of the inserted object in the db"""
+    filter_db = dict()
+    filter_db['mod_data_id'] = full_json['mod_data_id']
+    if upsert is True:
+        return collection.update_one(filter_db, {'$set': full_json},
+                                     upsert=upsert)
+    return collection.insert_one(full_json)
+
+
+def update(inserted_id, json_changes):
+    """Update an observation in the db
+
+    Args:
+        insert_id(int): the id of the observation
+        json_changes(dict): the changes to do in the db"""
+    return get_models().update_one(inserted_id, json_changes)
+
+
+def report_metrics(inserted_id, step, metrics):
+    """Store the intermediate metrics of a model being trained
+
+    Args:
+        inserted_id(int): the id of the observation
+        step(int): the epoch (or chunk) of the metrics
+        metrics(dict): a dictionnary mapping metrics names to their last value
+
+    Returns:
+        True if the model was flagged as stopped, False otherwise"""
+    metrics_db = dict(metrics)
+    metrics_db['model'] = inserted_id
+    metrics_db['step'] = step
+    collection = get_metrics()
+    collection.delete_many({'model': inserted_id, 'step': step})
+    collection.insert_one(metrics_db)
+    model_db = get_models().find_one({'_id': inserted_id})
+    return model_db is not None and model_db.get('stopped', 0) == 1
+
+
+def insert_metrics(inserted_id, metrics):
+    """Store the metrics of a trained model, one document per epoch (or chunk)
+
+    The metrics reported during the training are replaced.
+
+    Args:
+        inserted_id(int): the id of the observation
+        metrics(dict): a dictionnary mapping metrics names to lists of values
+    """
+    metrics_db = _metrics_steps(inserted_id, metrics)
+    collection = get_metrics()
+    collection.delete_many({'model': inserted_id})
+    collection.insert_many(metrics_db)
+
+
+def insert_trained(docs, metrics, upsert=False):
+    """Store several trained models and their metrics in one transaction
+
+    Args:
+        docs(list): the documents of the models, with the mod_data_id key
+        metrics(list): for each model, a dictionnary mapping metrics names to
+            lists of values
+        upsert(bool): if True, the documents of the models already in the db
+            are updated
+
+    Returns:
+        the ids of the models in the db"""
+    models = get_models()
+    metrics_collection = get_metrics()
+    inserted_ids = []
+    conn = _connect()
+    with conn:
+        for doc in docs:
+            doc_id = None
+            model_db = None
+            if upsert is True:
+                filter_db = {'mod_data_id': doc['mod_data_id']}
+                model_db = models.find_one(filter_db)
+            if model_db is not None:
+                model_db.update(doc)
+                doc_id = model_db.pop('_id')
+                doc = model_db
+            inserted_ids.append(models._write(conn, doc, doc_id))
+        conn.executemany('DELETE FROM "{}" WHERE model = ?'.format(
+            metrics_collection.name), [(i,) for i in inserted_ids])
+        for inserted_id, m in zip(inserted_ids, metrics):
+            for step_db in _metrics_steps(inserted_id, m):
+                metrics_collection._write(conn, step_db)
+    for doc, inserted_id in zip(docs, inserted_ids):
+        doc['_id'] = inserted_id
+    return inserted_ids
+
+
+def _histories(inserted_ids):
+    """Rebuild the histories of the metrics of some models
+
+    Args:
+        inserted_ids(list): the ids of the observations
+
+    Returns:
+        a dictionnary mapping the ids to dictionnaries mapping metrics names
+        to lists of values"""
+    histories = {i: dict() for i in inserted_ids}
+    metrics_db = get_metrics().find({'model': {'$in': list(inserted_ids)}},
+                                    sort=[('model', 1), ('step', 1)])
+    for step_db in metrics_db:
+        history = histories[step_db['model']]
+        for k, v in step_db.items():
+            if k not in ('_id', 'model', 'step'):
+                history.setdefault(k, []).append(v)
+    return histories
+
+
+def get_history(inserted_id):
+    """Get the metrics of a model, epoch by epoch
+
+    Args:
+        inserted_id(int): the id of the observation
+
+    Returns:
+        a dictionnary mapping metrics names to lists of values"""
+    return _histories([inserted_id])[inserted_id]
+
+
+def get_partial_metrics(task_ids):
+    """Get the intermediate metrics of the models trained by some tasks
+
+    Args:
+        task_ids(list): the ids of the tasks
+
+    Returns:
+        a dictionnary mapping the tasks ids to their intermediate metrics"""
+    models_db = get_models().find({'task_id': {'$in': list(task_ids)}})
+    tasks = {m['_id']: m['task_id'] for m in models_db}
+    histories = _histories(list(tasks))
+    return {tasks[i]: h for i, h in histories.items()}
+
+
+def find_best(data_id, metric='val_loss', k=1, ascending=True):
+    """Find the best models trained on some data
+
+    The query is served by the indexes created for the `loss` and `val_loss`
+    metrics.
+
+    Args:
+        data_id(str): the id of the data
+        metric(str): the name of the metric stored in the models documents
+        k(int): the number of models to return
+        ascending(bool): if True the lowest values are the best
+
+    Returns:
+        a list of the documents of the k best models"""
+    filter_db = {'data_id': data_id,
+                 'trained': 1,
+                 metric: {'$gt': float('-inf')}}
+    return get_models().find(filter_db, sort=[(metric, 1 if ascending else -1)],
+                             limit=k)
+
+
+def find_trained(backend_name=None, since=None):
+    """Find the trained models, the most recent first
+
+    Args:
+        backend_name(str, optionnal): the name of the backend of the models
+        since(datetime, optionnal): the models must be created after this date
+
+    Returns:
+        a list of the documents of the models"""
+    filter_db = {'trained': 1}
+    if backend_name is not None:
+        filter_db['backend_name'] = backend_name
+    if since is not None:
+        filter_db['datetime'] = {'$gte': since}
+    return get_models().find(filter_db, sort=[('datetime', -1)])
+
+
+def create_db(drop=True):
+    """Delete (and optionnaly drop) the modelization database and collection
+
+    The tables and their indexes are created."""
+    conn = _connect()
+    if drop:
+        with conn:
+            for name in [_models_collection, _metrics_collection]:
+                conn.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+    for name in _COLUMNS:
+        _create_table(conn, name)
+    return '_'.join([_models_collection] + _UNIQUE[_models_collection])
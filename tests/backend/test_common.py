@@ -1,5 +1,38 @@
+from datetime import datetime
+
+import h5py
+import numpy as np
 import pytest
+from alp.appcom.utils import GroupResult
+from alp.appcom.utils import MemmapCache
+from alp.appcom.utils import PackSizer
+from alp.appcom.utils import PredictionCache
+from alp.appcom.utils import PredictionResult
 from alp.appcom.utils import imports
+from alp.appcom.utils import run_threads
+from alp.appcom.utils import write_h5_dataset
+from alp.backend import common as cm
+from alp.backend.common import clean_model
+from alp.backend.common import create_arch_hash
+from alp.backend.common import create_gen_hash
+from alp.backend.common import MicroBatcher
+from alp.backend.common import make_all_hash
+from alp.backend.common import Prefetcher
+from alp.backend.common import PrefetchedStream
+from alp.backend.common import transform_gen
+
+
+@pytest.fixture
+def sqlite_db(tmpdir, monkeypatch):
+    from alp import dbbackend as db
+    from alp.dbbackend import sqlite_backend as sqb
+    monkeypatch.setattr(sqb, '_sqlite_path', str(tmpdir.join('alp.sqlite')))
+    for name in ['get_models', 'get_metrics', 'insert', 'update',
+                 'insert_metrics', 'insert_trained', 'get_history',
+                 'report_metrics', 'DuplicateKeyError']:
+        monkeypatch.setattr(db, name, getattr(sqb, name))
+    sqb.create_db()
+    return sqb
 
 
 def test_imports():
@@ -18,5 +51,361 @@ def test_imports():
     assert ones_check().sum() == 1
 
 
+def test_clean_model():
+    model = {'model_arch': {'config': {'layers': []},
+                            'metrics': ['accuracy'],
+                            'ser_metrics': []},
+             'mod_id': None}
+    model_c = clean_model(model)
+    assert sorted(model_c['model_arch']) == ['config']
+    assert model_c['model_arch']['config'] is model['model_arch']['config']
+    assert model['model_arch']['metrics'] == ['accuracy']
+
+
+def test_arch_hash():
+    arch = {'config': {'a': 1, 'b': [1, 2]}, 'class_name': 'Model'}
+    arch_r = {'class_name': 'Model', 'config': {'b': [1, 2], 'a': 1}}
+    assert create_arch_hash(arch) == create_arch_hash(arch_r)
+    hexdi_m, params_dump = make_all_hash({'model_arch': arch}, 32, 'd', '/t')
+    model = {'model_arch': None, 'arch_hash': create_arch_hash(arch)}
+    assert make_all_hash(model, 32, 'd', '/t') == (hexdi_m, params_dump)
+    assert make_all_hash(model, 64, 'd', '/t')[0] != hexdi_m
+
+
+class DummyDataset(object):
+    def __init__(self, path, which_sets):
+        self.path = path
+        self.which_sets = which_sets
+        with open(path) as f:
+            self._header = f.read(4)
+
+
+class DummyStream(object):
+    def __init__(self, dataset, batch_size):
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+
+def test_gen_hash(tmpdir):
+    path = str(tmpdir.join('data.h5'))
+    with open(path, 'w') as f:
+        f.write('data')
+    gen_hash = create_gen_hash([DummyStream(DummyDataset(path, ['train']), 2)])
+    assert gen_hash == create_gen_hash(
+        [DummyStream(DummyDataset(path, ['train']), 2)])
+    assert gen_hash != create_gen_hash(
+        [DummyStream(DummyDataset(path, ['train']), 3)])
+    assert gen_hash != create_gen_hash(
+        [DummyStream(DummyDataset(path, ['test']), 2)])
+    with open(path, 'a') as f:
+        f.write('more data')
+    assert gen_hash != create_gen_hash(
+        [DummyStream(DummyDataset(path, ['train']), 2)])
+
+    rng = np.random.RandomState(0)
+    rng_hash = create_gen_hash([rng])
+    assert rng_hash == create_gen_hash([np.random.RandomState(0)])
+    rng.rand()
+    assert rng_hash != create_gen_hash([rng])
+
+    # the state of a python generator is unknown
+    gen = iter(range(3))
+    with pytest.warns(UserWarning):
+        assert create_gen_hash([gen]) != create_gen_hash([iter(range(3))])
+
+
+class DummyEpochStream(object):
+    sources = ('input_X', 'output_y')
+
+    def get_epoch_iterator(self):
+        return iter([(i, i) for i in range(5)])
+
+
+def test_prefetcher():
+    prefetcher = Prefetcher(iter(range(10)), depth=3)
+    assert list(prefetcher) == list(range(10))
+    assert list(prefetcher) == []
+    assert prefetcher.stats()['nb_items'] == 10
+
+    def failing():
+        yield 1
+        raise ValueError('failing')
+
+    prefetcher = Prefetcher(failing())
+    assert next(prefetcher) == 1
+    with pytest.raises(ValueError):
+        next(prefetcher)
+
+    # closed before the end of the iterator: does not block
+    prefetcher = Prefetcher(iter(range(10)), depth=1)
+    assert next(prefetcher) == 0
+    prefetcher.close()
+    assert len(list(prefetcher)) <= 2
+
+    stream = PrefetchedStream(DummyEpochStream(), depth=2)
+    assert stream.sources == DummyEpochStream.sources
+    for _ in range(2):
+        assert list(stream.get_epoch_iterator()) == [(i, i) for i in range(5)]
+    assert cm.close_prefetchers([None, stream, prefetcher]) == [stream,
+                                                                prefetcher]
+    assert stream.stats()['nb_items'] == 10
+
+
+class DummyFuelDataset(object):
+    def open(self):
+        pass
+
+
+class DummyFuelStream(object):
+    sources = ('input_a_list', 'output_y_list', 'index', 'input_b_list')
+    dataset = DummyFuelDataset()
+
+    def get_epoch_iterator(self):
+        return iter([(0, 1, 2, 3), (4, 5, 6, 7)])
+
+
+def test_transform_gen():
+    gen = transform_gen(DummyFuelStream(), 'Model')
+    assert next(gen) == ([0, 3], [1])
+    assert next(gen) == ([4, 7], [5])
+    assert next(gen) == ([0, 3], [1])
+
+
+def test_write_h5_dataset(tmpdir):
+    arr = np.arange(50, dtype='float32').reshape((25, 2))
+    blocks = (arr[i:i + 10] for i in range(0, 25, 10))
+    with h5py.File(str(tmpdir.join('data.hdf5')), mode='w') as f:
+        jobs = [lambda: write_h5_dataset(f, 'array', arr, chunk_rows=8),
+                lambda: write_h5_dataset(f, 'blocks', blocks, chunk_rows=8,
+                                         compression='gzip')]
+        run_threads(jobs, nb_threads=2)
+        for name in ['array', 'blocks']:
+            assert f[name].chunks == (8, 2)
+            assert np.array_equal(f[name][...], arr)
+        assert f['blocks'].compression == 'gzip'
+        with pytest.raises(ValueError):
+            run_threads([lambda: write_h5_dataset(f, 'empty', iter([]))], 2)
+
+
+class DummyAsyncResult(object):
+    id = 'task'
+    state = 'SUCCESS'
+
+    def ready(self):
+        return True
+
+    def get(self, *args, **kwargs):
+        return [[1., 2.], [3., 4.]]
+
+
+def test_prediction_result():
+    res = PredictionResult(DummyAsyncResult())
+    assert res.ready() and res.id == 'task' and res.state == 'SUCCESS'
+    preds = res.wait()
+    assert isinstance(preds, np.ndarray)
+    assert preds.shape == (2, 2)
+
+
+def test_group_result():
+    task = DummyAsyncResult()
+    task.state = 'PROGRESS'
+    task.info = {'step': 1, 'mod_data_id': 'b'}
+    task.wait = task.get
+    first, second = GroupResult(task, 0, 'a'), GroupResult(task, 1, 'b')
+    assert first.state == 'STARTED' and first.info is None
+    assert second.state == 'PROGRESS' and second.info['step'] == 1
+    assert second.id == 'task' and second.wait() == [3., 4.]
+
+
+class DummyTask(object):
+    class request(object):
+        id = 'task'
+
+    def __init__(self):
+        self.states = []
+
+    def update_state(self, state, meta):
+        assert state == 'PROGRESS'
+        self.states.append(dict(meta))
+
+
+def test_training_monitor(monkeypatch):
+    from alp import dbbackend as db
+    monkeypatch.setattr(db, 'report_metrics', lambda *args: False)
+    task = DummyTask()
+    monitor = cm.TrainingMonitor('id', task=task, min_interval=60,
+                                 mod_data_id='moddata')
+    for loss in [3., 2., 1.]:
+        assert not monitor.report({'loss': loss, 'layers': [1, 2]})
+    # throttled
+    assert [meta['step'] for meta in task.states] == [1]
+    monitor.flush()
+    assert [meta['step'] for meta in task.states] == [1, 3]
+    assert task.states[-1]['metrics'] == {'loss': 1.}
+    assert task.states[-1]['steps'] == [(2, {'loss': 2.}), (3, {'loss': 1.})]
+    assert task.states[-1]['mod_data_id'] == 'moddata'
+    monitor.flush()
+    assert len(task.states) == 2
+
+    # the last step is published when the training fails
+    def failing(*args, **kwargs):
+        kwargs['monitor'].report({'loss': 0.5})
+        raise ValueError('failing')
+
+    with pytest.raises(ValueError):
+        cm.train_pipe(failing, None, {'model_arch': None}, [], [], False,
+                      None, 'params', 'data', 'model', monitor=monitor)
+    assert task.states[-1]['step'] == 4
+
+
+def test_micro_batcher():
+    import threading
+
+    batcher = MicroBatcher(lambda X: X.sum(axis=1), max_batch_size=100,
+                           max_latency=0.2)
+    results = dict()
+
+    def request(i):
+        results[i] = batcher.predict(np.full((i + 1, 2), i))
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i in range(5):
+        assert results[i].tolist() == [2 * i] * (i + 1)
+    assert batcher.nb_requests == 5
+    assert batcher.nb_batches < 5
+
+    def failing(X):
+        raise ValueError('failing')
+
+    with pytest.raises(ValueError):
+        MicroBatcher(failing).predict(np.ones((2, 3)))
+
+
+def test_prediction_cache(tmpdir):
+    cache = PredictionCache(max_bytes=160)
+    preds = np.arange(10, dtype='float64')
+    assert cache.get(('m', 'd', 'a')) is None
+    cache.put(('m', 'd', 'a'), preds)
+    cache.put(('m', 'd', 'b'), preds)
+    cached = cache.get(('m', 'd', 'a'))
+    assert np.array_equal(cached, preds) and not cached.flags.writeable
+    preds[0] = 1.
+    assert cache.get(('m', 'd', 'a'))[0] == 0.
+    cache.put(('m', 'd', 'c'), preds)
+    assert ('m', 'd', 'b') not in cache
+    assert len(cache) == 2 and cache.nbytes == 160
+    assert cache.stats()['hits'] == 2 and cache.stats()['misses'] == 1
+
+    params_dump = str(tmpdir.join('model.h5'))
+    cache = PredictionCache(on_disk=True, max_disk_bytes=250)
+    cache.put(('m', 'd', 'a'), preds, params_dump)
+    cache = PredictionCache(on_disk=True, max_disk_bytes=250)
+    cached = cache.get(('m', 'd', 'a'), params_dump)
+    assert np.array_equal(cached, preds) and not cached.flags.writeable
+    assert cache.stats()['hits'] == 1
+    # the disk tier is bounded too
+    cache.put(('m', 'd', 'b'), preds, params_dump)
+    assert len(tmpdir.join('predictions').listdir()) == 1
+
+
+def test_memmap_cache(tmpdir):
+    cache = MemmapCache(str(tmpdir.join('cache')), max_bytes=250)
+    array = np.arange(10, dtype='float64')
+    assert cache.get('a') is None
+    assert np.array_equal(cache.put('a', array), array)
+    assert isinstance(cache.get('a'), np.memmap)
+    cache.put('b', array)
+    assert cache.get('a') is None
+    assert np.array_equal(cache.get('b'), array)
+    assert cache.stats()['hits'] == 2
+    # larger than the cache: returned but not kept
+    large = np.arange(40, dtype='float64')
+    assert cache.put('c', large) is large
+    assert cache.get('c') is None and cache.get('b') is not None
+
+
+def test_pack_sizer():
+    sizer = PackSizer(target_time=1., max_size=50, first_size=3)
+    assert sizer.size() == 3
+    sizer.update([{'fit_time': 0.1}, {'fit_time': 0.3}])
+    assert sizer.size() == 5
+    sizer.update([{'fit_time': 0.001}, {}])
+    assert sizer.fit_time == 0.1005 and sizer.size() == 9
+    for _ in range(3):
+        sizer.update([{'fit_time': 1e-6}])
+    assert sizer.size() == 50
+    sizer.update([{'fit_time': 10.}] * 2)
+    assert sizer.size() == 1
+
+
+def test_claim_models(sqlite_db, tmpdir):
+    params_dump = str(tmpdir.join('params.h5'))
+    doc = {'mod_data_id': 'moddata', 'mod_id': 'mod', 'data_id': 'data',
+           'params_dump': params_dump, 'trained': 0}
+    (mod_id, memoized), = cm.claim_models([dict(doc)])
+    assert memoized is None
+    with pytest.raises(sqlite_db.DuplicateKeyError):
+        cm.claim_models([dict(doc)])
+
+    # being trained by another task
+    (claimed, memoized), = cm.claim_models([dict(doc)], memoize=True)
+    assert claimed is None and memoized['pending']
+    with pytest.raises(Exception):
+        cm.wait_memoized(memoized, timeout=0.01, interval=0.01)
+
+    # the task training the model was lost
+    sqlite_db.update({'_id': mod_id},
+                     {'$set': {'datetime': datetime(2000, 1, 1)}})
+    assert cm.get_memoized('moddata', pending=True) is None
+    with pytest.raises(Exception):
+        cm.wait_memoized(memoized)
+    assert cm.claim_models([dict(doc, datetime=datetime.now())],
+                           memoize=True) == [(mod_id, None)]
+    assert cm.get_memoized('moddata', pending=True) is not None
+
+    sqlite_db.update({'_id': mod_id}, {'$set': {'trained': 1,
+                                                'iter_stopped': 1}})
+    sqlite_db.insert_metrics(mod_id, {'loss': [0.5]})
+    # the parameters were lost: the model is trained again
+    assert cm.get_memoized('moddata') is None
+    assert cm.get_memoized('moddata', check_file=False) is not None
+    assert cm.claim_models([dict(doc)], memoize=True) == [(mod_id, None)]
+
+    sqlite_db.update({'_id': mod_id}, {'$set': {'trained': 1}})
+    open(params_dump, 'w').close()
+    res = cm.wait_memoized(memoized)
+    assert res['metrics']['loss'] == [0.5] and 'pending' not in res
+    (claimed, memoized), = cm.claim_models([dict(doc)], memoize=True)
+    assert claimed is None and memoized['model_id'] == 'mod'
+
+    sqlite_db.update({'_id': mod_id}, {'$set': {'error': 1}})
+    with pytest.raises(Exception):
+        cm.wait_memoized({'model_id': 'mod', 'data_id': 'data',
+                          'pending': True})
+    assert cm.claim_models([dict(doc)], memoize=True) == [(mod_id, None)]
+    assert cm.get_memoized('moddata', pending=True)['error'] == 0
+
+
+def test_results_from_db(sqlite_db):
+    doc = {'mod_data_id': 'moddata', 'mod_id': 'mod', 'data_id': 'data',
+           'params_dump': 'params.h5', 'trained': 1, 'iter_stopped': 2}
+    mod_id = sqlite_db.insert(dict(doc), sqlite_db.get_models())
+    sqlite_db.insert_metrics(mod_id, {'loss': [0.5, 0.4]})
+    res = cm.results_from_db(sqlite_db.get_models().find_one({'_id': mod_id}))
+    assert res['metrics'] == {'loss': [0.5, 0.4], 'iter': 2}
+
+    # a document written before the metrics collection
+    old = dict(doc, mod_data_id='old', loss=0.4,
+               metrics={'loss': [0.5, 0.4], 'iter': 2})
+    del old['iter_stopped']
+    old_id = sqlite_db.insert(old, sqlite_db.get_models())
+    res = cm.results_from_db(sqlite_db.get_models().find_one({'_id': old_id}))
+    assert res['metrics'] == {'loss': [0.5, 0.4], 'iter': 2}
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -1,7 +1,10 @@
 """Tests for the sklearn backend"""
 
+import os
+
 import numpy as np
 import pytest
+import scipy.sparse as sparse
 import sklearn
 
 from fuel.datasets.hdf5 import H5PYDataset
@@ -201,6 +204,23 @@ class TestExperiment:
         assert(np.allclose(alp_pred, sklearn_pred))
         print(self)
 
+    def test_experiment_fit_memoize(self, get_model_data_expe):
+        data, data_val, _, model, metric, expe = get_model_data_expe
+
+        expe.fit([data], [data_val], model=model, overwrite=True,
+                 metrics=metric)
+        mod_id, data_id = expe.mod_id, expe.data_id
+
+        res, _ = expe.fit([data], [data_val], memoize=True)
+        assert res['memoized']
+        assert expe.mod_id == mod_id
+        assert expe.data_id == data_id
+
+        _, thread = expe.fit_async([data], [data_val], memoize=True)
+        thread.join()
+        assert expe.full_res['memoized']
+        print(self)
+
     def test_experiment_fit_gen_nogenval(self, get_model_data_expe):
         '''
             Main case: generator on train
@@ -388,5 +408,150 @@ def test_utils():
         SKB.typeconversion(el)
 
 
+def test_make_scorer():
+    data, _ = generate_data(True)
+    X, y = data['X'], data['y']
+    for model in SKB.SUPPORTED:
+        model = model()
+        if getname(model, call=False) in CLASSIF:
+            model.fit(X, y)
+        else:
+            model.fit(X, X[:, 0])
+        scorer = SKB.make_scorer(model)
+        if scorer is None:
+            assert isinstance(model, SKB.KernelRidge)
+            continue
+        assert np.allclose(scorer(X), model.predict(X))
+        assert np.allclose(SKB.make_scorer(model, check_input=False)(X),
+                           model.predict(X))
+        with pytest.raises(ValueError):
+            scorer(X[:, :2])
+
+
+def test_load_compiled(tmpdir, monkeypatch):
+    monkeypatch.setattr(SKB, 'COMPILED_MODELS', dict())
+    data, _ = generate_data(True)
+    X, y = data['X'], data['y']
+    model = SKB.Ridge(alpha=1.).fit(X, y)
+    params_dump = str(tmpdir.join('params.h5'))
+    SKB.save_params(model, params_dump)
+    ref = {'mod_id': 'mod', 'data_id': 'data', 'params_dump': params_dump,
+           'model_arch': SKB.to_dict_w_opt(model)}
+    arch = SKB.copy.deepcopy(ref['model_arch'])
+    compiled = SKB.load_compiled(ref)
+    assert SKB.load_ref('mod', 'data') is compiled
+    # the model dicts are read-only for the backend
+    SKB.predict(ref, X)
+    assert ref['model_arch'] == arch
+    fast = SKB.get_predict_f(compiled, fast=True)
+    assert SKB.get_predict_f(compiled, fast=True) is fast
+
+    model.fit(X, 2 * y)
+    SKB.save_params(model, params_dump)
+    os.utime(params_dump, (0, 0))
+    reloaded = SKB.load_ref('mod', 'data')
+    assert reloaded is not compiled
+    assert np.allclose(reloaded['model'].predict(X), model.predict(X))
+    assert np.allclose(fast(X), 0.5 * model.predict(X))
+
+
+def test_score_linear_models():
+    data, _ = generate_data(True)
+    X, y = data['X'], data['y']
+    models = [SKB.Ridge(alpha=a).fit(X, X[:, 0]) for a in [0.1, 1.]]
+    models += [SKB.LogisticRegression().fit(X, y),
+               SKB.LogisticRegression().fit(X, y == 1),
+               SKB.QuadraticDiscriminantAnalysis().fit(X, y)]
+    preds = SKB.score_linear_models(models, X, chunk_rows=7)
+    for pred, model in szip(preds, models):
+        assert np.allclose(pred, model.predict(X))
+
+
+def test_fit_regularization_path():
+    data, _ = generate_data(True)
+    X, y = data['X'], data['y']
+    sweeps = [(SKB.Ridge, 'alpha', [10., 0.1, 1.], X[:, 0], {}),
+              (SKB.Ridge, 'alpha', [10., 0.1], X[:, 0], {'normalize': True}),
+              (SKB.Lasso, 'alpha', [0.01, 0.1], X[:, 0], {}),
+              (SKB.LassoLars, 'alpha', [0.001, 0.1, 0.01], X[:, 0], {}),
+              (SKB.LassoLars, 'alpha', [0.001, 0.1], X[:, 0],
+               {'normalize': False}),
+              (SKB.LogisticRegression, 'C', [1., 0.1], y, {})]
+    for model_class, param, values, target, params in sweeps:
+        models = [model_class(**dict(params, **{param: v})) for v in values]
+        fitted = SKB.fit_regularization_path(models, X, target)
+        for model, estimator in szip(models, fitted):
+            assert getattr(estimator, param) == getattr(model, param)
+            model.fit(X, target)
+            assert np.allclose(estimator.predict(X), model.predict(X),
+                               atol=1e-3)
+
+
+def test_fit_from_stats(tmpdir, monkeypatch):
+    from alp.appcom.utils import ArrayCache
+    from alp.appcom.utils import MemmapCache
+    monkeypatch.setattr(SKB, 'STATS_CACHE', ArrayCache())
+    monkeypatch.setattr(SKB, 'STATS_FILES', MemmapCache(str(tmpdir)))
+    data, _ = generate_data(True)
+    X = data['X'][:, 1:]
+    targets = [data['X'][:, 0], data['X'][:, :1]]
+    models = [SKB.LinearRegression(), SKB.Ridge(alpha=2.),
+              SKB.Ridge(fit_intercept=False), SKB.Lars(normalize=False),
+              SKB.LassoLars(alpha=0.01, normalize=False)]
+    assert not SKB.supports_stats(SKB.Lasso())
+    assert not SKB.supports_stats(SKB.LinearRegression(),
+                                  sparse.csr_matrix(X))
+    assert not SKB.supports_stats(SKB.LinearRegression(normalize=True))
+    assert not SKB.supports_stats(SKB.Lars())
+
+    # the statistics are keyed by the content of the data
+    stats = SKB.get_linear_stats(X, targets[0])
+    assert np.array_equal(stats, SKB.linear_stats(X, targets[0]))
+    # same mean and first row
+    other = X.copy()
+    other[-1] += 1.
+    other[-2] -= 1.
+    assert not np.array_equal(SKB.get_linear_stats(other, targets[0]), stats)
+    SKB.STATS_CACHE.clear()
+    assert np.array_equal(SKB.get_linear_stats(X, targets[0]), stats)
+    assert SKB.STATS_FILES.stats()['hits'] == 1
+    for y in targets:
+        stats = SKB.linear_stats(X, y)
+        for model in models:
+            if np.ndim(y) == 2 and isinstance(model, SKB.Lars):
+                continue
+            assert SKB.supports_stats(model)
+            fitted = SKB.fit_from_stats(SKB.copy.deepcopy(model), stats, X, y)
+            model.fit(X, y)
+            assert np.allclose(fitted.coef_, model.coef_)
+            assert np.allclose(fitted.predict(X), model.predict(X))
+
+
+def test_get_kernel(tmpdir, monkeypatch):
+    from alp.appcom.utils import MemmapCache
+    monkeypatch.setattr(SKB, 'KERNEL_CACHE', MemmapCache(str(tmpdir)))
+    data, data_val = generate_data(True)
+    model = SKB.KernelRidge(kernel='rbf', gamma=0.5)
+    assert SKB.supports_kernel_cache(model)
+    assert not SKB.supports_kernel_cache(
+        SKB.KernelRidge(kernel='rbf', kernel_params={'gamma': 5.}))
+    params = SKB.kernel_params(model)
+    K = SKB.get_kernel(params, data['X'])
+    K_val = SKB.get_kernel(params, data['X'], data_val['X'])
+    assert K_val.shape == (len(data_val['X']), len(data['X']))
+    assert SKB.get_kernel(params, data['X']).shape == K.shape
+    assert SKB.KERNEL_CACHE.stats()['hits'] == 1
+    # the kernels are keyed by the content of the inputs
+    other = data['X'].copy()
+    other[-1] += 1.
+    other[-2] -= 1.
+    assert not np.allclose(SKB.get_kernel(params, other), K)
+
+    model.fit(data['X'], data['y'])
+    precomputed = SKB.KernelRidge(kernel='precomputed', gamma=0.5)
+    precomputed.fit(K, data['y'])
+    assert np.allclose(precomputed.predict(K_val), model.predict(data_val['X']))
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
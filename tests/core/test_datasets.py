@@ -0,0 +1,55 @@
+import pickle
+
+import numpy as np
+import pytest
+from alp.appcom.datasets import ArrayStream
+from alp.appcom.datasets import shard_manifest
+from alp.appcom.datasets import to_npy_dataset
+from alp.appcom.utils import check_gen
+from alp.appcom.utils import get_nb_chunks
+
+
+def test_array_stream(tmpdir):
+    X = np.arange(40, dtype='float32').reshape((20, 2))
+    y = np.arange(20)
+    path, i_names, o_names = to_npy_dataset([X], [y], [0, 15],
+                                            ['train', 'test'], 'data',
+                                            str(tmpdir))
+    assert i_names == ['input_list_0']
+    assert o_names == ['output_list_0']
+
+    stream = ArrayStream(path, 'train', batch_size=4)
+    assert stream.sources == ('input_list_0', 'output_list_0')
+    assert check_gen([stream])
+    assert get_nb_chunks(stream) == 4
+    batches = list(stream.get_epoch_iterator())
+    assert len(batches) == 4
+    assert isinstance(batches[0][0], np.memmap)
+    assert np.array_equal(np.concatenate([b[0] for b in batches]), X[:15])
+
+    stream = pickle.loads(pickle.dumps(
+        ArrayStream(path, 'test', batch_size=2, shuffle=True, seed=1)))
+    ys = np.concatenate([b[1] for b in stream.get_epoch_iterator()])
+    assert sorted(ys) == list(range(15, 20))
+    for X_b, y_b in stream.get_epoch_iterator():
+        assert np.array_equal(X_b, X[y_b])
+
+
+def test_shard_manifest(tmpdir):
+    X = np.arange(20, dtype='float32').reshape((10, 2))
+    path, _, _ = to_npy_dataset([X], [X[:, 0]], [0, 7], ['train', 'test'],
+                                'data', str(tmpdir))
+    shards = shard_manifest(path, 3)
+    assert len(shards) == 3
+    ys = []
+    for shard in shards:
+        stream = ArrayStream(shard, 'train', batch_size=2)
+        ys += [b[1] for b in stream.get_epoch_iterator()]
+    assert np.array_equal(np.concatenate(ys), X[:7, 0])
+    sizes = [len(ArrayStream(s, 'test', 1).iteration_scheme.indices)
+             for s in shards]
+    assert sizes == [1, 1, 1]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
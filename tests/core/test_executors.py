@@ -0,0 +1,81 @@
+"""Tests the local executor"""
+
+import os
+import pickle
+
+import numpy as np
+import pytest
+from alp.appcom.executors import CeleryExecutor
+from alp.appcom.executors import ProcessExecutor
+from alp.appcom.executors import SharedArray
+from alp.appcom.executors import get_executor
+from alp.appcom.executors import set_executor
+from alp.backend import common as cm
+
+
+def test_process_executor():
+    X = np.arange(20000, dtype='float64').reshape(100, 200)
+    with ProcessExecutor(max_workers=2) as executor:
+        keys = []
+        shared = executor.share([{'X': X, 'y': np.ones(3)}], keys)
+        executor._release(keys)
+        assert len(keys) == 1
+        assert isinstance(shared[0]['X'], SharedArray)
+        assert isinstance(shared[0]['y'], np.ndarray)
+        assert len(pickle.dumps(shared)) < 1000
+
+        results = [executor.submit(np, 'sum', X, axis=axis)
+                   for axis in [0, 1]]
+        for res, axis in zip(results, [0, 1]):
+            assert np.allclose(res.wait(), X.sum(axis=axis))
+            assert res.ready() and res.state == 'SUCCESS'
+        assert executor.arrays.stats()['hits'] == 2
+
+        res = executor.submit(np, 'reshape', X, (3, 3))
+        with pytest.raises(ValueError):
+            res.get()
+        assert res.state == 'FAILURE'
+
+
+def test_share_failure(monkeypatch):
+    def full(*args, **kwargs):
+        raise IOError('No space left on device')
+
+    X = np.arange(20000, dtype='float64').reshape(100, 200)
+    with ProcessExecutor(max_workers=1) as executor:
+        monkeypatch.setattr(np, 'save', full)
+        with pytest.warns(UserWarning):
+            shared = executor.share({'X': X}, [])
+            res = executor.submit(np, 'sum', X)
+        assert shared['X'] is X
+        assert np.allclose(res.wait(), X.sum())
+        assert os.listdir(executor.directory) == []
+
+
+def test_share_pending():
+    arrays = [np.full((100, 200), i, dtype='float64') for i in range(3)]
+    with ProcessExecutor(max_workers=1,
+                         max_bytes=arrays[0].nbytes + 1000) as executor:
+        first, second = [], []
+        executor.share(arrays[0], first)
+        executor.share(arrays[1], second)
+        assert len(os.listdir(executor.directory)) == 2
+        executor._release(first)
+        executor.share(arrays[2], [])
+        assert sorted(os.listdir(executor.directory)) == sorted(
+            executor.arrays.path(k).split(os.sep)[-1]
+            for k in second + [cm.create_input_hash(arrays[2])])
+
+
+def test_set_executor():
+    assert isinstance(get_executor(), CeleryExecutor)
+    executor = ProcessExecutor(max_workers=1)
+    set_executor(executor)
+    assert get_executor() is executor
+    set_executor(None)
+    executor.shutdown()
+    assert isinstance(get_executor(), CeleryExecutor)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -1,5 +1,8 @@
 """Tests Hyper parameter search"""
 
+import copy
+import os
+
 import keras
 import numpy as np
 import pytest
@@ -17,7 +20,17 @@ from sklearn.linear_model import LogisticRegression
 
 from alp.appcom.core import Experiment
 from alp.appcom.ensembles import HParamsSearch
+from alp.appcom.ensembles import average
+from alp.appcom.ensembles import get_top_k
+from alp.appcom.ensembles import median_stopping
+from alp.appcom.ensembles import metric_weights
+from alp.appcom.ensembles import path_groups
+from alp.appcom.ensembles import threshold_stopping
+from alp.appcom.ensembles import vote
+from alp.appcom.executors import ProcessExecutor
 from alp.appcom.utils import to_fuel_h5
+from alp.backend import common as cm
+from alp.dbbackend import get_models
 from alp.utils.utils_tests import batch_size
 from alp.utils.utils_tests import close_gens
 from alp.utils.utils_tests import make_data
@@ -60,6 +73,43 @@ def make_sklearn_experiments():
     return experiments
 
 
+def join_results(param_search):
+    for _, thread in param_search.results.values():
+        if thread is not None:
+            thread.join()
+
+
+def check_models(experiments):
+    """Check that each experiment has its own document and parameters
+
+    Returns:
+        the dates of the end of the trainings"""
+    assert len(set(expe.params_dump for expe in experiments)) == \
+        len(experiments)
+    finished = []
+    for expe in experiments:
+        assert expe.trained and os.path.isfile(expe.params_dump)
+        model_db = get_models().find_one({'mod_id': expe.mod_id,
+                                          'data_id': expe.data_id})
+        assert model_db['trained'] == 1
+        assert model_db['params_dump'] == expe.params_dump
+        finished.append(model_db['date_finished_training'])
+    return finished
+
+
+def check_independent(experiments, data, data_val):
+    """Check that the experiments trained together have the metrics of
+    independent fits"""
+    for expe in experiments:
+        alone = Experiment(copy.deepcopy(expe.model))
+        alone.fit([data], [data_val], overwrite=True)
+        assert alone.params_dump == expe.params_dump
+        metrics = alone.full_res['metrics']
+        for metric, values in expe.full_res['metrics'].items():
+            assert np.allclose(values, metrics[metric], atol=1e-3,
+                               equal_nan=True)
+
+
 class TestHParamsSearch:
     def test_fit(self):
         data, data_val = make_data(train_samples, test_samples)
@@ -147,6 +197,226 @@ class TestHParamsSearch:
         param_search.predict(data['X'])
         print(self)
 
+    def test_predict_all(self):
+        data, data_val = make_data(train_samples, test_samples)
+        experiments = make_sklearn_experiments()
+
+        param_search = HParamsSearch(experiments, metric='score', op=np.max)
+        data['y'] = np.argmax(data['y'], axis=1).ravel()
+        data_val['y'] = np.argmax(data_val['y'], axis=1).ravel()
+        param_search.fit([data], [data_val], overwrite=True)
+
+        preds = param_search.predict_all(data['X'], chunk_rows=16)
+        assert sorted(preds) == [0, 1, 2]
+        for i, expe in enumerate(experiments):
+            assert np.array_equal(preds[i], expe.predict(data['X']))
+        print(self)
+
+    def test_fit_path(self):
+        data, data_val = make_data(train_samples, test_samples)
+        data['y'] = np.argmax(data['y'], axis=1).ravel()
+        data_val['y'] = np.argmax(data_val['y'], axis=1).ravel()
+        experiments = make_sklearn_experiments()
+        assert path_groups(HParamsSearch(experiments).experiments) == \
+            [[0, 1, 2]]
+
+        param_search = HParamsSearch(experiments, metric='score', op=np.max)
+        param_search.fit_path([data], [data_val], overwrite=True)
+        finished = check_models(experiments)
+
+        # without overwrite, the models are not trained again
+        memoized = make_sklearn_experiments()
+        HParamsSearch(memoized).fit_path([data], [data_val], memoize=True)
+        assert check_models(memoized) == finished
+        check_independent(experiments, data, data_val)
+
+        param_search = HParamsSearch(make_sklearn_experiments())
+        param_search.fit_path_async([data], [data_val], overwrite=True)
+        join_results(param_search)
+        print(self)
+
+    def test_fit_async_local(self):
+        data, data_val = make_data(train_samples, test_samples)
+        data['y'] = np.argmax(data['y'], axis=1).ravel()
+        data_val['y'] = np.argmax(data_val['y'], axis=1).ravel()
+        experiments = make_sklearn_experiments()
+        failing = Experiment(LogisticRegression(C=-1.))
+
+        with ProcessExecutor(max_workers=2) as executor:
+            for expe in experiments + [failing]:
+                expe.executor = executor
+            param_search = HParamsSearch(experiments + [failing])
+            param_search.fit_async([data], [data_val], overwrite=True)
+            join_results(param_search)
+        check_models(experiments)
+        check_independent(experiments, data, data_val)
+
+        assert not failing.trained
+        assert failing.async_res.state == 'FAILURE'
+        with pytest.raises(ValueError):
+            failing.async_res.wait()
+        print(self)
+
+    def test_fit_pack(self):
+        data, data_val = make_data(train_samples, test_samples)
+        data['y'] = np.argmax(data['y'], axis=1).ravel()
+        data_val['y'] = np.argmax(data_val['y'], axis=1).ravel()
+        experiments = make_sklearn_experiments()
+
+        param_search = HParamsSearch(experiments, metric='score', op=np.max)
+        param_search.pack_sizer.first_size = 2
+        param_search.fit_pack([data], [data_val], overwrite=True)
+        assert param_search.pack_sizer.fit_time is not None
+        finished = check_models(experiments)
+
+        # without overwrite, the models are not trained again
+        memoized = make_sklearn_experiments()
+        HParamsSearch(memoized).fit_pack([data], [data_val], pack_size=2,
+                                         memoize=True)
+        assert check_models(memoized) == finished
+        check_independent(experiments, data, data_val)
+
+        # a failing model does not leave the rest of its pack pending
+        experiments = make_sklearn_experiments()
+        experiments.insert(1, Experiment(LogisticRegression(C=-1.)))
+        with pytest.raises(ValueError):
+            HParamsSearch(experiments).fit_pack([data], [data_val],
+                                                pack_size=4, overwrite=True)
+        data_hash = cm.create_data_hash([data])
+        for expe in experiments[1:]:
+            model_db = get_models().find_one(
+                {'mod_data_id': expe._mod_data_id(data_hash)})
+            assert model_db['error'] == 1 and model_db['trained'] == 0
+
+        param_search = HParamsSearch(make_sklearn_experiments())
+        param_search.fit_pack_async([data], [data_val], pack_size=2,
+                                    overwrite=True)
+        join_results(param_search)
+        print(self)
+
+
+def test_stopping_rules():
+    histories = {'a': [1., 0.5, 0.4],
+                 'b': [1.2, 1.1, 1.],
+                 'c': [0.9, 0.6, 0.5]}
+    assert median_stopping(histories) == ['b']
+    assert median_stopping(histories, min_steps=4) == []
+    assert median_stopping({'a': [0.1]}) == []
+
+    policy = threshold_stopping(0.45)
+    assert sorted(policy(histories)) == ['b', 'c']
+    assert policy(histories, op=np.max) == ['a']
+
+
+def test_merge_predictions():
+    preds = np.array([[0, 1, 2], [0, 2, 2], [1, 2, 0]])
+    assert vote(preds).tolist() == [0, 2, 2]
+    assert np.allclose(average(preds), [1. / 3, 5. / 3, 4. / 3])
+
+
+class ProgressResult(object):
+    """An asynchronous result publishing a progress at each check"""
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self.state = 'PENDING'
+        self.info = None
+
+    def ready(self):
+        if len(self.steps) == 0:
+            self.state, self.info = 'SUCCESS', None
+            return True
+        self.state = 'PROGRESS'
+        self.info = {'step': self.steps.pop(0), 'metrics': {}}
+        return False
+
+
+def test_progress():
+    expe = Experiment()
+    assert expe.progress() is None
+
+    expe.async_res = ProgressResult([1, 1, 3])
+    steps = []
+    expe.subscribe(lambda e, progress: steps.append(progress['step']),
+                   interval=0).join()
+    assert steps == [1, 3]
+    assert expe.progress() is None
+
+    experiments = {'a': Experiment(), 'b': Experiment(), 'c': Experiment()}
+    experiments['a'].async_res = ProgressResult([1, 2])
+    experiments['b'].async_res = ProgressResult([1])
+    experiments['b'].stopped = True
+    param_search = HParamsSearch(experiments)
+    steps = []
+    threads = param_search.subscribe(
+        lambda k, progress: steps.append((k, progress['step'])), interval=0)
+    assert list(threads) == ['a']
+    threads['a'].join()
+    assert steps == [('a', 1), ('a', 2)]
+
+
+class MonitoredResult(object):
+    """An asynchronous result of a task reporting a loss at each check"""
+    class request(object):
+        id = 'task'
+
+    def __init__(self, losses):
+        self.losses = list(losses)
+        self.state, self.info = 'STARTED', None
+        self.monitor = cm.TrainingMonitor('id', task=self, min_interval=60)
+        self.flushed = False
+
+    def update_state(self, state, meta):
+        self.state, self.info = state, meta
+
+    def ready(self):
+        if len(self.losses) > 0:
+            self.monitor.report({'loss': self.losses.pop(0)})
+            return False
+        if not self.flushed:
+            self.monitor.flush()
+            self.flushed = True
+            return False
+        self.state, self.info = 'SUCCESS', None
+        return True
+
+
+def test_progress_monitor(monkeypatch):
+    from alp import dbbackend as db
+    monkeypatch.setattr(db, 'report_metrics', lambda *args: False)
+    expe = Experiment()
+    expe.async_res = MonitoredResult([3., 2., 1.])
+    progresses = []
+    expe.subscribe(lambda e, progress: progresses.append(progress),
+                   interval=0).join()
+    # the steps 2 and 3 are throttled, then published by the flush
+    assert [progress['step'] for progress in progresses] == [1, 3]
+    assert progresses[0]['steps'] == [(1, {'loss': 3.})]
+    assert progresses[-1]['metrics'] == {'loss': 1.}
+    assert progresses[-1]['steps'] == [(2, {'loss': 2.}), (3, {'loss': 1.})]
+    assert expe.progress() is None
+
+
+class ScoredExperiment(object):
+    stopped = False
+
+    def __init__(self, losses):
+        self.full_res = {'metrics': {'val_loss': losses}}
+
+
+def test_top_k():
+    experiments = {'a': ScoredExperiment([0.5, 0.3]),
+                   'b': ScoredExperiment([0.4, 0.2]),
+                   'c': ScoredExperiment([0.6, 0.4]),
+                   'd': ScoredExperiment([np.nan])}
+    top = get_top_k(experiments, 'val_loss', np.min, k=2)
+    assert [key for key, _, _ in top] == ['b', 'a']
+    top = get_top_k(experiments, 'val_loss', np.max, k=5)
+    assert [key for key, _, _ in top] == ['c', 'a', 'b']
+
+    weights = metric_weights([0.2, 0.3], np.min)
+    assert np.allclose(weights, [0.6, 0.4])
+    assert np.allclose(metric_weights([0.2, 0.3], np.max), [0.4, 0.6])
+
 
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 import pytest
 
 from alp.dbbackend import mongo_backend as mgb
@@ -8,5 +10,26 @@ def test_create_db():
     mgb.create_db(False)
 
 
+def test_queries():
+    mgb.create_db(True)
+    for i, val_loss in enumerate([0.5, 0.2, float('nan'), 0.3]):
+        full_json = {'mod_data_id': str(i) + 'data',
+                     'data_id': 'data',
+                     'backend_name': 'sklearn',
+                     'datetime': datetime.now(),
+                     'trained': 1,
+                     'val_loss': val_loss}
+        inserted = mgb.insert(full_json, mgb.get_models())
+        mgb.insert_metrics(inserted, {'val_loss': [1., val_loss],
+                                      'iter': 2})
+
+    best = mgb.find_best('data', 'val_loss', k=2)
+    assert [b['val_loss'] for b in best] == [0.2, 0.3]
+    assert mgb.get_history(best[0]['_id']) == {'val_loss': [1., 0.2]}
+    assert len(mgb.find_trained('sklearn')) == 4
+    assert len(mgb.find_trained('keras')) == 0
+    mgb.create_db(True)
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
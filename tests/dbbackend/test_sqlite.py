@@ -0,0 +1,90 @@
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+
+from alp.dbbackend import sqlite_backend as sqb
+
+
+@pytest.fixture(autouse=True)
+def sqlite_path(tmpdir, monkeypatch):
+    monkeypatch.setattr(sqb, '_sqlite_path', str(tmpdir.join('alp.sqlite')))
+
+
+def test_create_db():
+    sqb.create_db(True)
+    sqb.create_db(False)
+
+
+def test_insert_update():
+    models = sqb.get_models()
+    full_json = {'mod_data_id': 'moddata',
+                 'mod_id': 'mod',
+                 'data_id': 'data',
+                 'datetime': datetime.now(),
+                 'model_arch': {'config': 'LogisticRegression'},
+                 'trained': 0}
+    inserted = sqb.insert(full_json, models)
+    sqb.update({'_id': inserted}, {'$set': {'trained': 1, 'loss': 0.1}})
+
+    model_db = models.find_one({'mod_id': 'mod', 'data_id': 'data'})
+    assert model_db['_id'] == inserted
+    assert model_db['trained'] == 1
+    assert model_db['model_arch'] == {'config': 'LogisticRegression'}
+    assert model_db['datetime'] == full_json['datetime']
+
+    with pytest.raises(Exception):
+        sqb.insert(dict(full_json), models)
+    upserted = sqb.insert({'mod_data_id': 'moddata', 'trained': 0}, models,
+                          upsert=True)
+    assert upserted == inserted
+    assert models.find_one({'_id': inserted})['loss'] == 0.1
+
+
+def test_queries():
+    now = datetime.now()
+    for i, val_loss in enumerate([0.5, 0.2, float('nan'), 0.3]):
+        full_json = {'mod_data_id': str(i) + 'data',
+                     'data_id': 'data',
+                     'backend_name': 'sklearn',
+                     'datetime': now - timedelta(days=i),
+                     'task_id': 'task' + str(i),
+                     'trained': 1,
+                     'val_loss': val_loss}
+        inserted = sqb.insert(full_json, sqb.get_models())
+        sqb.insert_metrics(inserted, {'val_loss': [1., val_loss],
+                                      'iter': 2})
+
+    best = sqb.find_best('data', 'val_loss', k=2)
+    assert [b['val_loss'] for b in best] == [0.2, 0.3]
+    assert sqb.get_history(best[0]['_id']) == {'val_loss': [1., 0.2]}
+    assert len(sqb.find_trained('sklearn')) == 4
+    assert len(sqb.find_trained('sklearn', now - timedelta(hours=36))) == 2
+    assert len(sqb.find_trained('keras')) == 0
+
+    assert not sqb.report_metrics(best[0]['_id'], 3, {'val_loss': 0.1})
+    sqb.update({'task_id': 'task1'}, {'$set': {'stopped': 1}})
+    assert sqb.report_metrics(best[0]['_id'], 4, {'val_loss': 0.1})
+    partial = sqb.get_partial_metrics(['task1', 'task3'])
+    assert partial['task1'] == {'val_loss': [1., 0.2, 0.1, 0.1]}
+    assert partial['task3'] == {'val_loss': [1., 0.3]}
+
+
+def test_insert_trained():
+    docs = [{'mod_data_id': str(i) + 'data', 'trained': 1, 'loss': i}
+            for i in range(3)]
+    metrics = [{'loss': [1., float(i)], 'iter': 2} for i in range(3)]
+    inserted = sqb.insert_trained(docs, metrics)
+    assert len(set(inserted)) == 3
+    assert sqb.get_history(inserted[2]) == {'loss': [1., 2.]}
+
+    docs = [{'mod_data_id': '0data', 'loss': 5}]
+    assert sqb.insert_trained(docs, [{'loss': [5.]}],
+                              upsert=True) == inserted[:1]
+    model_db = sqb.get_models().find_one({'_id': inserted[0]})
+    assert model_db['loss'] == 5 and model_db['trained'] == 1
+    assert sqb.get_history(inserted[0]) == {'loss': [5.]}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])